@@ -1,31 +1,29 @@
+import argparse
+import time
+import os
 import pygame
 import numpy as np
 import math
 import random
-from scipy.spatial import KDTree
-from numba import jit
+
+from sim_core import (PI, WIDTH, HEIGHT, EPSILON, FORCE_BACKENDS, INTEGRATORS, BLOCK_LEVELS,
+                      MASS_SCALE, preset_colors, Universe, warm_up_kernels)
+from sim_profiler import profiler
+from sim_recording import Player, TrajectoryReader, frame_arrays
 
 # =============================================================================
-# Constants and Simulation Parameters
+# Front-end Parameters
 # =============================================================================
-PI = math.pi
-WIDTH, HEIGHT = 1900, 1000
 FPS = 60
-DT = 86400
-time_speed = 1.0
-c = 2.99792458e8            # Speed of light (m/s)
-h = 6.62607015e-34          # Planck's constant (J·s)
-Lambda = 1.0e-52            # Cosmological constant (m^-2)
-alpha = 1/137.0
-G_SIM = 6e-11
-EPSILON = 1e-2
-
-NUM_RANDOM_PARTICLES = 100
 LIGHT_EFFECT_RADIUS = 150
-
-# AU scaling for galaxy systems (used with an extra scaling factor for visibility)
-AU_TO_PIXELS = 300 / 4500e6
-MASS_SCALE = 1e-27
+TRAIL_LINES_MAX = 2000    # Above this many visible trails they are drawn as pixels
+CHECKPOINT_PATH = "universe.ckpt"   # F5 saves here, F9 loads it
+RECORD_EVERY = 1          # Steps per recorded trajectory frame (F6)
+LOD_BODIES = 20000        # Visible bodies above which galaxy mode draws a density field
+LOD_GLYPH_MASS = 1e29     # kg; heavier bodies (suns, black holes) stay glyphs over the field
+LOD_GLYPHS_MAX = 1000     # Heaviest bodies drawn as glyphs over the field
+LOD_GLYPH_RADIUS = 2      # Smallest glyph radius in pixels, so glyphs stand out
+LOD_FLOOR = 0.3           # Brightness of a pixel holding a typical amount of mass
 
 # =============================================================================
 # Global Game States and Modes
@@ -36,101 +34,47 @@ creation_mode = False
 god_mode = False
 help_mode = False
 mini_game_mode = None     # Defense mode toggled with G
+show_trails = False       # Particle trails toggled with T
+show_profiler = False     # Per-phase timing HUD toggled with F3
 
 new_object_type = None
 # When entering creation mode, initialize specs with a default velocity and spin.
 new_object_specs = {}
-preset_colors = [(255,255,255), (255,255,0), (0,0,255), (255,0,0), (80,0,80)]
 selected_particle = None
+trajectory_path = None    # File being recorded while F6 recording is on
+replay = None             # Player over a recording when started with --replay
+replay_shown = None       # Recorded frame currently loaded into the universe
 
-# Galaxy / Solar System parameters
-NUM_GALAXIES = 2
-SYSTEMS_PER_GALAXY = 9
-PLANETS_PER_SYSTEM = 9
+# The simulation itself; the front-end only reads and commands it. With
+# --worker it is a RemoteUniverse stepped in a separate process.
+universe = Universe()
 
-alive_population = 1000
-defense_score = 0
-
-meteor_spawn_interval = 3000  # milliseconds between meteor spawns
-last_meteor_spawn = 0
-meteors = []  # List to track meteor particles
-defense_level = 1
-last_level_up = 0
-
-# =============================================================================
-# Predefined Real Solar System (Central System)
-# Distances are in pixels (tuned for good visibility).
-# =============================================================================
-REAL_SOLAR_SYSTEM = [
-    {"name": "Sun", "mass": 1.989e30, "radius": 50, "color": (255,255,0), "pos": (WIDTH/2, HEIGHT/2)},
-    {"name": "Mercury", "mass": 3.285e23, "radius": 5, "distance": 60, "color": (200,200,200)},
-    {"name": "Venus",   "mass": 4.867e24, "radius": 10, "distance": 90, "color": (255,165,0)},
-    {"name": "Earth",   "mass": 5.972e24, "radius": 12, "distance": 130, "color": (0,0,255)},
-    {"name": "Mars",    "mass": 6.39e23,  "radius": 8,  "distance": 170, "color": (255,0,0)},
-    {"name": "Jupiter", "mass": 1.898e27, "radius": 30, "distance": 240, "color": (255,255,255)},
-    {"name": "Saturn",  "mass": 5.683e26, "radius": 28, "distance": 300, "color": (255,255,200)},
-    {"name": "Uranus",  "mass": 8.681e25, "radius": 20, "distance": 350, "color": (0,255,255)},
-    {"name": "Neptune", "mass": 1.024e26, "radius": 18, "distance": 400, "color": (0,0,255)}
-]
-
-# =============================================================================
-# Pygame Initialization and Screen Setup
-# =============================================================================
-pygame.init()
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Cosmic Deity: Universe Sandbox")
-clock = pygame.time.Clock()
-font = pygame.font.SysFont("Arial", 18)
+# Pygame display objects, created by init_display() when main() starts.
+screen = None
+clock = None
+font = None
 
 # Camera and zoom settings
 camera_x, camera_y = WIDTH/2, HEIGHT/2
 zoom = 1.0
 
-particles = []
-lights = []
 NUM_STARS = 300
 stars = [(random.randint(0, WIDTH), random.randint(0, HEIGHT)) for _ in range(NUM_STARS)]
 
+# Pre-rendered background layers keyed by (name, size); see background_layer().
+layer_cache = {}
+
+
 # =============================================================================
-# Particle Class (PRU Relational Particle)
+# Pygame Initialization and Screen Setup
 # =============================================================================
-class Particle:
-    def __init__(self, name, position, mass, velocity, charge, color, visual_radius,
-                 fixed=False, spin=0, stable=False, p_type="generic"):
-        self.name = name
-        # Ensure position is 3D: if less than 3 components, pad with 0.
-        pos = np.array(position, dtype=np.float64)
-        if pos.shape[0] < 3:
-            pos = np.concatenate((pos, np.zeros(3 - pos.shape[0])))
-        self.position = pos
-
-        # Ensure velocity is 3D: if less than 3 components, pad with 0.
-        vel = np.array(velocity, dtype=np.float64)
-        if vel.shape[0] < 3:
-            vel = np.concatenate((vel, np.zeros(3 - vel.shape[0])))
-        self.velocity = vel
-
-        self.mass = mass
-        self.charge = charge
-        self.color = color
-        self.visual_radius = visual_radius
-        self.fixed = fixed
-        self.size = visual_radius
-        self.trail = []
-        self.spin = spin
-        self.stable = stable
-        self.p_type = p_type
-        self.spawn_time = pygame.time.get_ticks() if p_type == "meteor" else None
-
-    def draw(self, surface):
-        try:
-            # Project 3D position to 2D screen (ignoring z, or applying a simple perspective)
-            x_screen = int((self.position[0] - camera_x) * zoom + WIDTH / 2)
-            y_screen = int((self.position[1] - camera_y) * zoom + HEIGHT / 2)
-            pygame.draw.circle(surface, self.color, (x_screen, y_screen),
-                               max(1, int(self.size * zoom)))
-        except Exception:
-            pass
+def init_display():
+    global screen, clock, font
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Cosmic Deity: Universe Sandbox")
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont("Arial", 18)
 
 
 # =============================================================================
@@ -147,405 +91,198 @@ def draw_arrow(surface, start, end, color, width=2):
     right_y = end[1] - arrow_length * math.sin(angle + arrow_angle)
     pygame.draw.polygon(surface, color, [(end[0], end[1]), (left_x, left_y), (right_x, right_y)])
 
-@jit(nopython=True)
-def compute_force(pos, neighbor_pos, neighbor_mass, G_val, eps):
-    total = np.zeros(2)
-    for k in range(neighbor_pos.shape[0]):
-        diff0 = neighbor_pos[k, 0] - pos[0]
-        diff1 = neighbor_pos[k, 1] - pos[1]
-        dist = math.sqrt(diff0 * diff0 + diff1 * diff1) + eps
-        total[0] += G_val * neighbor_mass[k] * diff0 / (dist ** 3)
-        total[1] += G_val * neighbor_mass[k] * diff1 / (dist ** 3)
-    return total
-
 
+def screen_to_world(x, y):
+    return np.array([(x - WIDTH/2)/zoom + camera_x, (y - HEIGHT/2)/zoom + camera_y])
 
 
 # =============================================================================
-# 3D Compute Force Function (JIT-compiled)
+# Drawing Functions
 # =============================================================================
-@jit(nopython=True)
-def compute_force_3D(pos, neighbor_pos, neighbor_mass, G_val, eps):
+def world_to_screen(points):
+    """Project world coordinates (any leading shape, x/y in the last axis) to the screen."""
+    x_screen = (points[..., 0] - camera_x) * zoom + WIDTH / 2
+    y_screen = (points[..., 1] - camera_y) * zoom + HEIGHT / 2
+    return x_screen, y_screen
+
+def draw_particles(surface):
     """
-    Computes the net gravitational force on an object at position 'pos' (3D)
-    from neighbors (each given in neighbor_pos, a 2D array with shape (n, 3)).
-    Uses a softened Newtonian formula.
+    Projects all particles in one pass, culls those outside the viewport and
+    draws the rest: bodies smaller than a pixel are written straight into the
+    surface through surfarray, larger ones as circles. In galaxy mode with
+    more than LOD_BODIES visible bodies, the light ones are drawn as a
+    density field instead (see draw_density) and only the heaviest and the
+    selected body remain glyphs.
     """
-    total = np.zeros(3)
-    for k in range(neighbor_pos.shape[0]):
-        # Compute difference vector in 3D
-        diff = neighbor_pos[k] - pos
-        dist = math.sqrt(diff[0] * diff[0] + diff[1] * diff[1] + diff[2] * diff[2]) + eps
-        # Add contribution from neighbor k
-        total[0] += G_val * neighbor_mass[k] * diff[0] / (dist ** 3)
-        total[1] += G_val * neighbor_mass[k] * diff[1] / (dist ** 3)
-        total[2] += G_val * neighbor_mass[k] * diff[2] / (dist ** 3)
-    return total
-
-
-
-def update_gravitational_constant():
+    particles = universe.particles
+    n = len(particles)
+    if n == 0:
+        return
+    width, height = surface.get_size()
+    x_screen, y_screen = world_to_screen(particles.pos[:n])
+    radii = particles.radius[:n] * zoom
+    visible = ((x_screen + radii >= 0) & (x_screen - radii < width) &
+               (y_screen + radii >= 0) & (y_screen - radii < height))
+    if mode == "galaxy" and np.count_nonzero(visible) > LOD_BODIES:
+        mass = particles.mass[:n]
+        heavy = np.flatnonzero(visible & (mass >= LOD_GLYPH_MASS * MASS_SCALE))
+        if heavy.shape[0] > LOD_GLYPHS_MAX:
+            heavy = heavy[np.argpartition(mass[heavy], -LOD_GLYPHS_MAX)[-LOD_GLYPHS_MAX:]]
+        glyphs = np.zeros(n, dtype=np.bool_)
+        glyphs[heavy] = True
+        if selected_particle is not None and selected_particle in particles:
+            glyphs[selected_particle.row] = visible[selected_particle.row]
+        field = visible & ~glyphs
+        draw_density(surface, x_screen[field], y_screen[field], mass[field],
+                     particles.color[:n][field])
+        visible = glyphs
+        radii = np.where(glyphs, np.maximum(radii, LOD_GLYPH_RADIUS), radii)
+    dots = visible & (radii < 1)
+    if dots.any():
+        px = x_screen[dots].astype(np.int64)
+        py = y_screen[dots].astype(np.int64)
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels[px[inside], py[inside]] = particles.color[:n][dots][inside]
+        del pixels
+    # Skip discs pygame cannot take as integer pixel coordinates.
+    limit = 2 ** 30
+    discs = np.flatnonzero(visible & (radii >= 1) & (radii < limit) &
+                           (np.abs(x_screen) < limit) & (np.abs(y_screen) < limit))
+    if discs.shape[0] == 0:
+        return
+    x_screen = x_screen[discs].astype(np.int64).tolist()
+    y_screen = y_screen[discs].astype(np.int64).tolist()
+    radii = radii[discs].astype(np.int64).tolist()
+    colors = particles.color[:n][discs].tolist()
+    for x, y, r, color in zip(x_screen, y_screen, radii, colors):
+        pygame.draw.circle(surface, color, (x, y), r)
+
+def draw_density(surface, x_screen, y_screen, mass, colors):
     """
-    Dynamically updates G_SIM using the emergent formula:
-
-        G_SIM = (c * h) / (Lambda * alpha * sqrt(N_eff))
-
-    Here, N_eff is the effective particle count.
-    We set N_eff = N_sim * scale_factor, where scale_factor is chosen to represent
-    the real density of particles.
+    Adds the bodies at screen positions x_screen, y_screen to surface as a
+    mass-weighted histogram with one bin per pixel. Each pixel gets the
+    mass-weighted mean colour of its bodies, scaled by its mass on a log
+    scale from the median occupied pixel (LOD_FLOOR) to the densest one
+    (full brightness). Beyond the binning pass the cost depends on the
+    surface size only. Recorded frames carry no masses; they are binned by
+    count.
     """
-    global G_SIM, particles
-    N_sim = len(particles)
-    scale_factor = 1e76  # Choose this factor so that N_eff approximates the real universe (e.g., ~10^80)
-    N_eff = N_sim * scale_factor
-    if N_eff == 0:
-        N_eff = 1  # Avoid division by zero
-    sqrt_N = np.sqrt(N_eff)
-    G_SIM = (c * h) / (Lambda * alpha * sqrt_N)
-    # Optional: print debugging info
-    # print(f"N_sim = {N_sim}, N_eff = {N_eff:.3e}, sqrt(N_eff) = {sqrt_N:.3e}, G_SIM = {G_SIM:.3e}")
-
-
-# =============================================================================
-# Updated Universe Update Function in 3D
-# =============================================================================
-def update_universe():
+    width, height = surface.get_size()
+    px = x_screen.astype(np.int64)
+    py = y_screen.astype(np.int64)
+    inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    # Bin index in surfarray's (width, height) layout.
+    cell = px[inside] * height + py[inside]
+    weight = mass[inside].astype(np.float64)
+    if not weight.any():
+        weight = np.ones_like(weight)
+    size = width * height
+    density = np.bincount(cell, weights=weight, minlength=size)
+    occupied = np.flatnonzero(density > 0)
+    if occupied.shape[0] == 0:
+        return
+    tint = np.stack([np.bincount(cell, weights=weight * colors[inside, c], minlength=size)[occupied]
+                     for c in range(3)], axis=-1)
+    dense = density[occupied]
+    reference = np.median(dense)
+    level = np.log1p(dense / reference) / np.log1p(dense.max() / reference)
+    brightness = LOD_FLOOR + (1.0 - LOD_FLOOR) * np.minimum(level, 1.0)
+    rgb = np.zeros((size, 3), dtype=np.uint8)
+    rgb[occupied] = np.minimum(tint / dense[:, None] * brightness[:, None], 255)
+    key = ("density", (width, height))
+    layer = layer_cache.get(key)
+    if layer is None:
+        layer = layer_cache[key] = pygame.Surface((width, height)).convert()
+    pygame.surfarray.blit_array(layer, rgb.reshape(width, height, 3))
+    surface.blit(layer, (0, 0), special_flags=pygame.BLEND_ADD)
+
+def draw_trails(surface):
     """
-    Updates the simulation universe in 3D using a two-step Velocity Verlet-like integration:
-    1. Update gravitational constant G_SIM based on the current particle count.
-    2. Compute accelerations via KDTree neighbor searches (in full 3D).
-    3. Perform a half-step velocity update, update positions, rebuild KDTree,
-       recompute accelerations, then update velocities fully.
-    4. Update trails for visualization.
+    Draws every particle trail from the store's ring buffers. All points are
+    projected in one pass; trails are drawn as polylines, or as single pixels
+    written through surfarray when there are too many for per-trail calls.
     """
-    global particles, G_SIM, DT, time_speed
-
-    # Update dynamic gravitational constant first
-    update_gravitational_constant()
-
-    N = len(particles)
-    if N == 0:
+    particles = universe.particles
+    n = len(particles)
+    if n == 0 or particles.trail_length < 2:
         return
-
-    # Build positions array in 3D
-    positions = np.array([p.position for p in particles])
-    tree = KDTree(positions)
-    acc = np.zeros((N, 3))
-
-    # First acceleration pass using up to 5 nearest neighbors.
-    for i, p in enumerate(particles):
-        if p.fixed:
-            continue
-        k = 5 if N >= 5 else N
-        neighbors_idx = tree.query(positions[i], k=k)[1]
-        if i not in neighbors_idx:
-            neighbors_idx = np.append(neighbors_idx, i)
-        neighbor_list = [particles[j] for j in neighbors_idx if j != i]
-        if len(neighbor_list) == 0:
-            continue
-        neighbor_positions = np.array([n.position for n in neighbor_list])
-        neighbor_masses = np.array([n.mass for n in neighbor_list])
-        force = compute_force_3D(p.position, neighbor_positions, neighbor_masses, G_SIM, EPSILON)
-        acc[i] = force / p.mass
-
-    # Half-step velocity update.
-    for i, p in enumerate(particles):
-        if not p.fixed:
-            p.velocity += 0.5 * acc[i] * DT * time_speed
-
-    # Update positions using the half-step velocities.
-    for i, p in enumerate(particles):
-        if not p.fixed:
-            p.position += p.velocity * DT * time_speed
-
-    # Rebuild positions array and KDTree after moving.
-    positions = np.array([p.position for p in particles])
-    tree = KDTree(positions)
-    new_acc = np.zeros((N, 3))
-
-    # Second acceleration pass.
-    for i, p in enumerate(particles):
-        if p.fixed:
-            continue
-        neighbors_idx = tree.query(positions[i], k=5)[1]
-        if i not in neighbors_idx:
-            neighbors_idx = np.append(neighbors_idx, i)
-        neighbor_list = [particles[j] for j in neighbors_idx if j != i]
-        if len(neighbor_list) == 0:
-            continue
-        neighbor_positions = np.array([n.position for n in neighbor_list])
-        neighbor_masses = np.array([n.mass for n in neighbor_list])
-        force = compute_force_3D(p.position, neighbor_positions, neighbor_masses, G_SIM, EPSILON)
-        new_acc[i] = force / p.mass
-
-    # Full velocity update and trail update.
-    for i, p in enumerate(particles):
-        if not p.fixed:
-            p.velocity += 0.5 * new_acc[i] * DT * time_speed
-            p.trail.append(tuple(p.position))
-            if len(p.trail) > 20:
-                p.trail.pop(0)
-
-
-def handle_collisions():
-    global particles, alive_population, defense_score
-    merged_particles = []
-    to_remove = set()
-    N = len(particles)
-    MASS_CAP = 1e31  # Example maximum mass for an object
-    for i in range(N):
-        for j in range(i + 1, N):
-            p1 = particles[i]
-            p2 = particles[j]
-            # Skip if both are stable, etc.
-            if p1.stable and p2.stable:
-                continue
-            # Check for collision based on visual radii
-            if np.linalg.norm(p1.position - p2.position) < (p1.visual_radius + p2.visual_radius) * 0.5:
-                new_mass = p1.mass + p2.mass
-                # Only merge if new mass is below cap, otherwise, "absorb" the smaller into the larger
-                if new_mass < MASS_CAP:
-                    new_velocity = (p1.mass * p1.velocity + p2.mass * p2.velocity) / new_mass
-                    new_color = tuple(min(255, int((p1.color[k] * p1.mass + p2.color[k] * p2.mass) / new_mass))
-                                      for k in range(3))
-                    new_radius = (p1.visual_radius ** 3 + p2.visual_radius ** 3) ** (1 / 3)
-                    merged_particles.append(Particle(p1.name + "+" + p2.name,
-                                                     (p1.mass * p1.position + p2.mass * p2.position) / new_mass,
-                                                     new_mass, new_velocity, 0, new_color, new_radius))
-                    to_remove.add(i)
-                    to_remove.add(j)
-                else:
-                    # Absorb: larger object gains the mass of the smaller, but no new object is created
-                    if p1.mass > p2.mass:
-                        p1.mass = new_mass
-                        p1.velocity = (p1.mass * p1.velocity + p2.mass * p2.velocity) / new_mass
-                        to_remove.add(j)
-                    else:
-                        p2.mass = new_mass
-                        p2.velocity = (p1.mass * p1.velocity + p2.mass * p2.velocity) / new_mass
-                        to_remove.add(i)
-    if to_remove:
-        particles[:] = [particles[i] for i in range(N) if i not in to_remove]
-        particles.extend(merged_particles)
-
-
-# =============================================================================
-# Object Creation Functions
-# =============================================================================
-def create_particle_from_dict(specs, stable=False, p_type="user", fixed=False):
-    name = specs["name"]
-    color = specs["color"]
-    pos = np.array(specs["pos"], dtype=np.float64)
-    velocity = specs.get("velocity", np.array([0, 0]))
-    mass = specs["mass"] * MASS_SCALE
-    visual_radius = specs["radius"]
-    spin = specs.get("spin", 0)
-    particles.append(Particle(name, pos, mass, velocity, 0, color, visual_radius, fixed, spin, stable, p_type))
-
-# -----------------------------------------------------------------------------
-# Solar System and Galaxy Creation Functions
-# -----------------------------------------------------------------------------
-
-# =============================================================================
-# Updated Function: create_real_solar_system
-# =============================================================================
-def create_real_solar_system():
-    # Create the Sun (ensure its position is 3D)
-    for body in REAL_SOLAR_SYSTEM:
-        if body["name"] == "Sun":
-            specs = body.copy()
-            # Convert 2D pos to 3D: add a 0 for z.
-            pos_2d = np.array(specs["pos"], dtype=np.float64)
-            specs["pos"] = np.concatenate((pos_2d, [0]))
-            create_particle_from_dict(specs, stable=True, p_type="system", fixed=True)
-
-    # Create orbiting bodies (planets)
-    sun = next((b for b in REAL_SOLAR_SYSTEM if b["name"] == "Sun"), None)
-    if sun is None:
+    rows = np.flatnonzero(particles.trail_len[:n] >= 2)
+    if rows.shape[0] == 0:
         return
-    sun_pos_2d = np.array(sun["pos"], dtype=np.float64)
-    sun_pos = np.concatenate((sun_pos_2d, [0]))
-    sun_mass = sun["mass"]
-
-    for body in REAL_SOLAR_SYSTEM:
-        if body["name"] != "Sun":
-            angle = random.uniform(0, 2 * PI)
-            distance = body["distance"]
-            # Create a 3D position; z can be 0 or a small random offset if desired.
-            pos_2d = np.array([sun_pos[0] + distance * math.cos(angle),
-                               sun_pos[1] + distance * math.sin(angle)], dtype=np.float64)
-            pos = np.concatenate((pos_2d, [0]))  # 3D position
-            v_mag = math.sqrt(G_SIM * sun_mass * MASS_SCALE / (distance + EPSILON))
-            velocity_2d = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
-            velocity = np.concatenate((velocity_2d, [0]))
-            specs = {
-                "name": body["name"],
-                "mass": body["mass"],
-                "radius": body["radius"],
-                "color": body["color"],
-                "pos": pos,
-                "velocity": velocity,
-                "spin": 0
-            }
-            create_particle_from_dict(specs, stable=True, p_type="system")
-
-def create_solar_system(center, sys_velocity, num_planets=PLANETS_PER_SYSTEM):
-    # Use a simple scaling factor; here we assume distances are given in pixels.
-    solar_distance_factor = 1.0  # Direct pixel values for orbit radii.
-    sun_color = (255, 255, 0)
-    sun_mass = 1.989e30  # SI units
-    sun_radius = 50
-
-    # Ensure center and sys_velocity are 3D vectors.
-    center = np.array(center, dtype=np.float64)
-    if center.shape[0] < 3:
-        center = np.concatenate((center, [0]))
-    sys_velocity = np.array(sys_velocity, dtype=np.float64)
-    if sys_velocity.shape[0] < 3:
-        sys_velocity = np.concatenate((sys_velocity, [0]))
-
-    sun = {
-        "name": f"Sun-{random.randint(0,1000)}",
-        "mass": sun_mass,
-        "radius": sun_radius,
-        "color": sun_color,
-        "pos": center,
-        "velocity": sys_velocity,
-        "spin": 0
-    }
-    create_particle_from_dict(sun, stable=True, p_type="system")
-
-    # Use fixed orbital distances for stability (e.g., evenly spaced).
-    base_distances = np.linspace(200, 600, num_planets)  # in pixels
-    for i in range(num_planets):
-        distance = base_distances[i] * solar_distance_factor
-        angle = random.uniform(0, 2 * PI)
-        pos_2d = np.array([center[0] + distance * math.cos(angle),
-                           center[1] + distance * math.sin(angle)], dtype=np.float64)
-        pos = np.concatenate((pos_2d, [0]))  # 3D position; z = 0 initially.
-        r = np.linalg.norm(pos - center)
-        # Circular orbit: v = sqrt(G * M_sun / r)
-        # Use the effective gravitational constant G_SIM.
-        v_mag = math.sqrt(G_SIM * sun_mass * MASS_SCALE / (r + EPSILON))
-        vel_2d = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
-        velocity = np.concatenate((vel_2d, [0])) + sys_velocity
-        planet = {
-            "name": f"Planet-{random.randint(0,1000)}",
-            "mass": random.uniform(1e24, 5e24),
-            "radius": random.uniform(5,15),
-            "color": random.choice(preset_colors),
-            "pos": pos,
-            "velocity": velocity * 15,
-            "spin": 0
-        }
-        create_particle_from_dict(planet, stable=True, p_type="system")
-
-
-
-def create_galaxy(galaxy_center, num_systems=SYSTEMS_PER_GALAXY, galaxy_radius=500e6):
-    for i in range(num_systems):
-        angle = random.uniform(0, 2 * PI)
-        distance = random.uniform(0.2, 1.0) * galaxy_radius * AU_TO_PIXELS
-        sys_center = np.array([galaxy_center[0] + distance * math.cos(angle),
-                               galaxy_center[1] + distance * math.sin(angle)], dtype=np.float64)
-        r = np.linalg.norm(sys_center - np.array(galaxy_center))
-        v_mag = math.sqrt(G_SIM * 1e40 / (r + EPSILON))
-        sys_velocity = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
-        create_solar_system(sys_center, sys_velocity)
-
-def create_galaxies():
-    for i in range(NUM_GALAXIES):
-        galaxy_center = (random.uniform(WIDTH * 0.2, WIDTH * 0.8),
-                         random.uniform(HEIGHT * 0.2, HEIGHT * 0.8))
-        create_galaxy(galaxy_center)
-
-def create_random_particle(position):
-    pos = np.array(position, dtype=np.float64)
-    # Pad position to 3D if necessary:
-    if pos.shape[0] < 3:
-        pos = np.concatenate((pos, np.zeros(3 - pos.shape[0])))
-    sun = next((p for p in particles if p.name.startswith("Sun")), None)
-    if sun:
-        r_vec = pos - sun.position
-        r = np.linalg.norm(r_vec)
-        if r > EPSILON:
-            angle = math.atan2(r_vec[1], r_vec[0])
-            v_mag = math.sqrt(G_SIM * sun.mass / (r + EPSILON))
-            velocity = np.array([-math.sin(angle), math.cos(angle)])
-            # Pad velocity to 3D:
-            velocity = np.concatenate((velocity, [0]))
-            velocity *= v_mag
-        else:
-            velocity = np.array([0, 0, 0])
-    else:
-        velocity = np.array([random.uniform(-0.5, 0.5), random.uniform(-0.5, 0.5)])
-        velocity = np.concatenate((velocity, [0]))
-    mass = random.uniform(50, 1000) * MASS_SCALE
-    color = (random.randint(100, 255), random.randint(100, 255), random.randint(100, 255))
-    visual_radius = random.uniform(5, 20)
-    spec = {
-        "name": "Custom",
-        "mass": mass / MASS_SCALE,
-        "radius": visual_radius,
-        "color": color,
-        "pos": pos,
-        "velocity": velocity,
-        "spin": 0
-    }
-    create_particle_from_dict(spec)
-
-
-def create_random_light(position):
-    lights.append(position)
+    points, valid = particles.trail_points(rows)
+    x_screen, y_screen = world_to_screen(points)
+    # Cull trails that lie entirely off-screen or too far out to rasterise.
+    inside = valid & (x_screen >= 0) & (x_screen < WIDTH) & (y_screen >= 0) & (y_screen < HEIGHT)
+    drawable = (~valid | ((np.abs(x_screen) < 2 ** 15) & (np.abs(y_screen) < 2 ** 15))).all(axis=1)
+    visible = inside.any(axis=1) & drawable
+    colors = particles.color[:n][rows] // 2
+    if visible.sum() > TRAIL_LINES_MAX:
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels[x_screen[inside].astype(np.int64), y_screen[inside].astype(np.int64)] = \
+            np.broadcast_to(colors[:, None, :], inside.shape + (3,))[inside]
+        del pixels
+        return
+    start = particles.trail_length - particles.trail_len[rows]
+    for t in np.flatnonzero(visible).tolist():
+        s = start[t]
+        line = np.stack((x_screen[t, s:], y_screen[t, s:]), axis=1).astype(np.int64).tolist()
+        pygame.draw.lines(surface, colors[t].tolist(), False, line)
 
 # =============================================================================
-# Meteor (Defense) Functions
+# Static Background Layers
 # =============================================================================
-def spawn_meteor():
-    edge = random.choice(["top", "bottom", "left", "right"])
-    if edge == "top":
-        pos = np.array([random.uniform(0, WIDTH), 0, 0])
-    elif edge == "bottom":
-        pos = np.array([random.uniform(0, WIDTH), HEIGHT, 0])
-    elif edge == "left":
-        pos = np.array([0, random.uniform(0, HEIGHT), 0])
-    else:
-        pos = np.array([WIDTH, random.uniform(0, HEIGHT), 0])
-    systems = [p for p in particles if p.stable and p.p_type == "system"]
-    if systems:
-        target = random.choice(systems)
-        direction = target.position - pos
-        norm = np.linalg.norm(direction)
-        direction = direction / norm if norm > EPSILON else np.array([0, 0, 0])
-    else:
-        direction = np.array([0, 0, 0])
-    speed = random.uniform(0, 0.00005) + (defense_level * 0.00005)
-    velocity = direction * speed
-    mass = random.uniform(1e22, 1e23)
-    radius = random.uniform(60, 100)  # Larger meteor radius for visibility.
-    color = (255, 100, 0)
-    meteor = Particle("Meteor", pos, mass, velocity, 0, color, radius,
-                        fixed=False, spin=0, stable=False, p_type="meteor")
-    meteor.spawn_time = pygame.time.get_ticks()
-    particles.append(meteor)
-    meteors.append(meteor)
+def render_starfield(size):
+    surface = pygame.Surface(size)
+    surface.fill((0, 0, 0))
+    for star in stars:
+        pygame.draw.circle(surface, (255,255,255), star, 1)
+    return surface
+
+def render_earth_backdrop(size):
+    width, height = size
+    horizon = int(height * 0.75)
+    y = np.arange(height, dtype=np.float64)
+    sky = y[:horizon, None] / (height * 0.75)
+    ground = (y[horizon:, None] - height * 0.75) / (height * 0.25)
+    rows = np.concatenate((
+        np.array([10, 10, 40]) + np.array([20, 30, 60]) * sky,
+        np.array([30, 100, 30]) + np.array([50, 80, 50]) * ground)).astype(np.int64)
+    surface = pygame.Surface(size)
+    pygame.surfarray.blit_array(surface, np.broadcast_to(rows, (width, height, 3)))
+    return surface
+
+LAYER_RENDERERS = {
+    "stars": render_starfield,
+    "earth": render_earth_backdrop,
+}
+
+def background_layer(name, size):
+    """Return the cached static layer, rendering it on first use for this size."""
+    key = (name, size)
+    layer = layer_cache.get(key)
+    if layer is None:
+        for stale in [k for k in layer_cache if k[0] == name]:
+            del layer_cache[stale]
+        layer = layer_cache[key] = LAYER_RENDERERS[name](size).convert()
+    return layer
+
+def frame_surface(size):
+    """Reusable off-screen surface for the cosmic view, reset to the starfield."""
+    key = ("frame", size)
+    surface = layer_cache.get(key)
+    if surface is None:
+        surface = layer_cache[key] = pygame.Surface(size).convert()
+    surface.blit(background_layer("stars", size), (0, 0))
+    return surface
 
-# =============================================================================
-# Drawing Functions
-# =============================================================================
 def draw_earth_environment(surface, current_time):
-    for y in range(0, int(HEIGHT * 0.75)):
-        ratio = y / (HEIGHT * 0.75)
-        sky_color = (int(10 + 20 * ratio), int(10 + 30 * ratio), int(40 + 60 * ratio))
-        pygame.draw.line(surface, sky_color, (0, y), (WIDTH, y))
-    for y in range(int(HEIGHT * 0.75), HEIGHT):
-        ratio = (y - HEIGHT * 0.75) / (HEIGHT * 0.25)
-        ground_color = (int(30 + 50 * ratio), int(100 + 80 * ratio), int(30 + 50 * ratio))
-        pygame.draw.line(surface, ground_color, (0, y), (WIDTH, y))
+    surface.blit(background_layer("earth", surface.get_size()), (0, 0))
+    width, height = surface.get_size()
     sun_angle = (current_time - 6) / 12 * PI
     sun_orbit_radius = 300
-    sun_x = WIDTH / 2 + sun_orbit_radius * math.cos(sun_angle - PI)
-    sun_y = HEIGHT * 0.75 - sun_orbit_radius * math.sin(sun_angle - PI)
+    sun_x = width / 2 + sun_orbit_radius * math.cos(sun_angle - PI)
+    sun_y = height * 0.75 - sun_orbit_radius * math.sin(sun_angle - PI)
     brightness = max(0, min(255, int(255 * math.sin(sun_angle))))
     sun_color = (brightness, brightness, 0)
     pygame.draw.circle(surface, sun_color, (int(sun_x), int(sun_y)), 40)
@@ -573,7 +310,7 @@ def draw_god_mode_ui(surface):
     surface.blit(panel_surface, (WIDTH - panel_width - 10, 10))
 
 def draw_help_ui(surface):
-    panel_width, panel_height = 500, 260
+    panel_width, panel_height = 500, 415
     panel_surface = pygame.Surface((panel_width, panel_height), pygame.SRCALPHA)
     panel_surface.fill((0, 0, 0, 220))
     instructions = [
@@ -581,8 +318,21 @@ def draw_help_ui(surface):
         "",
         "General:",
         "  SPACE: Pause/Resume simulation",
-        "  M: Toggle solar/galaxy view",
+        "  M: Toggle solar/galaxy view (crowded galaxies draw as a density field)",
         "  R: Restart simulation (menu)",
+        "  F: Cycle gravity solver, [/]: Barnes-Hut opening angle",
+        "  T: Toggle particle trails",
+        "  V: Toggle block timesteps (small steps for close encounters)",
+        "  F2: Energy/momentum diagnostics, F3: Profiler HUD",
+        "  F4: Start/stop recording a Chrome trace",
+        "  Y: Cycle integrator (Verlet, Yoshida 4th/6th order)",
+        "  X: Toggle float32 state precision (error shown with F2)",
+        "  F5: Save checkpoint, F9: Load checkpoint",
+        "  F6: Start/stop recording a trajectory (replay: sim.py --replay FILE)",
+        "",
+        "Replay:",
+        "  SPACE: Pause, LEFT/RIGHT: Step a frame, PGUP/PGDN: Skip 10%",
+        "  +/-: Speed, BACKSPACE: Reverse, drag the bar at the bottom to scrub",
         "",
         "Creation Mode:",
         "  N: Create planet, U: Create sun, B: Create black hole",
@@ -633,19 +383,188 @@ def draw_creation_ui(surface):
         y_offset += 14
     surface.blit(panel_surface, (10, HEIGHT - panel_height - 10))
 
-def draw_overlays(surface, simulation_time):
-    info_text = f"Time: {simulation_time:.1f}s | Mode: {mode} | Particles: {len(particles)} | DT: {DT:.3e}"
-    info_text += f" | TimeSpeed: {time_speed:.2f}"
+def draw_overlays(surface):
+    u = universe
+    info_text = f"Time: {u.simulation_time:.1f}s | Mode: {mode} | Particles: {len(u.particles)} | DT: {u.dt:.3e}"
+    info_text += f" | TimeSpeed: {u.time_speed:.2f} | Gravity: {u.force_backend}"
+    if u.force_backend == "barnes_hut":
+        info_text += f" (theta {u.bh_theta:.2f})"
+    if u.block_levels:
+        info_text += f" | Block steps: DT/{2 ** u.block_levels}"
+    else:
+        info_text += f" | Integrator: {u.integrator}"
+    if u.precision != "float64":
+        info_text += f" | {u.precision}"
     overlay = font.render(info_text, True, (255,255,255))
     surface.blit(overlay, (10, HEIGHT - 30))
-    pop_text = f"Alive: {alive_population}  Score: {defense_score}  Level: {defense_level}"
+    pop_text = f"Alive: {u.alive_population}  Score: {u.defense_score}  Level: {u.defense_level}"
     pop_overlay = font.render(pop_text, True, (0,255,0))
     surface.blit(pop_overlay, (10, 30))
+    if trajectory_path is not None:
+        rec_overlay = font.render(f"REC {trajectory_path}", True, (255,0,0))
+        surface.blit(rec_overlay, (surface.get_width() - rec_overlay.get_width() - 10, HEIGHT - 30))
+    if u.precision_notice:
+        notice_overlay = font.render(u.precision_notice, True, (255,200,0))
+        surface.blit(notice_overlay, (10, HEIGHT - 50))
     if mini_game_mode == "defense":
         mode_text = "DEFENSE MODE ACTIVE"
         mode_overlay = font.render(mode_text, True, (255,0,0))
         surface.blit(mode_overlay, (10, 50))
 
+PROFILER_PHASES = ("step", "gravity_constant", "neighbors", "forces", "integrate", "collisions",
+                   "meteors", "sync", "replay", "background", "particles", "ui", "events", "present")
+
+def draw_profiler_hud(surface):
+    stats = profiler.stats()
+    lines = ["PROFILER (ms)        avg      p99"]
+    for name in PROFILER_PHASES + ("frame",):
+        if name in stats:
+            avg, p99 = stats[name]
+            lines.append(f"{name:<18}{avg:7.2f}  {p99:7.2f}")
+    if profiler.recording:
+        lines.append(f"Recording trace: {len(profiler.trace)} spans")
+    panel_width, panel_height = 300, 20 + 15 * len(lines)
+    panel_surface = pygame.Surface((panel_width, panel_height), pygame.SRCALPHA)
+    panel_surface.fill((0, 0, 0, 200))
+    y = 10
+    for line in lines:
+        text = font.render(line, True, (0,255,255))
+        panel_surface.blit(text, (10, y))
+        y += 15
+    surface.blit(panel_surface, (surface.get_width() - panel_width - 10, 10))
+
+def draw_diagnostics_hud(surface):
+    """Latest conservation sample and a plot of the relative energy drift."""
+    diagnostics = universe.diagnostics
+    sample = diagnostics.latest
+    lines = [f"DIAGNOSTICS (every {diagnostics.every} steps, {universe.force_backend})"]
+    if sample is not None:
+        momentum = math.sqrt(sample["px"] ** 2 + sample["py"] ** 2 + sample["pz"] ** 2)
+        lines += [f"Kinetic    {sample['kinetic']: .4e}",
+                  f"Potential  {sample['potential']: .4e}",
+                  f"Energy     {sample['energy']: .4e}  drift {diagnostics.drift():+.2e}",
+                  f"|P|        {momentum: .4e}",
+                  f"Lz         {sample['lz']: .4e}",
+                  f"Virial 2K/|W| {sample['virial']:.3f}"]
+        if universe.precision != "float64":
+            lines.append(f"{universe.precision}: accel err {sample['accel_error']:.1e}, "
+                         f"pos ulp {sample['position_ulp']:.1e}")
+        if not sample["conservative"]:
+            lines.append(f"{universe.force_backend} forces are not conservative:")
+            lines.append("  drift is no guide to DT (use F: barnes_hut/direct)")
+    plot_height = 50
+    panel_width, panel_height = 330, 20 + 15 * len(lines) + plot_height
+    panel_surface = pygame.Surface((panel_width, panel_height), pygame.SRCALPHA)
+    panel_surface.fill((0, 0, 0, 200))
+    y = 10
+    for line in lines:
+        text = font.render(line, True, (255,200,0))
+        panel_surface.blit(text, (10, y))
+        y += 15
+    drifts = [diagnostics.drift(s) for s in diagnostics.samples]
+    if len(drifts) > 1:
+        scale = max(abs(d) for d in drifts) or 1.0
+        width = panel_width - 20
+        mid = y + plot_height // 2
+        points = [(10 + width * i // (len(drifts) - 1), mid - int(d / scale * (plot_height // 2 - 2)))
+                  for i, d in enumerate(drifts)]
+        pygame.draw.line(panel_surface, (80,80,80), (10, mid), (10 + width, mid))
+        conservative = sample is not None and sample["conservative"]
+        pygame.draw.lines(panel_surface, (255,200,0) if conservative else (120,120,120),
+                          False, points)
+    surface.blit(panel_surface, (10, 70))
+
+def toggle_trace_recording():
+    """Start a trace recording, or stop it and write it next to the working directory."""
+    if not profiler.recording:
+        profiler.start_recording()
+        return
+    spans = profiler.stop_recording()
+    path = time.strftime("trace-%Y%m%d-%H%M%S.json")
+    count = profiler.export_trace(path, spans)
+    print(f"Wrote {count} trace events to {path}")
+
+def toggle_trajectory_recording():
+    """Start recording the run to a new trajectory file, or finish the current one."""
+    global trajectory_path
+    if trajectory_path is None:
+        trajectory_path = time.strftime("run-%Y%m%d-%H%M%S.traj")
+        universe.start_recording(trajectory_path, RECORD_EVERY, True)
+    else:
+        universe.stop_recording()
+        print(f"Recorded trajectory to {trajectory_path}")
+        trajectory_path = None
+
+# =============================================================================
+# Replay
+# =============================================================================
+def show_replay_frame():
+    """Load the player's current frame into the universe if it changed."""
+    global replay_shown
+    index = replay.index
+    if index == replay_shown or len(replay.reader) == 0:
+        return
+    frame = replay.reader.frame(index)
+    particles = universe.particles
+    particles.assign(frame_arrays(frame))
+    rows = np.arange(len(particles))
+    # Trails only follow playback; after a seek or reversal they restart.
+    if replay_shown is None or not 0 < index - replay_shown <= max(1, replay.speed):
+        particles.trail_len[rows] = 0
+    particles.record_trails(rows)
+    universe.simulation_time = frame["simulation_time"]
+    replay_shown = index
+
+def replay_bar_rect():
+    return pygame.Rect(10, HEIGHT - 50, screen.get_width() - 20, 10)
+
+def scrub_replay(x):
+    bar = replay_bar_rect()
+    replay.seek_fraction(min(max((x - bar.left) / bar.width, 0.0), 1.0))
+
+def handle_replay_key(key):
+    """Playback keys; returns True when key was one of them."""
+    reader = replay.reader
+    if key == pygame.K_LEFT:
+        replay.seek(replay.index - 1)
+    elif key == pygame.K_RIGHT:
+        replay.seek(replay.index + 1)
+    elif key == pygame.K_PAGEUP:
+        replay.seek(replay.index - max(1, len(reader) // 10))
+    elif key == pygame.K_PAGEDOWN:
+        reader.refresh()
+        replay.seek(replay.index + max(1, len(reader) // 10))
+    elif key == pygame.K_HOME:
+        replay.seek(0)
+    elif key == pygame.K_END:
+        reader.refresh()
+        replay.seek(len(reader) - 1)
+    elif key in (pygame.K_PLUS, pygame.K_KP_PLUS, pygame.K_EQUALS):
+        if abs(replay.speed) < 256:
+            replay.speed *= 2
+    elif key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+        if abs(replay.speed) > 1 / 64:
+            replay.speed /= 2
+    elif key == pygame.K_BACKSPACE:
+        replay.speed = -replay.speed
+    else:
+        return False
+    return True
+
+def draw_replay_bar(surface):
+    bar = replay_bar_rect()
+    frames = len(replay.reader)
+    pygame.draw.rect(surface, (60,60,60), bar)
+    if frames > 1:
+        filled = bar.copy()
+        filled.width = int(bar.width * replay.index / (frames - 1))
+        pygame.draw.rect(surface, (0,200,255), filled)
+    text = f"REPLAY frame {replay.index + 1}/{frames}  speed {replay.speed:g}x"
+    if frames:
+        text += f"  step {replay.reader.frame(replay.index)['step']}"
+    label = font.render(text, True, (0,200,255))
+    surface.blit(label, (bar.left, bar.top - 18))
+
 def draw_menu(surface):
     surface.fill((0, 0, 0))
     title = font.render("Cosmic Deity Universe Sandbox", True, (255,255,0))
@@ -692,16 +611,14 @@ def update_creation_mode_keys():
 # Restart Simulation (Reset Globals and Reinitialize)
 # =============================================================================
 def reset_simulation():
-    global particles, lights, alive_population, defense_score, meteor_spawn_interval, defense_level
-    global last_meteor_spawn, last_level_up, camera_x, camera_y, zoom, mode, new_object_specs, new_object_type, god_mode, mini_game_mode, G_SIM
-    particles = []
-    lights = []
-    alive_population = 1000
-    defense_score = 0
-    meteor_spawn_interval = 3000
-    defense_level = 1
-    last_meteor_spawn = pygame.time.get_ticks()
-    last_level_up = pygame.time.get_ticks()
+    global camera_x, camera_y, zoom, mode, new_object_specs, new_object_type, god_mode, mini_game_mode
+    global replay_shown
+    if replay is not None:
+        replay.seek(0)
+        replay_shown = None
+        show_replay_frame()
+    else:
+        universe.reset(pygame.time.get_ticks())
     camera_x, camera_y = WIDTH/2, HEIGHT/2
     zoom = 1.0
     mode = "solar"
@@ -709,35 +626,40 @@ def reset_simulation():
     new_object_type = None
     god_mode = False
     mini_game_mode = None
-    G_SIM = 6e-11
-    create_real_solar_system()
-    create_galaxies()
-    for _ in range(NUM_RANDOM_PARTICLES):
-        pos = np.array([random.uniform(0, WIDTH), random.uniform(0, HEIGHT)], dtype=np.float64)
-        mass = random.uniform(50, 1000) * MASS_SCALE
-        velocity = np.array([random.uniform(-0.5, 0.5), random.uniform(-0.5, 0.5)])
-        color = (random.randint(100,255), random.randint(100,255), random.randint(100,255))
-        visual_radius = random.uniform(3,8)
-        particles.append(Particle("Asteroid", pos, mass, velocity, 0, color, visual_radius))
 
 # =============================================================================
 # Main Game Loop
 # =============================================================================
-def main():
-    global camera_x, camera_y, zoom, DT, time_speed, mode, creation_mode, new_object_type, new_object_specs
-    global selected_particle, mini_game_mode, last_meteor_spawn, alive_population, defense_score, defense_level
-    global last_level_up, god_mode, help_mode, game_state, G_SIM, meteor_spawn_interval
-
+def main(worker=False, replay_path=None, warm_up=True):
+    global camera_x, camera_y, zoom, mode, creation_mode, new_object_type, new_object_specs
+    global selected_particle, mini_game_mode, god_mode, help_mode, game_state, show_trails
+    global show_profiler, universe, replay
+
+    if replay_path is not None:
+        # Frames come from the recording; no physics runs.
+        replay = Player(TrajectoryReader(replay_path))
+        worker = False
+    elif worker:
+        from sim_worker import RemoteUniverse
+        universe = RemoteUniverse()
+        universe.start()
+    elif warm_up:
+        # Compile the kernels of the first frames while the menu is up (the
+        # worker process does this on its own).
+        warm_up_kernels((universe.force_backend, "collisions"))
+    init_display()
     reset_simulation()
-    simulation_time = 0.0
     time_of_day = 12.0
     paused = False
     running = True
+    scrubbing = False
 
     # Main loop
     while running:
         # --- Menu State ---
         if game_state == "menu":
+            if worker:
+                universe.set_paused(True)
             draw_menu(screen)
             pygame.display.flip()
             for event in pygame.event.get():
@@ -759,58 +681,56 @@ def main():
             continue
 
         # --- Running Simulation ---
-        cosmic_surface = pygame.Surface((WIDTH, HEIGHT))
-        cosmic_surface.fill((0, 0, 0))
-        for star in stars:
-            pygame.draw.circle(cosmic_surface, (255,255,255), star, 1)
-
-        if not paused and not creation_mode:
-            update_universe()
-            simulation_time += DT * time_speed
-            handle_collisions()
+        profiler.end_frame()
+        with profiler.phase("background"):
+            cosmic_surface = frame_surface(screen.get_size())
+
+        physics_running = not paused and not creation_mode
+        if replay is not None:
+            with profiler.phase("replay"):
+                if physics_running and not scrubbing:
+                    replay.tick()
+                show_replay_frame()
+        elif worker:
+            # The worker steps on its own; just pause it and pick up its latest frame.
+            with profiler.phase("sync"):
+                universe.set_paused(not physics_running)
+                universe.sync()
+        elif physics_running:
+            with profiler.phase("step"):
+                universe.step()
+        if physics_running and mode == "solar":
+            time_of_day = (time_of_day + 0.01 * universe.time_speed * universe.dt) % 24
+
+        with profiler.phase("particles"):
+            if show_trails:
+                draw_trails(cosmic_surface)
+            draw_particles(cosmic_surface)
+            for light in universe.lights:
+                lx = int((light[0] - camera_x) * zoom + WIDTH / 2)
+                ly = int((light[1] - camera_y) * zoom + HEIGHT / 2)
+                pygame.draw.circle(cosmic_surface, (255,255,100), (lx, ly), 6)
+
+        with profiler.phase("background"):
             if mode == "solar":
-                time_of_day = (time_of_day + 0.01 * time_speed * DT) % 24
-            if alive_population < 100000:
-                alive_population += 1
-
-        for p in particles:
-            p.draw(cosmic_surface)
-        for light in lights:
-            lx = int((light[0] - camera_x) * zoom + WIDTH / 2)
-            ly = int((light[1] - camera_y) * zoom + HEIGHT / 2)
-            pygame.draw.circle(cosmic_surface, (255,255,100), (lx, ly), 6)
-
-        if mode == "solar":
-            screen.fill((0, 0, 0))
-            draw_earth_environment(screen, time_of_day)
-            sky_rect = pygame.Rect(0, 0, WIDTH, int(HEIGHT * 0.75))
-            cosmic_part = cosmic_surface.subsurface(sky_rect)
-            screen.blit(cosmic_part, (0, 0))
-        else:
-            screen.blit(cosmic_surface, (0, 0))
+                draw_earth_environment(screen, time_of_day)
+                sky_rect = pygame.Rect(0, 0, WIDTH, int(HEIGHT * 0.75))
+                cosmic_part = cosmic_surface.subsurface(sky_rect)
+                screen.blit(cosmic_part, (0, 0))
+            else:
+                screen.blit(cosmic_surface, (0, 0))
 
         if mini_game_mode == "defense":
-            current_ticks = pygame.time.get_ticks()
-            if current_ticks - last_meteor_spawn > meteor_spawn_interval:
-                spawn_meteor()
-                last_meteor_spawn = current_ticks
-            if current_ticks - last_level_up > 30000:
-                defense_level += 1
-                meteor_spawn_interval = max(1000, meteor_spawn_interval - 200)
-                last_level_up = current_ticks
-            for meteor in meteors[:]:
-                if pygame.time.get_ticks() - meteor.spawn_time >= 5000:
-                    if meteor in particles:
-                        particles.remove(meteor)
-                    meteors.remove(meteor)
+            universe.update_defense(pygame.time.get_ticks())
 
+        ui_phase = profiler.begin("ui")
         if god_mode:
             draw_god_mode_ui(screen)
         if help_mode:
             draw_help_ui(screen)
         if creation_mode:
             mx, my = pygame.mouse.get_pos()
-            world_pos = np.array([(mx - WIDTH/2)/zoom + camera_x, (my - HEIGHT/2)/zoom + camera_y])
+            world_pos = screen_to_world(mx, my)
             if "velocity" in new_object_specs and np.linalg.norm(new_object_specs["velocity"]) > 0:
                 arrow_scale = 50
                 arrow_end_world = world_pos + new_object_specs["velocity"] * arrow_scale
@@ -819,18 +739,21 @@ def main():
                 draw_arrow(screen, (mx, my), arrow_end_screen, (255,255,255))
             draw_creation_ui(screen)
 
-        dynamic_vels = [np.linalg.norm(p.velocity) for p in particles if not p.fixed]
-        avg_vel = np.mean(dynamic_vels) if dynamic_vels else 0
-        info_text = f"Time: {simulation_time:.1f}s | Mode: {mode} | Particles: {len(particles)} | DT: {DT:.3e}"
-        info_text += f" | TimeSpeed: {time_speed:.2f}"
-        overlay = font.render(info_text, True, (255,255,255))
-        screen.blit(overlay, (10, HEIGHT - 30))
-        draw_overlays(screen, simulation_time)
+        draw_overlays(screen)
+        if universe.diagnostics is not None:
+            draw_diagnostics_hud(screen)
+        if replay is not None:
+            draw_replay_bar(screen)
+        if show_profiler:
+            draw_profiler_hud(screen)
+        profiler.end(ui_phase)
 
-        pygame.display.flip()
-        clock.tick(FPS)
-        update_creation_mode_keys()
+        with profiler.phase("present"):
+            pygame.display.flip()
+            clock.tick(FPS)
 
+        events_phase = profiler.begin("events")
+        update_creation_mode_keys()
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
@@ -844,6 +767,43 @@ def main():
                     game_state = "menu"
                     continue
 
+                if event.key == pygame.K_F3:
+                    show_profiler = not show_profiler
+                    profiler.enable(show_profiler or profiler.recording)
+                    profiler.reset()
+                    continue
+
+                if event.key == pygame.K_F4:
+                    toggle_trace_recording()
+                    if not show_profiler:
+                        profiler.enable(profiler.recording)
+                    continue
+
+                if event.key == pygame.K_F2 and replay is None:
+                    if universe.diagnostics is None:
+                        universe.start_diagnostics()
+                    else:
+                        universe.stop_diagnostics()
+                    continue
+
+                if event.key == pygame.K_F5:
+                    universe.save(CHECKPOINT_PATH, pygame.time.get_ticks())
+                    print(f"Saved checkpoint to {CHECKPOINT_PATH}")
+                    continue
+
+                if event.key == pygame.K_F9:
+                    if os.path.exists(CHECKPOINT_PATH):
+                        universe.load(CHECKPOINT_PATH, pygame.time.get_ticks())
+                        selected_particle = None
+                    continue
+
+                if event.key == pygame.K_F6 and replay is None:
+                    toggle_trajectory_recording()
+                    continue
+
+                if replay is not None and not creation_mode and handle_replay_key(event.key):
+                    continue
+
                 if event.key == pygame.K_F1:
                     god_mode = not god_mode
                     if god_mode:
@@ -855,61 +815,25 @@ def main():
                 if god_mode:
                     if event.key == pygame.K_1:
                         mx, my = pygame.mouse.get_pos()
-                        pos = np.array([(mx - WIDTH/2)/zoom + camera_x, (my - HEIGHT/2)/zoom + camera_y])
-                        create_solar_system(pos, (0,0))
+                        universe.create_solar_system(screen_to_world(mx, my), (0,0))
                     elif event.key == pygame.K_2:
                         mx, my = pygame.mouse.get_pos()
-
-                        # Convert screen coordinates to world coordinates
-                        world_pos = np.array([(mx - WIDTH / 2) / zoom + camera_x, (my - HEIGHT / 2) / zoom + camera_y,
-                                              0.0])  # Ensure 3D compatibility
-
-                        if particles:
-                            # Find the closest particle to the mouse click
-                            closest = min(particles, key=lambda p: np.linalg.norm(p.position - world_pos))
-
-                            # Remove from both lists to avoid lingering meteors
-                            if closest in particles:
-                                particles.remove(closest)
-                            if closest in meteors:
-                                meteors.remove(closest)
+                        # Find the closest particle to the mouse and remove it
+                        # (also from the meteor list, to avoid lingering meteors).
+                        closest = universe.nearest(screen_to_world(mx, my))
+                        if closest is not None:
+                            universe.remove(closest)
                     elif event.key == pygame.K_3:
-                        for p in particles:
-                            impulse = np.array([random.uniform(-5,5), random.uniform(-5,5),  random.uniform(-5,5)])
-                            p.velocity += impulse
+                        universe.cosmic_storm()
                     elif event.key == pygame.K_4:
-                        G_SIM *= 1.1
+                        universe.G *= 1.1
                     elif event.key == pygame.K_5:
-                        G_SIM /= 1.1
+                        universe.G /= 1.1
                     elif event.key == pygame.K_6:
-                        for p in particles:
-                            # Generate 3D positions: random x, y, and z (for z, you can choose a range appropriate for your simulation)
-                            p.position = np.array([
-                                random.uniform(0, WIDTH),
-                                random.uniform(0, HEIGHT),
-                                random.uniform(-HEIGHT / 2, HEIGHT / 2)
-                            ], dtype=np.float64)
-                            # Generate 3D velocity
-                            p.velocity = np.array([
-                                random.uniform(-1, 1),
-                                random.uniform(-1, 1),
-                                random.uniform(-1, 1)
-                            ], dtype=np.float64)
+                        universe.randomize()
                     elif event.key == pygame.K_7:
                         mx, my = pygame.mouse.get_pos()
-                        pos = np.array([(mx - WIDTH/2)/zoom + camera_x, (my - HEIGHT/2)/zoom + camera_y])
-                        for i in range(20):
-                            offset = np.array([random.uniform(-20,20), random.uniform(-20,20)])
-                            p_spec = {
-                                "name": f"Burst-{i}",
-                                "mass": random.uniform(1e22,1e23),
-                                "radius": random.uniform(5,10),
-                                "color": random.choice(preset_colors),
-                                "pos": pos + offset,
-                                "velocity": np.array([random.uniform(-3,3), random.uniform(-3,3)]),
-                                "spin": 0
-                            }
-                            create_particle_from_dict(p_spec)
+                        universe.collision_burst(screen_to_world(mx, my))
                     continue
 
                 if creation_mode:
@@ -919,14 +843,12 @@ def main():
                         new_object_specs["color"] = preset_colors[(idx+1) % len(preset_colors)]
                     elif event.key == pygame.K_RETURN:
                         mx, my = pygame.mouse.get_pos()
-                        world_x = (mx - WIDTH/2)/zoom + camera_x
-                        world_y = (my - HEIGHT/2)/zoom + camera_y
-                        pos = np.array([world_x, world_y], dtype=np.float64)
-                        ref = next((p for p in particles if p.stable and p.name.startswith("Sun")), None)
+                        pos = screen_to_world(mx, my)
+                        ref = universe.find_sun(stable_only=True)
                         if new_object_type == "planet" and ref is not None:
                             if np.linalg.norm(new_object_specs["velocity"]) < 1e-10:
-                                r = np.linalg.norm(pos - ref.position)
-                                v_mag = math.sqrt(G_SIM * ref.mass / (r + EPSILON))
+                                r = np.linalg.norm(pos - ref.position[:2])
+                                v_mag = math.sqrt(universe.G * ref.mass / (r + EPSILON))
                                 angle = math.atan2(pos[1] - ref.position[1], pos[0] - ref.position[0])
                                 velocity = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
                             else:
@@ -934,7 +856,7 @@ def main():
                         else:
                             velocity = new_object_specs.get("velocity", np.array([0,0]))
                         new_obj = {
-                            "name": f"{new_object_type.capitalize()}-{len(particles)}",
+                            "name": f"{new_object_type.capitalize()}-{len(universe.particles)}",
                             "mass": new_object_specs["mass"],
                             "radius": new_object_specs["radius"],
                             "color": new_object_specs["color"],
@@ -942,7 +864,7 @@ def main():
                             "velocity": velocity,
                             "spin": new_object_specs["spin"]
                         }
-                        create_particle_from_dict(new_obj)
+                        universe.create_particle_from_dict(new_obj)
                         creation_mode = False
                         new_object_type = None
                         new_object_specs = {}
@@ -954,11 +876,27 @@ def main():
                     if event.key == pygame.K_SPACE:
                         paused = not paused
                     elif event.key in (pygame.K_PLUS, pygame.K_KP_PLUS):
-                        DT *= 1.1
+                        universe.dt *= 1.1
                     elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
-                        DT /= 1.1
+                        universe.dt /= 1.1
                     elif event.key == pygame.K_m:
                         mode = "galaxy" if mode=="solar" else "solar"
+                    elif event.key == pygame.K_t:
+                        show_trails = not show_trails
+                    elif event.key == pygame.K_f:
+                        idx = FORCE_BACKENDS.index(universe.force_backend)
+                        universe.force_backend = FORCE_BACKENDS[(idx + 1) % len(FORCE_BACKENDS)]
+                    elif event.key == pygame.K_LEFTBRACKET:
+                        universe.bh_theta = max(0.1, universe.bh_theta - 0.1)
+                    elif event.key == pygame.K_RIGHTBRACKET:
+                        universe.bh_theta = min(1.5, universe.bh_theta + 0.1)
+                    elif event.key == pygame.K_v:
+                        universe.block_levels = 0 if universe.block_levels else BLOCK_LEVELS
+                    elif event.key == pygame.K_y:
+                        idx = INTEGRATORS.index(universe.integrator)
+                        universe.integrator = INTEGRATORS[(idx + 1) % len(INTEGRATORS)]
+                    elif event.key == pygame.K_x:
+                        universe.precision = "float32" if universe.precision == "float64" else "float64"
                     elif event.key == pygame.K_n:  # Planet
                         creation_mode = True
                         new_object_type = "planet"
@@ -985,44 +923,31 @@ def main():
                             mini_game_mode = None
                         else:
                             mini_game_mode = "defense"
-                            defense_score = 0
+                            universe.start_defense()
+
+            elif replay is not None and event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                scrubbing = replay_bar_rect().collidepoint(event.pos)
+                if scrubbing:
+                    scrub_replay(event.pos[0])
+            elif event.type == pygame.MOUSEBUTTONUP:
+                scrubbing = False
+            elif event.type == pygame.MOUSEMOTION and scrubbing:
+                scrub_replay(event.pos[0])
 
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if not creation_mode:
                     if mini_game_mode == "defense" and event.button == 1:
-                        click_pos = np.array([event.pos[0], event.pos[1], 0.0])  # Ensure 3D compatibility
-
-                        for p in particles[:]:  # Iterate over a copy of the list to avoid modification issues
-                            if p.p_type == "meteor" and np.linalg.norm(p.position - click_pos) < p.visual_radius:
-                                defense_score += 10
-
-                                # Remove the meteor from both lists safely
-                                if p in particles:
-                                    particles.remove(p)
-                                if p in meteors:
-                                    meteors.remove(p)
-                                break  # Stop after removing one to avoid iteration issues
+                        universe.shoot((event.pos[0], event.pos[1], 0.0))
 
                     else:
                         if event.button == 2:
                             mx, my = pygame.mouse.get_pos()
-                            world_x = (mx - WIDTH / 2) / zoom + camera_x
-                            world_y = (my - HEIGHT / 2) / zoom + camera_y
-                            world_z = 0  # Add a default z-coordinate (adjust if needed)
-
-                            click_pos = np.array([world_x, world_y, world_z])  # Now it's 3D
-
-                            for p in particles:
-                                if np.linalg.norm(p.position - click_pos) < p.visual_radius:
-                                    selected_particle = p
-                                    break
+                            selected_particle = universe.particle_at(screen_to_world(mx, my))
 
                         elif event.button == 1:
-                            create_random_particle([(event.pos[0]-WIDTH/2)/zoom + camera_x,
-                                                    (event.pos[1]-HEIGHT/2)/zoom + camera_y])
+                            universe.create_random_particle(screen_to_world(*event.pos))
                         elif event.button == 3:
-                            create_random_light([(event.pos[0]-WIDTH/2)/zoom + camera_x,
-                                                 (event.pos[1]-HEIGHT/2)/zoom + camera_y])
+                            universe.create_random_light(list(screen_to_world(*event.pos)))
             elif event.type == pygame.MOUSEWHEEL:
                 zoom *= 1.1 if event.y > 0 else 0.9
 
@@ -1035,8 +960,23 @@ def main():
             camera_x -= 10/zoom
         if keys[pygame.K_d]:
             camera_x += 10/zoom
-
+        profiler.end(events_phase)
+
+    if trajectory_path is not None:
+        toggle_trajectory_recording()
+    if worker:
+        universe.close()
+    if replay is not None:
+        replay.reader.close()
     pygame.quit()
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Cosmic Deity: Universe Sandbox")
+    parser.add_argument("--worker", action="store_true",
+                        help="run the physics in a separate process")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="play back a trajectory recorded with F6 instead of simulating")
+    parser.add_argument("--no-warmup", action="store_true",
+                        help="do not compile the physics kernels in the background on the menu")
+    args = parser.parse_args()
+    main(worker=args.worker, replay_path=args.replay, warm_up=not args.no_warmup)
@@ -0,0 +1,266 @@
+"""
+Benchmark suite for the Cosmic Deity physics and render hot paths.
+
+Builds seeded scenes with the real solar system, the galaxies and a random
+asteroid field at several body counts. It then times each phase of a step
+separately: force evaluation, the rest of the integration, collisions and
+an off-screen frame drawn with the front-end's renderer. Results, including
+steps per second and peak memory, can be written to JSON and compared
+against a stored baseline:
+
+    python sim_bench.py --output bench.json
+    python sim_bench.py --sizes 100 1000 --baseline bench.json
+
+The comparison exits with status 1 when any phase is slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from sim_core import (FORCE_BACKENDS, HEIGHT, INTEGRATORS, MASS_SCALE, NUM_GALAXIES,
+                      NUM_RANDOM_PARTICLES, PLANETS_PER_SYSTEM, PRECISIONS, SYSTEMS_PER_GALAXY,
+                      WIDTH, Universe)
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+SIZES = (100, 1000, 10000, 100000)
+GALAXY_BODIES = NUM_GALAXIES * SYSTEMS_PER_GALAXY * (1 + PLANETS_PER_SYSTEM)
+PHASES = ("forces", "integrate", "collisions", "render")
+
+
+# =============================================================================
+# Scenarios
+# =============================================================================
+def add_asteroid_field(universe, count, rng):
+    """
+    Random asteroids with the same mass, speed, colour and size ranges as
+    Universe.create_asteroids. The field grows with count so that its density
+    matches the default scene's 100 asteroids on one screen.
+    """
+    spread = np.sqrt(max(count, NUM_RANDOM_PARTICLES) / NUM_RANDOM_PARTICLES)
+    center = np.array([WIDTH / 2, HEIGHT / 2])
+    extent = np.array([WIDTH, HEIGHT]) * spread
+    positions = center + (rng.random((count, 2)) - 0.5) * extent
+    universe.add_bodies(positions, rng.uniform(50, 1000, count) * MASS_SCALE,
+                        velocities=rng.uniform(-0.5, 0.5, (count, 2)),
+                        colors=rng.integers(100, 256, (count, 3)),
+                        radii=rng.uniform(3, 8, count), names="Asteroid", p_type="generic")
+
+
+def build_scenario(n, seed=0, force_backend="knn", integrator="verlet", precision="float64"):
+    """
+    A seeded scene of n bodies: the real solar system, the galaxies when they
+    fit, and an asteroid field for the remainder.
+    """
+    universe = Universe(seed=seed, force_backend=force_backend, precision=precision)
+    universe.integrator = integrator
+    universe.create_real_solar_system()
+    if len(universe.particles) + GALAXY_BODIES <= n:
+        universe.create_galaxies()
+    rng = np.random.default_rng(seed)
+    add_asteroid_field(universe, max(0, n - len(universe.particles)), rng)
+    return universe
+
+
+# =============================================================================
+# Timing
+# =============================================================================
+class PhaseTimer:
+    """Accumulates wall time per phase for the current step."""
+
+    def __init__(self):
+        self.current = dict.fromkeys(PHASES, 0.0)
+        self.samples = {phase: [] for phase in PHASES}
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.current[phase] += time.perf_counter() - start
+        return timed
+
+    def time(self, phase, func, *args):
+        self.wrap(phase, func)(*args)
+
+    def commit(self):
+        for phase, seconds in self.current.items():
+            self.samples[phase].append(seconds)
+        self.current = dict.fromkeys(PHASES, 0.0)
+
+
+def summarize(samples):
+    ms = np.asarray(samples) * 1000.0
+    return {"mean_ms": float(ms.mean()), "min_ms": float(ms.min()),
+            "max_ms": float(ms.max()), "p50_ms": float(np.median(ms))}
+
+
+class Renderer:
+    """Off-screen drawing through sim.py's own draw path on the dummy SDL driver."""
+
+    def __init__(self):
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        import sim
+        self.sim = sim
+        sim.init_display()
+
+    def draw(self, universe):
+        sim = self.sim
+        sim.universe = universe
+        surface = sim.frame_surface(sim.screen.get_size())
+        sim.draw_trails(surface)
+        sim.draw_particles(surface)
+        sim.screen.blit(surface, (0, 0))
+
+
+def run_scenario(n, steps, warmup, seed, force_backend, integrator, renderer, domains=0,
+                 precision="float64"):
+    universe = build_scenario(n, seed, force_backend, integrator, precision)
+    if domains:
+        universe.start_domains(domains)
+    try:
+        return time_scenario(universe, steps, warmup, renderer)
+    finally:
+        universe.stop_domains()
+
+
+def time_scenario(universe, steps, warmup, renderer):
+    bodies = len(universe.particles)
+    timer = PhaseTimer()
+    universe.compute_accelerations = timer.wrap("forces", universe.compute_accelerations)
+
+    def one_step():
+        timer.time("integrate", universe.update)
+        timer.time("collisions", universe.handle_collisions)
+        if renderer is not None:
+            timer.time("render", renderer.draw, universe)
+
+    for _ in range(warmup):     # JIT compilation and first neighbour lists
+        one_step()
+        timer.current = dict.fromkeys(PHASES, 0.0)
+    for _ in range(steps):
+        one_step()
+        # update() includes the force evaluations; report them separately.
+        timer.current["integrate"] -= timer.current["forces"]
+        timer.commit()
+
+    tracemalloc.start()
+    one_step()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    phases = {phase: summarize(samples) for phase, samples in timer.samples.items()
+              if renderer is not None or phase != "render"}
+    physics_ms = sum(phases[p]["mean_ms"] for p in ("forces", "integrate", "collisions"))
+    return {
+        "bodies": bodies,
+        "bodies_after": len(universe.particles),
+        "phases": phases,
+        "steps_per_s": 1000.0 / physics_ms if physics_ms > 0 else float("inf"),
+        "peak_traced_bytes": int(peak),
+    }
+
+
+def run(sizes=SIZES, steps=10, warmup=2, seed=0, force_backend="knn", integrator="verlet",
+        render=True, domains=0, precision="float64", log=print):
+    renderer = Renderer() if render else None
+    results = {}
+    for n in sizes:
+        start = time.perf_counter()
+        results[str(n)] = result = run_scenario(n, steps, warmup, seed, force_backend,
+                                                integrator, renderer, domains, precision)
+        log(f"N={n:>7}: {result['steps_per_s']:9.2f} steps/s  " +
+            "  ".join(f"{p} {s['mean_ms']:.2f} ms" for p, s in result["phases"].items()) +
+            f"  ({time.perf_counter() - start:.1f} s)")
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "force_backend": force_backend,
+            "integrator": integrator,
+            "domains": domains,
+            "precision": precision,
+            "steps": steps,
+            "warmup": warmup,
+            "seed": seed,
+        },
+        "results": results,
+    }
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        scale = 1 if sys.platform == "darwin" else 1024
+        report["meta"]["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return report
+
+
+# =============================================================================
+# Baseline Comparison
+# =============================================================================
+def compare(report, baseline, tolerance=0.2, log=print):
+    """Print per-phase ratios against baseline; returns the list of regressions."""
+    regressions = []
+    for size, result in report["results"].items():
+        base = baseline.get("results", {}).get(size)
+        if base is None:
+            continue
+        for phase, stats in result["phases"].items():
+            if phase not in base["phases"]:
+                continue
+            old = base["phases"][phase]["mean_ms"]
+            ratio = stats["mean_ms"] / old if old > 0 else 1.0
+            flag = ""
+            if ratio > 1 + tolerance:
+                regressions.append((size, phase, ratio))
+                flag = "  REGRESSION"
+            log(f"N={size:>7} {phase:<11} {old:10.2f} -> {stats['mean_ms']:10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--steps", type=int, default=10, help="timed steps per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed steps first (JIT)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=FORCE_BACKENDS, default="knn")
+    parser.add_argument("--integrator", choices=INTEGRATORS, default="verlet")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float64")
+    parser.add_argument("--no-render", action="store_true", help="skip the render phase")
+    parser.add_argument("--domains", type=int, default=0,
+                        help="worker processes for barnes_hut/direct forces (see sim_domains)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a previous JSON result")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown per phase before it counts as a regression")
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.steps, args.warmup, args.seed, args.backend,
+                 args.integrator, render=not args.no_render, domains=args.domains,
+                 precision=args.precision)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Binary checkpoints of the complete universe state.
+
+A checkpoint holds every particle column of the ParticleStore (FIELDS), the
+particle names, and the scalar state: lights, G, dt, time_speed, the
+simulation clock, solver settings, defense counters, meteors and the RNG
+state. The file layout is
+
+    magic (8 bytes) | format version (uint32) | header length (uint32)
+    | JSON header | padding | column blocks, each 64-byte aligned
+
+The header lists every column with its dtype, row shape and offset from
+the first block. A loader can therefore memory-map the file and use the
+columns in place. load() maps them copy-on-write, so pages are only read
+when touched and writes never reach the file. Derived per-row state
+(trails, jerk estimates) is not stored and restarts empty.
+
+    universe.save("universe.ckpt")
+    universe.load("universe.ckpt")
+"""
+import json
+import os
+
+import numpy as np
+
+from sim_core import METEOR_LIFETIME, P_TYPES, ParticleStore, p_type_code
+
+MAGIC = b"UNIVCKPT"
+FORMAT_VERSION = 1
+ALIGN = 64
+PREFIX_BYTES = len(MAGIC) + 8
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def save_checkpoint(universe, path, now=None):
+    """
+    Write universe to path (atomically, through a temporary file). now is the
+    caller's wall clock in milliseconds; it lets load() carry the defense
+    mode timers over to a different clock.
+    """
+    store = universe.particles
+    n = store.n
+    columns = [(name, getattr(store, name)[:n]) for name, _, _ in ParticleStore.FIELDS]
+    encoded = [name.encode("utf-8") for name in store.names]
+    name_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=name_offsets[1:])
+    columns.append(("name_offsets", name_offsets))
+    columns.append(("name_bytes", np.frombuffer(b"".join(encoded), dtype=np.uint8)))
+
+    table = []
+    offset = 0
+    for name, arr in columns:
+        table.append({"name": name, "dtype": arr.dtype.str, "shape": list(arr.shape[1:]),
+                      "rows": arr.shape[0], "offset": offset, "nbytes": arr.nbytes})
+        offset = _aligned(offset + arr.nbytes)
+
+    u = universe
+    rnd = u.random.getstate()
+    header = {
+        "n": n,
+        "next_pid": store.next_pid,
+        "p_types": list(P_TYPES),
+        "columns": table,
+        "state": {
+            "G": u.G, "dt": u.dt, "time_speed": u.time_speed,
+            "simulation_time": u.simulation_time,
+            "force_backend": u.force_backend, "bh_theta": u.bh_theta,
+            "block_levels": u.block_levels, "integrator": u.integrator,
+            "precision": u.precision,
+            "lights": [list(map(float, light)) for light in u.lights],
+            "alive_population": u.alive_population, "defense_score": u.defense_score,
+            "meteor_spawn_interval": u.meteor_spawn_interval,
+            "defense_level": u.defense_level,
+            "last_meteor_spawn": u.last_meteor_spawn, "last_level_up": u.last_level_up,
+            "meteors": [int(m._pid) for m in u.meteors if m in store],
+            "clock": now,
+            "random": [rnd[0], list(rnd[1]), rnd[2]],
+        },
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _aligned(PREFIX_BYTES + len(header_bytes))
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([FORMAT_VERSION, len(header_bytes)], dtype="<u4").tobytes())
+        f.write(header_bytes)
+        for entry, (_, arr) in zip(table, columns):
+            f.seek(data_start + entry["offset"])
+            f.write(np.ascontiguousarray(arr).data)
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def read_checkpoint(path, mmap=True):
+    """Return (header, columns) with the columns mapped copy-on-write (or read, mmap=False)."""
+    with open(path, "rb") as f:
+        prefix = f.read(PREFIX_BYTES)
+        if len(prefix) < PREFIX_BYTES or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a universe checkpoint")
+        version, header_len = np.frombuffer(prefix[len(MAGIC):], dtype="<u4")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{path} uses checkpoint format {version}; "
+                             f"this version reads up to {FORMAT_VERSION}")
+        header = json.loads(f.read(int(header_len)).decode("utf-8"))
+        data_start = _aligned(PREFIX_BYTES + int(header_len))
+        if mmap:
+            raw = np.memmap(f, dtype=np.uint8, mode="c")
+        else:
+            f.seek(0)
+            raw = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+    columns = {}
+    for entry in header["columns"]:
+        start = data_start + entry["offset"]
+        block = raw[start:start + entry["nbytes"]]
+        columns[entry["name"]] = block.view(np.dtype(entry["dtype"])).reshape(
+            [entry["rows"]] + entry["shape"])
+    return header, columns
+
+
+def load_checkpoint(universe, path, now=None, mmap=True):
+    """
+    Replace the state of universe with the checkpoint at path. If both the
+    checkpoint and the caller supply a clock, defense timers and meteor
+    spawn times are shifted to the caller's clock.
+    """
+    header, columns = read_checkpoint(path, mmap)
+    offsets = columns["name_offsets"].tolist()
+    blob = columns["name_bytes"].tobytes()
+    names = [blob[a:b].decode("utf-8") for a, b in zip(offsets, offsets[1:])]
+
+    # Type codes are assigned on first use, so map the saved ones onto ours.
+    codes = np.array([p_type_code(name) for name in header["p_types"]], dtype=np.int16)
+    if not np.array_equal(codes, np.arange(codes.shape[0])):
+        columns["p_type"] = codes[columns["p_type"]]
+    state = header["state"]
+    store = ParticleStore.from_arrays({name: columns[name] for name, _, _ in ParticleStore.FIELDS},
+                                      names, header["next_pid"],
+                                      precision=state.get("precision", "float64"))
+    shift = 0.0
+    if now is not None and state["clock"] is not None:
+        shift = now - state["clock"]
+        store.spawn_time[:store.n] += shift
+
+    u = universe
+    u.particles = store
+    meteors = np.array(state["meteors"], dtype=np.int64)
+    u.meteors.clear()
+    u.meteors.add(store, meteors, store.spawn_time[store.row_of[meteors]] + METEOR_LIFETIME)
+    u.lights = [list(light) for light in state["lights"]]
+    for key in ("G", "dt", "time_speed", "simulation_time", "force_backend", "bh_theta",
+                "block_levels", "integrator", "alive_population", "defense_score",
+                "meteor_spawn_interval", "defense_level"):
+        setattr(u, key, state[key])
+    u.last_meteor_spawn = state["last_meteor_spawn"] + shift
+    u.last_level_up = state["last_level_up"] + shift
+    version, internal, gauss = state["random"]
+    u.random.setstate((version, tuple(internal), gauss))
+    u.neighbors.invalidate()
+    u.acc_cache.invalidate()
@@ -0,0 +1,2301 @@
+"""
+Headless simulation core for the Cosmic Deity universe sandbox.
+
+Holds the particle store, the JIT-compiled gravity kernels and the Universe
+engine that owns all simulation state. Nothing here imports pygame, so the
+physics can run on a display-less server or inside a test process; sim.py is
+the pygame front-end built on top of it.
+
+    universe = Universe(seed=1)
+    universe.reset()
+    universe.step(100)
+    state = universe.snapshot()
+"""
+import heapq
+import math
+import random
+import threading
+
+import numpy as np
+from numba import get_num_threads, jit, prange, types
+
+from sim_profiler import profiler
+
+# =============================================================================
+# Constants and Simulation Parameters
+# =============================================================================
+PI = math.pi
+WIDTH, HEIGHT = 1900, 1000  # Extent of the default scene (world units are pixels)
+DT = 86400
+c = 2.99792458e8            # Speed of light (m/s)
+h = 6.62607015e-34          # Planck's constant (J·s)
+Lambda = 1.0e-52            # Cosmological constant (m^-2)
+alpha = 1/137.0
+G_SIM = 6e-11
+EPSILON = 1e-2
+
+# Gravity solver: "knn" (5 nearest neighbours), "barnes_hut" (octree, all bodies)
+# or "direct" (exact pairwise sum, the reference for small to medium N)
+FORCE_BACKENDS = ("knn", "barnes_hut", "direct")
+DIRECT_TILE = 256           # Bodies per cache tile in the direct-sum kernel
+BH_THETA = 0.5              # Barnes-Hut opening angle (smaller = more accurate)
+BH_MAX_DEPTH = 48           # Deeper cells keep all their bodies in one leaf
+BH_LEAF_SIZE = 8            # Bodies per octree leaf before it is split
+KNN_NEIGHBORS = 5           # Nearest neighbours (including the body itself) for "knn"
+NEIGHBOR_SKIN = 10.0        # Extra search radius that lets neighbour lists be reused
+NEIGHBOR_WORKERS = -1       # KDTree query threads (-1 = all cores)
+NEIGHBOR_CANDIDATES = 8     # Neighbours fetched per particle when building the lists
+BLOCK_LEVELS = 8            # Finest block timestep is DT / 2**BLOCK_LEVELS when enabled
+BLOCK_ETA = 0.02            # Block step accuracy: h = BLOCK_ETA * |a| / |jerk|
+DIAGNOSTICS_EVERY = 10      # Steps between conservation diagnostics samples
+
+NUM_RANDOM_PARTICLES = 100
+MASS_CAP = 1e31             # Merges above this mass become absorptions
+
+# AU scaling for galaxy systems (used with an extra scaling factor for visibility)
+AU_TO_PIXELS = 300 / 4500e6
+MASS_SCALE = 1e-27
+
+preset_colors = [(255,255,255), (255,255,0), (0,0,255), (255,0,0), (80,0,80)]
+
+# Galaxy / Solar System parameters
+NUM_GALAXIES = 2
+SYSTEMS_PER_GALAXY = 9
+PLANETS_PER_SYSTEM = 9
+
+# Defense mode timings (milliseconds of wall-clock time)
+METEOR_SPAWN_INTERVAL = 3000
+METEOR_LIFETIME = 5000
+DEFENSE_LEVEL_INTERVAL = 30000
+METEOR_POOL_SIZE = 64       # Meteor rows reserved in the store; also the live meteor cap
+
+# =============================================================================
+# Predefined Real Solar System (Central System)
+# Distances are in pixels (tuned for good visibility).
+# =============================================================================
+REAL_SOLAR_SYSTEM = [
+    {"name": "Sun", "mass": 1.989e30, "radius": 50, "color": (255,255,0), "pos": (WIDTH/2, HEIGHT/2)},
+    {"name": "Mercury", "mass": 3.285e23, "radius": 5, "distance": 60, "color": (200,200,200)},
+    {"name": "Venus",   "mass": 4.867e24, "radius": 10, "distance": 90, "color": (255,165,0)},
+    {"name": "Earth",   "mass": 5.972e24, "radius": 12, "distance": 130, "color": (0,0,255)},
+    {"name": "Mars",    "mass": 6.39e23,  "radius": 8,  "distance": 170, "color": (255,0,0)},
+    {"name": "Jupiter", "mass": 1.898e27, "radius": 30, "distance": 240, "color": (255,255,255)},
+    {"name": "Saturn",  "mass": 5.683e26, "radius": 28, "distance": 300, "color": (255,255,200)},
+    {"name": "Uranus",  "mass": 8.681e25, "radius": 20, "distance": 350, "color": (0,255,255)},
+    {"name": "Neptune", "mass": 1.024e26, "radius": 18, "distance": 400, "color": (0,0,255)}
+]
+
+# =============================================================================
+# Particle Store (structure of arrays)
+# =============================================================================
+TRAIL_LENGTH = 20          # Positions kept per particle trail (0 disables trails)
+PRECISIONS = ("float64", "float32")     # Storage precision of positions, velocities and masses
+# Largest state magnitude kept in float32: squares of differences stay finite.
+FLOAT32_RANGE = float(np.sqrt(np.finfo(np.float32).max)) / 4
+
+# Particle types are stored as small integer codes; unknown names get a new code.
+P_TYPES = ["generic", "user", "system", "meteor"]
+P_TYPE_CODES = {name: code for code, name in enumerate(P_TYPES)}
+
+
+def p_type_code(name):
+    code = P_TYPE_CODES.get(name)
+    if code is None:
+        code = len(P_TYPES)
+        P_TYPES.append(name)
+        P_TYPE_CODES[name] = code
+    return code
+
+
+def as_vec3(value):
+    """Return value as a float64 3-vector, padding missing components with 0."""
+    vec = np.asarray(value, dtype=np.float64).ravel()
+    if vec.shape[0] < 3:
+        vec = np.concatenate((vec, np.zeros(3 - vec.shape[0])))
+    return vec
+
+
+class ParticleStore:
+    """
+    Contiguous storage for every body in the universe.
+
+    Each field is an array with one row per particle; rows [0, n) are live and
+    the arrays grow geometrically when capacity runs out. Every row carries a
+    stable particle id (pid) so Particle views survive compaction. Physics,
+    collisions and drawing work on the live slices directly, e.g.
+    store.pos[:store.n]. The store also behaves like the old list of particles
+    (len, iteration, indexing, append, remove, in) for the UI code.
+
+    Trails are a ring buffer of the last trail_length positions per row
+    (trail[row, slot]); trail_head is the next slot to write and trail_len the
+    number of valid points. They are display-only and kept in float32.
+    jerk is the last measured da/dt per row, used to pick block timesteps; it
+    is NaN until a body has completed a step.
+
+    The STATE_FIELDS are stored at the store's precision (PRECISIONS). In
+    float32 they take half the memory and bandwidth; the force kernels then
+    run on float32 inputs but still accumulate in float64.
+    """
+
+    FIELDS = (
+        ("pos", (3,), np.float64),
+        ("vel", (3,), np.float64),
+        ("mass", (), np.float64),
+        ("charge", (), np.float64),
+        ("radius", (), np.float64),
+        ("color", (3,), np.uint8),
+        ("spin", (), np.float64),
+        ("fixed", (), np.bool_),
+        ("stable", (), np.bool_),
+        ("p_type", (), np.int16),
+        ("spawn_time", (), np.float64),
+        ("pid", (), np.int64),
+    )
+    STATE_FIELDS = ("pos", "vel", "mass")
+
+    def __init__(self, capacity=64, trail_length=TRAIL_LENGTH, precision="float64"):
+        self.n = 0
+        self.capacity = 0
+        self.trail_length = trail_length
+        self.precision = precision
+        self.fields = self.field_types(trail_length, precision)
+        for name, shape, dtype in self.fields:
+            setattr(self, name, np.empty((0,) + shape, dtype=dtype))
+        self.names = []
+        self.row_of = np.full(0, -1, dtype=np.int64)   # pid -> row (-1 once removed)
+        self.next_pid = 0
+        self.version = 0    # Bumped on row adds/removals and Particle position/mass writes
+        self.stable_version = 0     # Bumped when stable rows are added, removed or re-flagged
+        self.reserve(capacity)
+
+    @classmethod
+    def field_types(cls, trail_length, precision):
+        """(name, row shape, dtype) of every column of a store with this precision."""
+        real = np.dtype(precision)
+        return tuple((name, shape, real if name in cls.STATE_FIELDS else dtype)
+                     for name, shape, dtype in cls.FIELDS) + (
+            ("trail", (trail_length, 3), np.float32),
+            ("trail_head", (), np.int32),
+            ("trail_len", (), np.int32),
+            ("jerk", (3,), np.float64),
+        )
+
+    def set_precision(self, precision):
+        """Convert the STATE_FIELDS to precision ("float64" or "float32")."""
+        if precision == self.precision:
+            return
+        self.fields = self.field_types(self.trail_length, precision)
+        for name in self.STATE_FIELDS:
+            setattr(self, name, getattr(self, name).astype(precision))
+        self.precision = precision
+
+    # -------------------------------------------------------------------------
+    # Capacity management
+    # -------------------------------------------------------------------------
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity)
+        for name, shape, dtype in self.fields:
+            old = getattr(self, name)
+            arr = np.zeros((new_capacity,) + shape, dtype=dtype)
+            arr[:self.n] = old[:self.n]
+            setattr(self, name, arr)
+        self.capacity = new_capacity
+
+    def _new_pids(self, count):
+        pids = np.arange(self.next_pid, self.next_pid + count, dtype=np.int64)
+        self.next_pid += count
+        if self.next_pid > self.row_of.shape[0]:
+            grown = np.full(max(self.next_pid, 2 * self.row_of.shape[0]), -1, dtype=np.int64)
+            grown[:self.row_of.shape[0]] = self.row_of
+            self.row_of = grown
+        return pids
+
+    # -------------------------------------------------------------------------
+    # Adding and removing rows
+    # -------------------------------------------------------------------------
+    def add(self, name, position, mass, velocity, charge, color, visual_radius,
+            fixed=False, spin=0, stable=False, p_type="generic", spawn_time=None):
+        """Append one particle and return a Particle view of its row."""
+        self.reserve(self.n + 1)
+        row = self.n
+        pid = self._new_pids(1)[0]
+        self.pos[row] = as_vec3(position)
+        self.vel[row] = as_vec3(velocity)
+        self.mass[row] = mass
+        self.charge[row] = charge
+        self.radius[row] = visual_radius
+        self.color[row] = np.clip(color, 0, 255)
+        self.spin[row] = spin
+        self.fixed[row] = fixed
+        self.stable[row] = stable
+        self.p_type[row] = p_type_code(p_type)
+        self.spawn_time[row] = np.nan if spawn_time is None else spawn_time
+        self.trail_head[row] = 0
+        self.trail_len[row] = 0
+        self.jerk[row] = np.nan
+        self.pid[row] = pid
+        self.row_of[pid] = row
+        self.names.append(name)
+        self.n += 1
+        self.version += 1
+        self.stable_version += bool(stable)
+        return Particle.view(self, pid)
+
+    def append(self, particle):
+        """Move a particle (usually a freshly constructed one) into this store."""
+        src, src_row = particle._store, particle.row
+        self.reserve(self.n + 1)
+        row = self.n
+        pid = self._new_pids(1)[0]
+        for name, _, _ in self.FIELDS:
+            getattr(self, name)[row] = getattr(src, name)[src_row]
+        # Trail buffers may differ in length between stores, so start afresh.
+        self.trail_head[row] = 0
+        self.trail_len[row] = 0
+        self.jerk[row] = np.nan
+        self.pid[row] = pid
+        self.row_of[pid] = row
+        self.names.append(src.names[src_row])
+        self.n += 1
+        self.version += 1
+        self.stable_version += bool(self.stable[row])
+        particle._store = self
+        particle._pid = pid
+
+    def extend(self, particles):
+        for particle in particles:
+            self.append(particle)
+
+    def keep(self, mask):
+        """Compact the store down to the rows where mask is True (order is preserved)."""
+        n = self.n
+        rows = np.flatnonzero(mask[:n])
+        k = rows.shape[0]
+        if k == n:
+            return
+        self.stable_version += bool(self.stable[:n].sum() - self.stable[rows].sum())
+        self.row_of[self.pid[:n]] = -1
+        for name, _, _ in self.fields:
+            arr = getattr(self, name)
+            arr[:k] = arr[rows]
+        self.names = [self.names[i] for i in rows.tolist()]
+        self.n = k
+        self.row_of[self.pid[:k]] = np.arange(k)
+        self.version += 1
+
+    def remove(self, particle):
+        if particle not in self:
+            raise ValueError("particle is not in this store")
+        self.remove_pid(particle._pid)
+
+    def remove_pid(self, pid):
+        """
+        Remove the particle with this pid in O(1): the last row moves into
+        its place, so unlike keep() this does not preserve row order.
+        """
+        row = self.row_of[pid]
+        if row < 0:
+            raise ValueError(f"no live particle with pid {pid}")
+        last = self.n - 1
+        self.stable_version += bool(self.stable[row])
+        if row != last:
+            for name, _, _ in self.fields:
+                arr = getattr(self, name)
+                arr[row] = arr[last]
+            self.names[row] = self.names[last]
+            self.row_of[self.pid[row]] = row
+        self.names.pop()
+        self.row_of[pid] = -1
+        self.n = last
+        self.version += 1
+
+    def clear(self):
+        self.keep(np.zeros(self.n, dtype=bool))
+
+    @classmethod
+    def from_arrays(cls, arrays, names=None, next_pid=0, trail_length=TRAIL_LENGTH,
+                    precision="float64"):
+        """
+        A store whose FIELDS columns are the given arrays, used in place
+        without a copy (e.g. memory-mapped checkpoint columns). They must be
+        writable; the first growth moves the store into ordinary arrays.
+        Columns of another dtype than the precision asks for are converted.
+        """
+        store = cls(capacity=0, trail_length=trail_length, precision=precision)
+        n = arrays["pid"].shape[0]
+        for name, shape, dtype in store.fields[:len(cls.FIELDS)]:
+            arr = arrays[name]
+            if arr.dtype != dtype:
+                arr = arr.astype(dtype)
+            setattr(store, name, arr.reshape((n,) + shape))
+        for name, shape, dtype in store.fields[len(cls.FIELDS):]:
+            setattr(store, name, np.zeros((n,) + shape, dtype=dtype))
+        store.jerk[:] = np.nan
+        store.n = store.capacity = n
+        store.names = list(names) if names is not None else [""] * n
+        store.next_pid = max(next_pid, int(store.pid.max()) + 1 if n else 0)
+        store.row_of = np.full(store.next_pid, -1, dtype=np.int64)
+        store.row_of[store.pid] = np.arange(n)
+        return store
+
+    def assign(self, arrays, names=None):
+        """
+        Replace the live rows with copies of the given FIELDS arrays (for
+        example a state published by another store), keeping their pids.
+        Rows whose pid was already live keep their trail.
+        """
+        pid = np.asarray(arrays["pid"], dtype=np.int64)
+        n = pid.shape[0]
+        known = pid < self.row_of.shape[0]
+        src = np.full(n, -1, dtype=np.int64)
+        src[known] = self.row_of[pid[known]]
+        carried = np.flatnonzero(src >= 0)
+        trail = self.trail[src[carried]]
+        trail_head = self.trail_head[src[carried]]
+        trail_len = self.trail_len[src[carried]]
+
+        self.reserve(n)
+        self.row_of[self.pid[:self.n]] = -1
+        for name, _, _ in self.FIELDS:
+            getattr(self, name)[:n] = arrays[name]
+        self.trail_len[:n] = 0
+        self.trail_head[:n] = 0
+        self.jerk[:n] = np.nan
+        self.trail[carried] = trail
+        self.trail_head[carried] = trail_head
+        self.trail_len[carried] = trail_len
+        self.names = list(names) if names is not None else [""] * n
+        self.n = n
+        if n:
+            self.next_pid = max(self.next_pid, int(pid.max()) + 1)
+            if self.next_pid > self.row_of.shape[0]:
+                self._new_pids(0)
+            self.row_of[pid] = np.arange(n)
+        self.version += 1
+        self.stable_version += 1
+
+    # -------------------------------------------------------------------------
+    # Trails
+    # -------------------------------------------------------------------------
+    def record_trails(self, rows):
+        """Push the current position of each given row onto its trail."""
+        if self.trail_length == 0 or rows.shape[0] == 0:
+            return
+        head = self.trail_head[rows]
+        # Trails are float32; bodies flung beyond its range are pinned to its edge.
+        limit = np.finfo(np.float32).max
+        self.trail[rows, head] = np.clip(self.pos[rows], -limit, limit)
+        self.trail_head[rows] = (head + 1) % self.trail_length
+        self.trail_len[rows] = np.minimum(self.trail_len[rows] + 1, self.trail_length)
+
+    def trail_points(self, rows):
+        """
+        Trails of the given rows in chronological order as an (len(rows), L, 3)
+        array, with the mask of valid points (the oldest points are missing
+        until a trail has filled up).
+        """
+        L = self.trail_length
+        age = np.arange(L)
+        slots = (self.trail_head[rows, None] + age) % L
+        points = self.trail[rows[:, None], slots]
+        valid = age >= (L - self.trail_len[rows, None])
+        return points, valid
+
+    def add_many(self, positions, masses, velocities=0.0, charges=0.0, colors=(255, 255, 255),
+                 radii=1.0, names="Body", fixed=False, spins=0.0, stable=False,
+                 p_type="generic"):
+        """
+        Append a batch of particles from arrays (scalars broadcast to every row)
+        and return their pids. Positions and velocities may be 2D or 3D.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        count = positions.shape[0]
+        if count == 0:
+            return np.empty(0, dtype=np.int64)
+        self.reserve(self.n + count)
+        rows = slice(self.n, self.n + count)
+        dims = positions.shape[1]
+        self.pos[rows] = 0.0
+        self.pos[rows, :dims] = positions
+        velocities = np.asarray(velocities, dtype=np.float64)
+        self.vel[rows] = 0.0
+        if velocities.ndim == 2:
+            self.vel[rows, :velocities.shape[1]] = velocities
+        else:
+            self.vel[rows] = velocities
+        self.mass[rows] = masses
+        self.charge[rows] = charges
+        self.radius[rows] = radii
+        self.color[rows] = np.clip(colors, 0, 255)
+        self.spin[rows] = spins
+        self.fixed[rows] = fixed
+        self.stable[rows] = stable
+        self.p_type[rows] = p_type_code(p_type)
+        self.spawn_time[rows] = np.nan
+        self.trail_head[rows] = 0
+        self.trail_len[rows] = 0
+        self.jerk[rows] = np.nan
+        pids = self._new_pids(count)
+        self.pid[rows] = pids
+        self.row_of[pids] = np.arange(self.n, self.n + count)
+        self.names.extend([names] * count if isinstance(names, str) else list(names))
+        self.n += count
+        self.version += 1
+        self.stable_version += bool(self.stable[rows].any())
+        return pids
+
+    # -------------------------------------------------------------------------
+    # Sequence protocol (Particle views)
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for pid in self.pid[:self.n].tolist():
+            yield Particle.view(self, pid)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Particle.view(self, pid) for pid in self.pid[:self.n][index].tolist()]
+        if index < 0:
+            index += self.n
+        if not 0 <= index < self.n:
+            raise IndexError("particle index out of range")
+        return Particle.view(self, int(self.pid[index]))
+
+    def __contains__(self, particle):
+        return (isinstance(particle, Particle) and particle._store is self
+                and self.row_of[particle._pid] >= 0)
+
+
+# =============================================================================
+# Particle Class (PRU Relational Particle)
+# =============================================================================
+class Particle:
+    """
+    Lightweight view of one row in a ParticleStore.
+
+    Constructing a Particle directly creates a detached single-row store;
+    ParticleStore.append moves it into the main store. Array attributes
+    (position, velocity) are views, so in-place updates such as
+    p.velocity += impulse write straight into the store.
+    """
+
+    __slots__ = ("_store", "_pid")
+
+    def __init__(self, name, position, mass, velocity, charge, color, visual_radius,
+                 fixed=False, spin=0, stable=False, p_type="generic", spawn_time=None):
+        store = ParticleStore(capacity=1)
+        store.add(name, position, mass, velocity, charge, color, visual_radius,
+                  fixed, spin, stable, p_type, spawn_time)
+        self._store = store
+        self._pid = 0
+
+    @classmethod
+    def view(cls, store, pid):
+        particle = cls.__new__(cls)
+        particle._store = store
+        particle._pid = pid
+        return particle
+
+    @property
+    def row(self):
+        row = self._store.row_of[self._pid]
+        if row < 0:
+            raise ValueError("particle has been removed from its store")
+        return row
+
+    def __eq__(self, other):
+        return (isinstance(other, Particle) and self._store is other._store
+                and self._pid == other._pid)
+
+    def __hash__(self):
+        return hash((id(self._store), self._pid))
+
+    @property
+    def name(self):
+        return self._store.names[self.row]
+
+    @name.setter
+    def name(self, value):
+        self._store.names[self.row] = value
+
+    @property
+    def position(self):
+        return self._store.pos[self.row]
+
+    @position.setter
+    def position(self, value):
+        self._store.pos[self.row] = as_vec3(value)
+        self._store.version += 1
+
+    @property
+    def velocity(self):
+        return self._store.vel[self.row]
+
+    @velocity.setter
+    def velocity(self, value):
+        self._store.vel[self.row] = as_vec3(value)
+
+    @property
+    def mass(self):
+        return float(self._store.mass[self.row])
+
+    @mass.setter
+    def mass(self, value):
+        self._store.mass[self.row] = value
+        self._store.version += 1
+
+    @property
+    def charge(self):
+        return float(self._store.charge[self.row])
+
+    @charge.setter
+    def charge(self, value):
+        self._store.charge[self.row] = value
+
+    @property
+    def color(self):
+        return tuple(self._store.color[self.row].tolist())
+
+    @color.setter
+    def color(self, value):
+        self._store.color[self.row] = np.clip(value, 0, 255)
+
+    @property
+    def visual_radius(self):
+        return float(self._store.radius[self.row])
+
+    @visual_radius.setter
+    def visual_radius(self, value):
+        self._store.radius[self.row] = value
+
+    size = visual_radius
+
+    @property
+    def spin(self):
+        return float(self._store.spin[self.row])
+
+    @spin.setter
+    def spin(self, value):
+        self._store.spin[self.row] = value
+
+    @property
+    def fixed(self):
+        return bool(self._store.fixed[self.row])
+
+    @fixed.setter
+    def fixed(self, value):
+        self._store.fixed[self.row] = value
+
+    @property
+    def stable(self):
+        return bool(self._store.stable[self.row])
+
+    @stable.setter
+    def stable(self, value):
+        self._store.stable[self.row] = value
+        self._store.stable_version += 1
+
+    @property
+    def p_type(self):
+        return P_TYPES[self._store.p_type[self.row]]
+
+    @p_type.setter
+    def p_type(self, value):
+        self._store.p_type[self.row] = p_type_code(value)
+        self._store.stable_version += 1
+
+    @property
+    def spawn_time(self):
+        value = self._store.spawn_time[self.row]
+        return None if np.isnan(value) else float(value)
+
+    @spawn_time.setter
+    def spawn_time(self, value):
+        self._store.spawn_time[self.row] = np.nan if value is None else value
+
+    @property
+    def trail(self):
+        points, valid = self._store.trail_points(np.array([self.row]))
+        return [tuple(p) for p in points[0][valid[0]].tolist()]
+
+
+# =============================================================================
+# Force Kernels (JIT-compiled)
+# =============================================================================
+@jit(nopython=True, parallel=True, cache=True)
+def compute_knn_accelerations(pos, mass, fixed, offsets, indices, k, G_val, eps):
+    """
+    Accelerations for all particles from their k nearest neighbours (counting
+    the particle itself, which is skipped), chosen among the CSR candidate
+    lists indices[offsets[i]:offsets[i + 1]]. Fixed particles get zero
+    acceleration.
+    """
+    n = pos.shape[0]
+    acc = np.zeros((n, 3))
+    m = k - 1
+    for i in prange(n):
+        if fixed[i] or m <= 0:
+            continue
+        # Keep the m closest candidates sorted by squared distance.
+        best_d2 = np.full(m, np.inf)
+        best_j = np.full(m, -1, dtype=np.int64)
+        for p in range(offsets[i], offsets[i + 1]):
+            j = indices[p]
+            if j == i:
+                continue
+            d0 = pos[j, 0] - pos[i, 0]
+            d1 = pos[j, 1] - pos[i, 1]
+            d2 = pos[j, 2] - pos[i, 2]
+            r2 = d0 * d0 + d1 * d1 + d2 * d2
+            if r2 >= best_d2[m - 1]:
+                continue
+            q = m - 1
+            while q > 0 and best_d2[q - 1] > r2:
+                best_d2[q] = best_d2[q - 1]
+                best_j[q] = best_j[q - 1]
+                q -= 1
+            best_d2[q] = r2
+            best_j[q] = j
+        total0 = 0.0
+        total1 = 0.0
+        total2 = 0.0
+        for q in range(m):
+            j = best_j[q]
+            if j == -1:
+                break
+            diff0 = pos[j, 0] - pos[i, 0]
+            diff1 = pos[j, 1] - pos[i, 1]
+            diff2 = pos[j, 2] - pos[i, 2]
+            dist = math.sqrt(diff0 * diff0 + diff1 * diff1 + diff2 * diff2) + eps
+            scale = G_val * mass[j] / (dist ** 3)
+            total0 += scale * diff0
+            total1 += scale * diff1
+            total2 += scale * diff2
+        # The neighbour path has always divided by the body's own mass.
+        acc[i, 0] = total0 / mass[i]
+        acc[i, 1] = total1 / mass[i]
+        acc[i, 2] = total2 / mass[i]
+    return acc
+
+
+@jit(nopython=True, cache=True)
+def max_displacement_sq(pos, ref_pos):
+    worst = 0.0
+    for i in range(pos.shape[0]):
+        d0 = pos[i, 0] - ref_pos[i, 0]
+        d1 = pos[i, 1] - ref_pos[i, 1]
+        d2 = pos[i, 2] - ref_pos[i, 2]
+        r2 = d0 * d0 + d1 * d1 + d2 * d2
+        if r2 > worst:
+            worst = r2
+    return worst
+
+
+class NeighborList:
+    """
+    Verlet neighbour lists for the "knn" force backend.
+
+    For every particle the candidates are all particles within its k-th
+    nearest neighbour distance plus a skin, found with one multi-worker KDTree
+    query for a fixed number of candidates (a ball query only for the rare
+    particles where that is not enough) and stored as CSR arrays
+    (offsets, indices). The k nearest are
+    re-selected from the candidates at every force evaluation, which stays
+    exact until some particle has moved more than skin / 4 since the build, or
+    particles are added or removed. Only then are the lists rebuilt.
+    """
+
+    def __init__(self, k=KNN_NEIGHBORS, skin=NEIGHBOR_SKIN, workers=NEIGHBOR_WORKERS,
+                 candidates=NEIGHBOR_CANDIDATES):
+        self.k = k
+        self.skin = skin
+        self.workers = workers
+        self.candidates = candidates
+        self.offsets = None
+        self.indices = None
+        self.ref_pos = None
+        self.tree = None        # KD-tree over ref_pos, shared with SpatialIndex
+        self.store = None
+        self.version = -1
+        self.builds = 0
+
+    def invalidate(self):
+        self.store = None
+
+    def needs_rebuild(self, store, pos):
+        if self.store is not store or self.version != store.version or self.ref_pos.shape != pos.shape:
+            return True
+        return max_displacement_sq(pos, self.ref_pos) > (0.25 * self.skin) ** 2
+
+    def build(self, pos):
+        n = pos.shape[0]
+        k = min(self.k, n)
+        n_cand = min(max(self.candidates, k), n)
+        from scipy.spatial import KDTree     # Only the knn backend needs scipy
+        tree = KDTree(pos)
+        dist, idx = tree.query(pos, k=n_cand, workers=self.workers)
+        dist = dist.reshape(n, n_cand)
+        idx = idx.reshape(n, n_cand)
+        radius = dist[:, k - 1] + self.skin
+        inside = dist <= radius[:, None]
+        counts = inside.sum(axis=1)
+        # Rows whose every candidate is inside the radius may be missing some;
+        # only those fall back to a (slower) ball query.
+        truncated = np.flatnonzero(inside[:, -1]) if n_cand < n else np.empty(0, dtype=np.int64)
+        extra = tree.query_ball_point(pos[truncated], radius[truncated], workers=self.workers)
+        inside[truncated] = False
+        regular = counts.copy()
+        regular[truncated] = 0
+        counts[truncated] = np.fromiter(map(len, extra), dtype=np.int64, count=truncated.shape[0])
+
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        indices = np.empty(offsets[-1], dtype=np.int64)
+        rows = np.repeat(np.arange(n), regular)
+        rank = np.arange(rows.shape[0]) - np.repeat(np.cumsum(regular) - regular, regular)
+        indices[offsets[rows] + rank] = idx[inside]
+        for row, members in zip(truncated.tolist(), extra):
+            indices[offsets[row]:offsets[row + 1]] = members
+        self.offsets = offsets
+        self.indices = indices
+        self.ref_pos = pos.copy()
+        self.tree = tree
+        self.builds += 1
+
+    def update(self, store, pos):
+        """Return (offsets, indices) for pos, rebuilding only when required."""
+        if self.needs_rebuild(store, pos):
+            self.build(pos)
+            self.store = store
+            self.version = store.version
+        return self.offsets, self.indices
+
+
+class SpatialIndex:
+    """
+    Point queries for input handling and game logic: the nearest body,
+    bodies within a radius and bodies inside an x/y rectangle. Results are
+    rows in ascending order.
+
+    When the knn backend's KD-tree is current for the store, queries run
+    on it. The tree was built at the neighbour list's reference positions
+    and no body has moved more than the drift since then (measured in one
+    JIT pass), so each query widens its search by the drift and filters the
+    candidates on the current positions. Without a current tree (other
+    backends, the front-end's mirror) queries are vectorised scans.
+    """
+
+    def __init__(self, universe):
+        self.universe = universe
+        self.z_tree = None      # Tree that z_extent was measured for
+        self.z_extent = 0.0
+
+    def _tree(self, pos):
+        """(tree, drift) for pos, or (None, 0.0) when no current tree exists."""
+        neighbors = getattr(self.universe, "neighbors", None)
+        if (neighbors is None or neighbors.tree is None
+                or neighbors.store is not self.universe.particles
+                or neighbors.version != self.universe.particles.version
+                or neighbors.ref_pos.shape != pos.shape):
+            return None, 0.0
+        if self.z_tree is not neighbors.tree:
+            self.z_tree = neighbors.tree
+            self.z_extent = float(np.abs(neighbors.ref_pos[:, 2]).max())
+        return neighbors.tree, math.sqrt(max_displacement_sq(pos, neighbors.ref_pos))
+
+    def nearest(self, point):
+        """Row of the body closest to point (the lowest on ties), or -1 if there are none."""
+        n = self.universe.particles.n
+        if n == 0:
+            return -1
+        pos = self.universe.particles.pos[:n]
+        point = as_vec3(point)
+        tree, drift = self._tree(pos)
+        if tree is None:
+            return int(np.argmin(((pos - point) ** 2).sum(axis=1)))
+        # The true nearest was within d + drift of point when the tree was built.
+        # The ball can miss the tree's own answer to rounding, so add it back.
+        d, j = tree.query(point)
+        rows = np.unique(np.append(tree.query_ball_point(point, d + 2 * drift), j).astype(np.int64))
+        return int(rows[np.argmin(((pos[rows] - point) ** 2).sum(axis=1))])
+
+    def within(self, point, radius):
+        """Rows of the bodies at most radius from point."""
+        n = self.universe.particles.n
+        pos = self.universe.particles.pos[:n]
+        point = as_vec3(point)
+        tree, drift = self._tree(pos)
+        if tree is None:
+            rows = np.arange(n)
+        else:
+            rows = np.sort(np.asarray(tree.query_ball_point(point, radius + drift), dtype=np.int64))
+        return rows[((pos[rows] - point) ** 2).sum(axis=1) <= radius * radius]
+
+    def in_rect(self, lo, hi):
+        """Rows of the bodies with lo <= (x, y) <= hi, at any z."""
+        n = self.universe.particles.n
+        pos = self.universe.particles.pos[:n]
+        lo = np.asarray(lo, dtype=np.float64)[:2]
+        hi = np.asarray(hi, dtype=np.float64)[:2]
+        tree, drift = self._tree(pos)
+        if tree is None:
+            rows = np.arange(n)
+        else:
+            # A Chebyshev ball around the rectangle's center, tall enough for every z.
+            center = np.append((lo + hi) / 2, 0.0)
+            reach = max(float((hi - lo).max()) / 2, self.z_extent) + drift
+            rows = np.sort(np.asarray(tree.query_ball_point(center, reach, p=np.inf),
+                                      dtype=np.int64))
+        xy = pos[rows, :2]
+        return rows[np.all((xy >= lo) & (xy <= hi), axis=1)]
+
+
+# =============================================================================
+# Barnes-Hut Octree (JIT-compiled)
+# =============================================================================
+@jit(nopython=True, cache=True)
+def build_octree(pos, mass, max_depth, leaf_size):
+    """
+    Builds a Barnes-Hut octree over pos.
+
+    Returns (child, first_body, next_body, center, half, com, node_mass).
+    child[node, octant] is -1 when empty; a node with no children is a leaf
+    whose bodies form a linked list first_body[node] -> next_body[...] -> -1.
+    Leaves hold up to leaf_size bodies, or any number once max_depth is
+    reached (coincident bodies). Children have larger indices than parents.
+    """
+    n = pos.shape[0]
+    capacity = n + 16
+    child = np.full((capacity, 8), -1, dtype=np.int64)
+    first_body = np.full(capacity, -1, dtype=np.int64)
+    count = np.zeros(capacity, dtype=np.int64)
+    depth = np.zeros(capacity, dtype=np.int64)
+    center = np.zeros((capacity, 3))
+    half = np.zeros(capacity)
+    next_body = np.full(n, -1, dtype=np.int64)
+
+    lo = np.empty(3)
+    hi = np.empty(3)
+    for d in range(3):
+        lo[d] = pos[:, d].min()
+        hi[d] = pos[:, d].max()
+    size = max(hi[0] - lo[0], hi[1] - lo[1], hi[2] - lo[2])
+    half[0] = 0.5 * size * (1.0 + 1e-9) + 1e-12
+    for d in range(3):
+        center[0, d] = 0.5 * (lo[d] + hi[d])
+    n_nodes = 1
+
+    # Bodies waiting to be inserted below a given node (splits re-insert residents).
+    pending_size = (leaf_size + 1) * (max_depth + 2)
+    pending_body = np.empty(pending_size, dtype=np.int64)
+    pending_node = np.empty(pending_size, dtype=np.int64)
+    for b0 in range(n):
+        pending_body[0] = b0
+        pending_node[0] = 0
+        n_pending = 1
+        while n_pending > 0:
+            n_pending -= 1
+            b = pending_body[n_pending]
+            node = pending_node[n_pending]
+            while True:
+                if count[node] >= 0:
+                    # Leaf (count < 0 marks an internal node).
+                    if count[node] < leaf_size or depth[node] >= max_depth:
+                        next_body[b] = first_body[node]
+                        first_body[node] = b
+                        count[node] += 1
+                        break
+                    # Split: the residents go back on the pending stack.
+                    r = first_body[node]
+                    while r != -1:
+                        pending_body[n_pending] = r
+                        pending_node[n_pending] = node
+                        n_pending += 1
+                        r = next_body[r]
+                    first_body[node] = -1
+                    count[node] = -1
+                octant = 0
+                for d in range(3):
+                    if pos[b, d] >= center[node, d]:
+                        octant |= 1 << d
+                c = child[node, octant]
+                if c == -1:
+                    if n_nodes == child.shape[0]:
+                        grown = 2 * n_nodes
+                        child2 = np.full((grown, 8), -1, dtype=np.int64)
+                        child2[:n_nodes] = child
+                        child = child2
+                        first2 = np.full(grown, -1, dtype=np.int64)
+                        first2[:n_nodes] = first_body
+                        first_body = first2
+                        count2 = np.zeros(grown, dtype=np.int64)
+                        count2[:n_nodes] = count
+                        count = count2
+                        depth2 = np.zeros(grown, dtype=np.int64)
+                        depth2[:n_nodes] = depth
+                        depth = depth2
+                        center2 = np.zeros((grown, 3))
+                        center2[:n_nodes] = center
+                        center = center2
+                        half2 = np.zeros(grown)
+                        half2[:n_nodes] = half
+                        half = half2
+                    c = n_nodes
+                    n_nodes += 1
+                    child[node, octant] = c
+                    depth[c] = depth[node] + 1
+                    half[c] = 0.5 * half[node]
+                    for d in range(3):
+                        if octant & (1 << d):
+                            center[c, d] = center[node, d] + half[c]
+                        else:
+                            center[c, d] = center[node, d] - half[c]
+                node = c
+
+    # Accumulate mass and centre of mass bottom-up (children come after parents).
+    com = np.zeros((n_nodes, 3))
+    node_mass = np.zeros(n_nodes)
+    for node in range(n_nodes - 1, -1, -1):
+        m = 0.0
+        cx = 0.0
+        cy = 0.0
+        cz = 0.0
+        b = first_body[node]
+        while b != -1:
+            m += mass[b]
+            cx += mass[b] * pos[b, 0]
+            cy += mass[b] * pos[b, 1]
+            cz += mass[b] * pos[b, 2]
+            b = next_body[b]
+        for o in range(8):
+            c = child[node, o]
+            if c != -1:
+                m += node_mass[c]
+                cx += node_mass[c] * com[c, 0]
+                cy += node_mass[c] * com[c, 1]
+                cz += node_mass[c] * com[c, 2]
+        node_mass[node] = m
+        if m > 0.0:
+            com[node, 0] = cx / m
+            com[node, 1] = cy / m
+            com[node, 2] = cz / m
+        else:
+            com[node, 0] = center[node, 0]
+            com[node, 1] = center[node, 1]
+            com[node, 2] = center[node, 2]
+    return (child[:n_nodes], first_body[:n_nodes], next_body, center[:n_nodes],
+            half[:n_nodes], com, node_mass)
+
+
+@jit(nopython=True, cache=True)
+def octree_body_order(child, first_body, next_body, max_depth):
+    """Bodies in depth-first leaf order, so spatial neighbours are adjacent."""
+    order = np.empty(next_body.shape[0], dtype=np.int64)
+    stack = np.empty(8 * (max_depth + 2), dtype=np.int64)
+    stack[0] = 0
+    top = 1
+    k = 0
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        b = first_body[node]
+        while b != -1:
+            order[k] = b
+            k += 1
+            b = next_body[b]
+        for o in range(7, -1, -1):
+            c = child[node, o]
+            if c != -1:
+                stack[top] = c
+                top += 1
+    return order
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_barnes_hut_accelerations(pos, mass, fixed, G_val, eps, theta,
+                                     max_depth=BH_MAX_DEPTH, leaf_size=BH_LEAF_SIZE):
+    """
+    Accelerations on every non-fixed particle from all other particles,
+    approximating distant octree cells by their centre of mass. A cell is
+    accepted when (cell size / distance) < theta and the particle is not inside
+    it. Uses the same softening as compute_knn_accelerations,
+    G m / (r + eps)^2 along the separation.
+    """
+    n = pos.shape[0]
+    acc = np.zeros((n, 3))
+    if n == 0:
+        return acc
+    child, first_body, next_body, center, half, com, node_mass = build_octree(
+        pos, mass, max_depth, leaf_size)
+    # A cell is opened unless (2 * half)^2 < theta^2 * r^2.
+    if theta > 0.0:
+        open_r2 = (2.0 * half / theta) ** 2
+    else:
+        open_r2 = np.full(half.shape[0], np.inf)
+    # Walk bodies in tree order so consecutive walks touch the same cells.
+    order = octree_body_order(child, first_body, next_body, max_depth)
+    stack_size = 8 * (max_depth + 2)
+    for k in prange(n):
+        i = order[k]
+        if fixed[i]:
+            continue
+        px = pos[i, 0]
+        py = pos[i, 1]
+        pz = pos[i, 2]
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            d0 = com[node, 0] - px
+            d1 = com[node, 1] - py
+            d2 = com[node, 2] - pz
+            r2 = d0 * d0 + d1 * d1 + d2 * d2
+            h = half[node]
+            if (r2 > open_r2[node] and
+                    (abs(px - center[node, 0]) > h or abs(py - center[node, 1]) > h or
+                     abs(pz - center[node, 2]) > h)):
+                dist = math.sqrt(r2) + eps
+                scale = G_val * node_mass[node] / (dist * dist * dist)
+                ax += scale * d0
+                ay += scale * d1
+                az += scale * d2
+                continue
+            b = first_body[node]
+            if b != -1:
+                # Opened leaf: sum its bodies directly.
+                while b != -1:
+                    if b != i:
+                        d0 = pos[b, 0] - px
+                        d1 = pos[b, 1] - py
+                        d2 = pos[b, 2] - pz
+                        dist = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2) + eps
+                        scale = G_val * mass[b] / (dist * dist * dist)
+                        ax += scale * d0
+                        ay += scale * d1
+                        az += scale * d2
+                    b = next_body[b]
+                continue
+            for o in range(8):
+                c = child[node, o]
+                if c != -1 and node_mass[c] != 0.0:
+                    stack[top] = c
+                    top += 1
+        acc[i, 0] = ax
+        acc[i, 1] = ay
+        acc[i, 2] = az
+    return acc
+
+
+# =============================================================================
+# Exact Direct Summation (JIT-compiled, parallel)
+# =============================================================================
+@jit(nopython=True, parallel=True, cache=True)
+def compute_direct_accelerations(pos, mass, fixed, G_val, eps, tile=DIRECT_TILE):
+    """
+    Exact softened accelerations on every non-fixed particle from all others.
+
+    Targets are split into tiles that run on separate threads; each tile
+    sweeps the sources one tile at a time so both stay in cache, and tiles
+    without any non-fixed target are skipped. Pairs at zero
+    separation (including a body with itself) contribute nothing.
+    """
+    n = pos.shape[0]
+    acc = np.zeros((n, 3))
+    x = np.ascontiguousarray(pos[:, 0])
+    y = np.ascontiguousarray(pos[:, 1])
+    z = np.ascontiguousarray(pos[:, 2])
+    n_tiles = (n + tile - 1) // tile
+    for t in prange(n_tiles):
+        i0 = t * tile
+        i1 = min(i0 + tile, n)
+        targets = 0
+        for i in range(i0, i1):
+            if not fixed[i]:
+                targets += 1
+        if targets == 0:
+            continue
+        ax = np.zeros(i1 - i0)
+        ay = np.zeros(i1 - i0)
+        az = np.zeros(i1 - i0)
+        for j0 in range(0, n, tile):
+            j1 = min(j0 + tile, n)
+            for j in range(j0, j1):
+                xj = x[j]
+                yj = y[j]
+                zj = z[j]
+                gm = G_val * mass[j]
+                for i in range(i0, i1):
+                    d0 = xj - x[i]
+                    d1 = yj - y[i]
+                    d2 = zj - z[i]
+                    r2 = d0 * d0 + d1 * d1 + d2 * d2
+                    dist = math.sqrt(r2) + eps
+                    scale = gm / (dist * dist * dist) if r2 > 0.0 else 0.0
+                    ax[i - i0] += scale * d0
+                    ay[i - i0] += scale * d1
+                    az[i - i0] += scale * d2
+        for i in range(i0, i1):
+            if not fixed[i]:
+                acc[i, 0] = ax[i - i0]
+                acc[i, 1] = ay[i - i0]
+                acc[i, 2] = az[i - i0]
+    return acc
+
+
+# =============================================================================
+# Collision Detection and Merging (JIT-compiled)
+# =============================================================================
+@jit(nopython=True, cache=True)
+def _cell_less(keys, a, b0, b1, b2):
+    if keys[a, 0] != b0:
+        return keys[a, 0] < b0
+    if keys[a, 1] != b1:
+        return keys[a, 1] < b1
+    return keys[a, 2] < b2
+
+
+@jit(nopython=True, cache=True)
+def find_collision_pairs(pos, radius, stable, keys, order):
+    """
+    Broad and narrow phase in one pass. keys holds each particle's grid cell
+    (floor(pos / cell) with cell >= the largest visual radius) and order sorts
+    the particles by cell. Every particle looks only at the 27 cells around
+    its own. Returns (first, second) arrays of colliding pairs with
+    first < second: their distance is below the mean visual radius and they
+    are not both stable.
+    """
+    n = pos.shape[0]
+    # Runs of equal cells in sorted order: cell c holds order[start[c]:start[c + 1]].
+    cell_keys = np.empty((n, 3))
+    start = np.empty(n + 1, dtype=np.int64)
+    n_cells = 0
+    for s in range(n):
+        i = order[s]
+        if (n_cells == 0 or keys[i, 0] != cell_keys[n_cells - 1, 0] or
+                keys[i, 1] != cell_keys[n_cells - 1, 1] or keys[i, 2] != cell_keys[n_cells - 1, 2]):
+            cell_keys[n_cells, 0] = keys[i, 0]
+            cell_keys[n_cells, 1] = keys[i, 1]
+            cell_keys[n_cells, 2] = keys[i, 2]
+            start[n_cells] = s
+            n_cells += 1
+    start[n_cells] = n
+
+    first = np.empty(64, dtype=np.int64)
+    second = np.empty(64, dtype=np.int64)
+    n_pairs = 0
+    visited = np.empty(27, dtype=np.int64)
+    for i in range(n):
+        n_visited = 0
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                for dz in range(-1, 2):
+                    k0 = keys[i, 0] + dx
+                    k1 = keys[i, 1] + dy
+                    k2 = keys[i, 2] + dz
+                    # Binary search for the cell (lexicographic on the keys).
+                    lo = 0
+                    hi = n_cells
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if _cell_less(cell_keys, mid, k0, k1, k2):
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    if (lo == n_cells or cell_keys[lo, 0] != k0 or cell_keys[lo, 1] != k1
+                            or cell_keys[lo, 2] != k2):
+                        continue
+                    # Far from the origin neighbouring keys can round to the same cell.
+                    seen = False
+                    for v in range(n_visited):
+                        if visited[v] == lo:
+                            seen = True
+                    if seen:
+                        continue
+                    visited[n_visited] = lo
+                    n_visited += 1
+                    for s in range(start[lo], start[lo + 1]):
+                        j = order[s]
+                        if j <= i or (stable[i] and stable[j]):
+                            continue
+                        d0 = pos[j, 0] - pos[i, 0]
+                        d1 = pos[j, 1] - pos[i, 1]
+                        d2 = pos[j, 2] - pos[i, 2]
+                        limit = (radius[i] + radius[j]) * 0.5
+                        if d0 * d0 + d1 * d1 + d2 * d2 < limit * limit:
+                            if n_pairs == first.shape[0]:
+                                first2 = np.empty(2 * n_pairs, dtype=np.int64)
+                                first2[:n_pairs] = first
+                                first = first2
+                                second2 = np.empty(2 * n_pairs, dtype=np.int64)
+                                second2[:n_pairs] = second
+                                second = second2
+                            first[n_pairs] = i
+                            second[n_pairs] = j
+                            n_pairs += 1
+    return first[:n_pairs], second[:n_pairs]
+
+
+@jit(nopython=True, cache=True)
+def collision_clusters(n, first, second):
+    """
+    Connected components of the collision graph. Returns (offsets, members):
+    cluster c consists of rows members[offsets[c]:offsets[c + 1]] in
+    ascending order, and clusters are ordered by their lowest row.
+    """
+    parent = np.arange(n)
+    for p in range(first.shape[0]):
+        a = first[p]
+        while parent[a] != a:
+            a = parent[a]
+        b = second[p]
+        while parent[b] != b:
+            b = parent[b]
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+    involved = np.zeros(n, dtype=np.bool_)
+    for p in range(first.shape[0]):
+        involved[first[p]] = True
+        involved[second[p]] = True
+    cluster_of = np.full(n, -1, dtype=np.int64)
+    counts = np.zeros(n + 1, dtype=np.int64)
+    n_clusters = 0
+    for i in range(n):
+        if not involved[i]:
+            continue
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        parent[i] = root
+        if root == i:
+            cluster_of[i] = n_clusters
+            n_clusters += 1
+        else:
+            cluster_of[i] = cluster_of[root]
+        counts[cluster_of[i] + 1] += 1
+    offsets = np.cumsum(counts[:n_clusters + 1])
+    members = np.empty(offsets[n_clusters], dtype=np.int64)
+    fill = offsets[:n_clusters].copy()
+    for i in range(n):
+        c = cluster_of[i]
+        if c >= 0:
+            members[fill[c]] = i
+            fill[c] += 1
+    return offsets, members
+
+
+@jit(nopython=True, cache=True)
+def merge_clusters(offsets, members, pos, vel, mass, radius, color, mass_cap):
+    """
+    Folds every cluster into one body, taking members in ascending row order
+    and applying the pairwise rule to the body so far and the next member:
+    below mass_cap the two merge into a new body (mass-weighted position,
+    velocity and color, volume-conserving radius); otherwise the heavier one
+    absorbs the other's mass and momentum. Returns per cluster the surviving
+    row (-1 for a new body) with its mass, position, velocity, color and
+    radius, plus a per-member flag telling which names make up the result.
+    """
+    n_clusters = offsets.shape[0] - 1
+    survivor = np.empty(n_clusters, dtype=np.int64)
+    out_mass = np.empty(n_clusters)
+    out_pos = np.empty((n_clusters, 3))
+    out_vel = np.empty((n_clusters, 3))
+    out_color = np.empty((n_clusters, 3), dtype=np.int64)
+    out_radius = np.empty(n_clusters)
+    in_name = np.zeros(members.shape[0], dtype=np.bool_)
+    for c in range(n_clusters):
+        first = offsets[c]
+        a = members[first]
+        row = a
+        m = mass[a]
+        r = radius[a]
+        p = pos[a].copy()
+        v = vel[a].copy()
+        col = np.empty(3, dtype=np.int64)
+        for k in range(3):
+            col[k] = color[a, k]
+        in_name[first] = True
+        for q in range(first + 1, offsets[c + 1]):
+            b = members[q]
+            new_mass = m + mass[b]
+            new_vel = (m * v + mass[b] * vel[b]) / new_mass
+            if new_mass < mass_cap:
+                p = (m * p + mass[b] * pos[b]) / new_mass
+                for k in range(3):
+                    col[k] = min(255, int((col[k] * m + color[b, k] * mass[b]) / new_mass))
+                r = (r ** 3 + radius[b] ** 3) ** (1 / 3)
+                row = -1
+                in_name[q] = True
+            elif m <= mass[b]:
+                # The later body is the heavier one and absorbs the rest.
+                row = b
+                p = pos[b].copy()
+                r = radius[b]
+                for k in range(3):
+                    col[k] = color[b, k]
+                for prev in range(first, q):
+                    in_name[prev] = False
+                in_name[q] = True
+            m = new_mass
+            v = new_vel
+        survivor[c] = row
+        out_mass[c] = m
+        out_pos[c] = p
+        out_vel[c] = v
+        out_color[c] = col
+        out_radius[c] = r
+    return survivor, out_mass, out_pos, out_vel, out_color, out_radius, in_name
+
+
+# =============================================================================
+# Integrators
+# =============================================================================
+# Every integrator is a symmetric composition of kick-drift-kick Verlet
+# substeps: each weight w runs one Verlet step of w * dt. Yoshida's weights
+# cancel the low-order error terms (4th order with 3 substeps, 6th with 7).
+_CBRT2 = 2 ** (1 / 3)
+_YOSHIDA6 = (0.784513610477560, 0.235573213359357, -1.17767998417887)
+INTEGRATOR_WEIGHTS = {
+    "verlet": (1.0,),
+    "yoshida4": (1 / (2 - _CBRT2), -_CBRT2 / (2 - _CBRT2), 1 / (2 - _CBRT2)),
+    "yoshida6": _YOSHIDA6 + (1 - 2 * sum(_YOSHIDA6),) + _YOSHIDA6[::-1],
+}
+INTEGRATORS = tuple(INTEGRATOR_WEIGHTS)
+
+
+class AccelerationCache:
+    """
+    First-same-as-last reuse of accelerations: the accelerations computed at
+    the end of one step start the next, so a Verlet substep costs a single
+    force evaluation. They are only reused while everything they depend on is
+    unchanged (same store and store.version, i.e. no merge, spawn, removal or
+    Particle position/mass assignment, and the same G and solver settings).
+    """
+
+    def __init__(self):
+        self.acc = None
+        self.key = None
+        self.hits = 0
+
+    def invalidate(self):
+        self.acc = None
+        self.key = None
+
+    def get(self, key):
+        if self.key is None or self.key != key:
+            return None
+        self.hits += 1
+        return self.acc
+
+    def put(self, key, acc):
+        self.acc = acc
+        self.key = key
+
+
+# =============================================================================
+# JIT Warm-up
+# =============================================================================
+# Kernels are compiled on first call and cached on disk (__pycache__), so
+# only the first run on a machine pays for compilation. These are the
+# argument types the simulation calls them with, per storage precision (the
+# state columns are float32 or float64, everything else is fixed);
+# compile_kernels() builds them ahead of the first step, e.g. on a
+# background thread or at install time with
+#   python -c "import sim_core; sim_core.compile_kernels(KERNEL_GROUPS)".
+_F8 = types.float64
+_I8 = types.int64
+_F8_1 = types.float64[::1]
+_I8_1, _B1_1, _U1_2 = types.int64[::1], types.boolean[::1], types.uint8[:, ::1]
+
+
+def kernel_signatures(real):
+    """Kernel argument types by group for state columns of numba type real."""
+    R1, R2 = real[::1], real[:, ::1]
+    return {
+        "knn": (
+            (compute_knn_accelerations, (R2, R1, _B1_1, _I8_1, _I8_1, _I8, _F8, _F8)),
+            (max_displacement_sq, (R2, R2)),
+        ),
+        "barnes_hut": (
+            (compute_barnes_hut_accelerations, (R2, R1, _B1_1, _F8, _F8, _F8, _I8, _I8)),
+        ),
+        "direct": (
+            (compute_direct_accelerations, (R2, R1, _B1_1, _F8, _F8, _I8)),
+        ),
+        "collisions": (
+            (find_collision_pairs, (R2, _F8_1, _B1_1, R2, _I8_1)),
+            (collision_clusters, (_I8, _I8_1, _I8_1)),
+            (merge_clusters, (_I8_1, _I8_1, R2, R2, R1, _F8_1, _U1_2, _F8)),
+        ),
+    }
+
+
+KERNEL_SIGNATURES = {"float64": kernel_signatures(types.float64),
+                     "float32": kernel_signatures(types.float32)}
+KERNEL_GROUPS = tuple(KERNEL_SIGNATURES["float64"])
+
+
+def compile_kernels(groups=("knn", "collisions"), precision="float64"):
+    """Compile, or load from the disk cache, the kernels of the given groups."""
+    for group in groups:
+        for kernel, signature in KERNEL_SIGNATURES[precision][group]:
+            kernel.compile(signature)
+
+
+def warm_up_kernels(groups=("knn", "collisions"), precision="float64"):
+    """Run compile_kernels(groups, precision) on a daemon thread and return the thread."""
+    # Start the parallel runtime here: a pool first started from the helper
+    # thread keeps the interpreter from exiting.
+    get_num_threads()
+    thread = threading.Thread(target=compile_kernels, args=(groups, precision), daemon=True)
+    thread.start()
+    return thread
+
+
+# =============================================================================
+# Block Timesteps
+# =============================================================================
+def block_step_levels(acc, jerk, step, max_level, eta=BLOCK_ETA):
+    """
+    Power-of-two step level for each body: level k means a step of
+    step / 2**k, the largest one not above eta * |a| / |jerk|. Bodies without
+    a jerk estimate (NaN) start on the finest level.
+    """
+    a = np.sqrt((acc * acc).sum(axis=1))
+    j = np.sqrt((jerk * jerk).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        level = np.ceil(np.log2(step * j / (eta * a)))
+    level[np.isnan(j)] = max_level
+    level[np.isnan(level)] = 0      # No acceleration and no jerk: quiet
+    return np.clip(level, 0, max_level).astype(np.int64)
+
+
+# =============================================================================
+# Defense Mode
+# =============================================================================
+class MeteorPool:
+    """
+    The live meteors of defense mode, by pid, with their expiry times in a
+    min-heap: a frame only looks at the meteors that are due. Meteors that
+    leave the store (merged in a collision, shot down) are dropped from the
+    pool the next time it is counted or iterated; their heap entries are
+    skipped when they come up.
+
+    Meteors aim at stable system bodies. Their pids are cached and only
+    gathered again when the store's stable_version changes, not on every
+    spawn. reserve() sets aside store rows for `size` meteors so spawning
+    never regrows the particle arrays mid-game.
+
+    Iterating yields Particle views of the meteors still in the store.
+    """
+
+    def __init__(self, size=METEOR_POOL_SIZE):
+        self.size = size
+        self.live = {}          # pid -> Particle view, in spawn order
+        self.expiry = []        # (expiry time, pid) heap
+        self.targets = None
+        self.targets_key = None
+
+    def __len__(self):
+        self.prune()
+        return len(self.live)
+
+    def __iter__(self):
+        self.prune()
+        return iter(list(self.live.values()))
+
+    def __contains__(self, particle):
+        return getattr(particle, "_pid", None) in self.live
+
+    def reserve(self, store):
+        store.reserve(store.n + self.size - len(self))
+
+    def clear(self):
+        self.live = {}
+        self.expiry = []
+        self.invalidate()
+
+    def invalidate(self):
+        self.targets = None
+        self.targets_key = None
+
+    def add(self, store, pids, expires):
+        """Track the meteors with these pids, expiring at the given times (ms)."""
+        for pid, when in zip(pids.tolist(), np.broadcast_to(expires, pids.shape).tolist()):
+            self.live[pid] = Particle.view(store, pid)
+            heapq.heappush(self.expiry, (when, pid))
+
+    def discard(self, pid):
+        self.live.pop(pid, None)
+
+    def prune(self):
+        """Forget the meteors whose pids have left their store."""
+        gone = [pid for pid, m in self.live.items() if m._store.row_of[pid] < 0]
+        for pid in gone:
+            del self.live[pid]
+
+    def expired(self, store, now):
+        """Pop the meteors due at now; returns the pids of those still in the store."""
+        due = []
+        while self.expiry and self.expiry[0][0] <= now:
+            _, pid = heapq.heappop(self.expiry)
+            if self.live.pop(pid, None) is not None and store.row_of[pid] >= 0:
+                due.append(pid)
+        return due
+
+    def target_pids(self, store):
+        """Pids of the stable system bodies of store (cached)."""
+        if (self.targets_key is None or self.targets_key[0] is not store
+                or self.targets_key[1] != store.stable_version):
+            n = store.n
+            rows = np.flatnonzero(store.stable[:n] & (store.p_type[:n] == p_type_code("system")))
+            self.targets = store.pid[rows]
+            self.targets_key = (store, store.stable_version)
+        return self.targets
+
+
+# =============================================================================
+# Universe Engine
+# =============================================================================
+class Universe:
+    """
+    Owns the complete simulation state and advances it without rendering.
+
+    The pygame front-end in sim.py is one client of this object; batch runs
+    drive it directly with step(n), add bodies with add_body/add_bodies and
+    read results with snapshot(). Wall-clock driven features (defense mode)
+    take the current time in milliseconds as an argument.
+    """
+
+    def __init__(self, seed=None, force_backend="knn", precision="float64"):
+        self.random = random.Random(seed)
+        self.particles = ParticleStore(precision=precision)
+        self.lights = []
+        self.meteors = MeteorPool()
+        self.G = G_SIM
+        self.dt = DT
+        self.time_speed = 1.0
+        self.simulation_time = 0.0
+        self.force_backend = force_backend
+        self.bh_theta = BH_THETA
+        self.block_levels = 0   # Finest block timestep level (0 = one global step)
+        self.integrator = "verlet"
+        self.neighbors = NeighborList()
+        self.acc_cache = AccelerationCache()
+        self.spatial = SpatialIndex(self)
+        self.recorder = None    # TrajectoryRecorder fed by step(), see sim_recording
+        self.diagnostics = None # Diagnostics fed by step(), see sim_diagnostics
+        self.domains = None     # DomainPool computing the forces, see sim_domains
+        self.precision_notice = None    # Why float32 was refused or left, for the UI
+        self.reset_defense(0)
+
+    def reset_defense(self, now):
+        self.alive_population = 1000
+        self.defense_score = 0
+        self.meteor_spawn_interval = METEOR_SPAWN_INTERVAL
+        self.defense_level = 1
+        self.last_meteor_spawn = now
+        self.last_level_up = now
+
+    def reset(self, now=0):
+        """Clear the universe and build the default scene."""
+        self.particles = ParticleStore(precision=self.precision)
+        self.lights = []
+        self.meteors.clear()
+        self.reset_defense(now)
+        self.G = G_SIM
+        self.simulation_time = 0.0
+        self.create_real_solar_system()
+        self.create_galaxies()
+        self.create_asteroids(NUM_RANDOM_PARTICLES)
+
+    @property
+    def precision(self):
+        """Storage precision of the particle state, one of PRECISIONS."""
+        return self.particles.precision
+
+    @precision.setter
+    def precision(self, value):
+        """
+        Switch the storage precision. A switch to float32 is refused, with a
+        precision_notice, while the state or its accelerations are outside
+        FLOAT32_RANGE.
+        """
+        if value not in PRECISIONS:
+            raise ValueError(f"unknown precision {value!r}; expected one of {PRECISIONS}")
+        if value == "float32" and self.precision != "float32":
+            particles = self.particles
+            n = particles.n
+            acc = None
+            if n > 1:
+                acc = self.compute_accelerations(particles.pos[:n], particles.mass[:n],
+                                                 particles.fixed[:n])
+            overflow = self.float32_overflow(acc)
+            if overflow is not None:
+                self.precision_notice = f"float32 refused: {overflow} beyond {FLOAT32_RANGE:.1e}"
+                return
+        self.precision_notice = None
+        self.particles.set_precision(value)
+        self.neighbors.invalidate()
+        self.acc_cache.invalidate()
+
+    def float32_overflow(self, acc=None):
+        """
+        Name of the first state quantity (or acc) with a magnitude beyond
+        FLOAT32_RANGE or not finite, or None when all fit.
+        """
+        particles = self.particles
+        n = particles.n
+        quantities = [("positions", particles.pos[:n]), ("velocities", particles.vel[:n]),
+                      ("masses", particles.mass[:n])]
+        if acc is not None:
+            quantities.append(("accelerations", acc))
+        for name, values in quantities:
+            if values.size and not np.abs(values).max() < FLOAT32_RANGE:
+                return name
+        return None
+
+    # -------------------------------------------------------------------------
+    # Stepping
+    # -------------------------------------------------------------------------
+    def step(self, n=1):
+        """
+        Advance n steps: integrate, advance the clock and resolve collisions.
+        In float32, a state about to leave FLOAT32_RANGE is switched back to
+        float64 before the step (see precision_notice).
+        """
+        for _ in range(n):
+            if self.precision == "float32":
+                overflow = self.float32_overflow()
+                if overflow is not None:
+                    self.precision = "float64"
+                    self.precision_notice = (f"back to float64: {overflow} "
+                                             f"beyond {FLOAT32_RANGE:.1e}")
+            self.update()
+            self.simulation_time += self.dt * self.time_speed
+            with profiler.phase("collisions"):
+                self.handle_collisions()
+            if self.alive_population < 100000:
+                self.alive_population += 1
+            if self.diagnostics is not None:
+                self.diagnostics.observe(self)
+            if self.recorder is not None:
+                self.recorder.record(self)
+
+    def update_gravitational_constant(self, n=None):
+        """
+        Dynamically updates G using the emergent formula:
+
+            G_SIM = (c * h) / (Lambda * alpha * sqrt(N_eff))
+
+        Here, N_eff is the effective particle count.
+        We set N_eff = N_sim * scale_factor, where scale_factor is chosen to represent
+        the real density of particles. N_sim is the current body count unless
+        n is given (e.g. the count a scene generator is about to reach).
+        """
+        N_sim = len(self.particles) if n is None else n
+        scale_factor = 1e76  # Choose this factor so that N_eff approximates the real universe (e.g., ~10^80)
+        N_eff = N_sim * scale_factor
+        if N_eff == 0:
+            N_eff = 1  # Avoid division by zero
+        sqrt_N = np.sqrt(N_eff)
+        self.G = (c * h) / (Lambda * alpha * sqrt_N)
+
+    def compute_accelerations(self, pos, mass, fixed, active=None):
+        """
+        Accelerations from the selected force backend (see FORCE_BACKENDS).
+        With an active mask only those bodies are evaluated (sources are still
+        every body); the rest, like fixed bodies, read zero.
+        """
+        if active is not None:
+            fixed = fixed | ~active
+        if self.domains is not None and self.force_backend != "knn":
+            with profiler.phase("forces"):
+                theta = self.bh_theta if self.force_backend == "barnes_hut" else 0.0
+                return self.domains.accelerations(self.particles, pos, mass, fixed, self.G,
+                                                  EPSILON, theta)
+        if self.force_backend == "barnes_hut":
+            with profiler.phase("forces"):
+                return compute_barnes_hut_accelerations(pos, mass, fixed, self.G, EPSILON,
+                                                        self.bh_theta, BH_MAX_DEPTH, BH_LEAF_SIZE)
+        if self.force_backend == "direct":
+            with profiler.phase("forces"):
+                if active is None:
+                    return compute_direct_accelerations(pos, mass, fixed, self.G, EPSILON,
+                                                        DIRECT_TILE)
+                # Pack the targets into the leading tiles so the idle tiles are skipped.
+                order = np.argsort(fixed, kind="stable")
+                acc = np.empty_like(pos)
+                acc[order] = compute_direct_accelerations(pos[order], mass[order], fixed[order],
+                                                          self.G, EPSILON, DIRECT_TILE)
+                return acc
+        # Default: the nearest neighbours of every particle, from the Verlet lists.
+        with profiler.phase("neighbors"):
+            offsets, indices = self.neighbors.update(self.particles, pos)
+        k = min(self.neighbors.k, pos.shape[0])
+        with profiler.phase("forces"):
+            return compute_knn_accelerations(pos, mass, fixed, offsets, indices, k, self.G, EPSILON)
+
+    def force_key(self):
+        """Everything the accelerations depend on besides positions and masses."""
+        s = self.particles
+        return (s, s.version, s.n, self.G, self.force_backend, self.bh_theta)
+
+    def start_accelerations(self, pos, mass, fixed):
+        """Accelerations at the start of a step, reused from the last step when still valid."""
+        acc = self.acc_cache.get(self.force_key())
+        if acc is None:
+            acc = self.compute_accelerations(pos, mass, fixed)
+        return acc
+
+    def update(self):
+        """
+        Updates the universe in 3D using a two-step Velocity Verlet-like integration:
+        1. Update the gravitational constant based on the current particle count.
+        2. Compute accelerations with the selected force backend.
+        3. Perform a half-step velocity update, update positions, recompute
+           accelerations, then update velocities fully.
+        4. Update trails for visualization.
+        All steps operate on the particle store arrays. Step 3 is repeated
+        for each substep of the selected integrator (INTEGRATOR_WEIGHTS), and
+        the accelerations from the end of a step are cached for the start of
+        the next one. With block_levels > 0 step 3 uses per-body Verlet block
+        timesteps instead (see update_blocks).
+        """
+        with profiler.phase("gravity_constant"):
+            self.update_gravitational_constant()
+
+        particles = self.particles
+        N = len(particles)
+        if N == 0:
+            return
+        with profiler.phase("integrate"):
+            self.integrate(particles, N)
+
+    def integrate(self, particles, N):
+        """Steps 3 and 4 of update() on the first N rows of the store."""
+        pos = particles.pos[:N]
+        vel = particles.vel[:N]
+        mass = particles.mass[:N]
+        fixed = particles.fixed[:N]
+        mobile = ~fixed
+        step = self.dt * self.time_speed
+
+        if self.block_levels > 0:
+            acc = self.update_blocks(pos, vel, mass, fixed, step)
+        else:
+            acc = self.start_accelerations(pos, mass, fixed)
+            for weight in INTEGRATOR_WEIGHTS[self.integrator]:
+                h = weight * step
+                # Half-step velocity update and drift with the current accelerations.
+                vel[mobile] += 0.5 * acc[mobile] * h
+                pos[mobile] += vel[mobile] * h
+
+                # Acceleration pass at the new positions and full velocity update.
+                acc = self.compute_accelerations(pos, mass, fixed)
+                vel[mobile] += 0.5 * acc[mobile] * h
+        self.acc_cache.put(self.force_key(), acc)
+
+        particles.record_trails(np.flatnonzero(mobile))
+
+    def update_blocks(self, pos, vel, mass, fixed, step):
+        """
+        One global step as hierarchical block timesteps. Each body gets a
+        power-of-two fraction of the step (block_step_levels) and runs the
+        same kick-drift-kick Verlet on it; every body drifts on each substep,
+        but forces are only evaluated for the bodies whose step ends there.
+        Bodies re-pick their level at the end of each of their steps, coarser
+        only where the new step stays aligned with the hierarchy, and all are
+        synchronised again at the end of the global step. Returns the
+        end-of-step accelerations.
+        """
+        jerk = self.particles.jerk[:pos.shape[0]]
+        mobile = np.flatnonzero(~fixed)
+        full_acc = self.start_accelerations(pos, mass, fixed)
+        if mobile.shape[0] == 0:
+            return full_acc
+        max_level = self.block_levels
+        ticks = 1 << max_level          # Global step in units of the finest substep
+        tick = step / ticks
+
+        acc = full_acc[mobile]
+        length = ticks >> block_step_levels(acc, jerk[mobile], step, max_level)
+        end = length.copy()
+        vel[mobile] += 0.5 * acc * (length * tick)[:, None]
+        now = 0
+        while now < ticks:
+            nxt = int(end.min())
+            pos[mobile] += vel[mobile] * ((nxt - now) * tick)
+            now = nxt
+            done = np.flatnonzero(end == now)
+            rows = mobile[done]
+            active = np.zeros(pos.shape[0], dtype=bool)
+            active[rows] = True
+            new_acc = self.compute_accelerations(pos, mass, fixed, active)[rows]
+            h = (length[done] * tick)[:, None]
+            vel[rows] += 0.5 * new_acc * h
+            jerk[rows] = (new_acc - acc[done]) / h
+            acc[done] = new_acc
+            if now == ticks:
+                break
+            # Next step: the coarsest level allowed is the one aligned with now.
+            aligned = max_level - ((now & -now).bit_length() - 1)
+            level = np.maximum(block_step_levels(new_acc, jerk[rows], step, max_level), aligned)
+            length[done] = ticks >> level
+            end[done] = now + length[done]
+            vel[rows] += 0.5 * new_acc * (length[done] * tick)[:, None]
+        full_acc = np.zeros_like(pos)
+        full_acc[mobile] = acc
+        return full_acc
+
+    def handle_collisions(self):
+        """
+        Merges or absorbs overlapping particles. Pairs come from a grid broad
+        phase, every connected cluster of pairs is resolved into one body in a
+        single batched pass (see merge_clusters), and mass and momentum are
+        conserved throughout.
+        """
+        particles = self.particles
+        N = len(particles)
+        if N < 2:
+            return
+        pos = particles.pos[:N]
+        radius = particles.radius[:N]
+        cell = radius.max()
+        if not cell > 0:
+            return
+        keys = np.floor(pos / pos.dtype.type(cell))
+        order = np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+        first, second = find_collision_pairs(pos, radius, particles.stable[:N], keys, order)
+        if first.shape[0] == 0:
+            return
+        offsets, members = collision_clusters(N, first, second)
+        survivor, mass, new_pos, vel, color, new_radius, in_name = merge_clusters(
+            offsets, members, pos, particles.vel[:N], particles.mass[:N], radius,
+            particles.color[:N], MASS_CAP)
+
+        keep = np.ones(N, dtype=bool)
+        keep[members] = False
+        kept = survivor >= 0
+        rows = survivor[kept]
+        keep[rows] = True
+        particles.mass[rows] = mass[kept]
+        particles.vel[rows] = vel[kept]
+
+        new = np.flatnonzero(~kept)
+        names = particles.names
+        member_list = members.tolist()
+        name_flags = in_name.tolist()
+        new_names = ["+".join(names[member_list[q]] for q in range(offsets[c], offsets[c + 1])
+                              if name_flags[q])
+                     for c in new.tolist()]
+        particles.keep(keep)
+        particles.add_many(new_pos[new], mass[new], vel[new], colors=color[new],
+                           radii=new_radius[new], names=new_names)
+
+    # -------------------------------------------------------------------------
+    # Adding bodies and reading state
+    # -------------------------------------------------------------------------
+    def add_body(self, name, position, mass, velocity=(0, 0, 0), color=(255, 255, 255),
+                 radius=5, fixed=False, spin=0, stable=False, p_type="user", charge=0):
+        """Add one body (mass in simulation units) and return its Particle view."""
+        return self.particles.add(name, position, mass, velocity, charge, color, radius,
+                                  fixed, spin, stable, p_type)
+
+    def add_bodies(self, positions, masses, velocities=0.0, colors=(255, 255, 255), radii=5.0,
+                   names="Body", fixed=False, stable=False, p_type="user"):
+        """Add a batch of bodies from arrays (see ParticleStore.add_many); returns their pids."""
+        return self.particles.add_many(positions, masses, velocities, colors=colors, radii=radii,
+                                       names=names, fixed=fixed, stable=stable, p_type=p_type)
+
+    def snapshot(self):
+        """Copy of the current state as plain arrays, safe to keep across steps."""
+        s = self.particles
+        n = s.n
+        return {
+            "time": self.simulation_time,
+            "G": self.G,
+            "dt": self.dt,
+            "time_speed": self.time_speed,
+            "names": list(s.names),
+            "pid": s.pid[:n].copy(),
+            "position": s.pos[:n].copy(),
+            "velocity": s.vel[:n].copy(),
+            "mass": s.mass[:n].copy(),
+            "radius": s.radius[:n].copy(),
+            "color": s.color[:n].copy(),
+            "fixed": s.fixed[:n].copy(),
+            "stable": s.stable[:n].copy(),
+            "p_type": [P_TYPES[code] for code in s.p_type[:n].tolist()],
+        }
+
+    def save(self, path, now=None):
+        """Write a binary checkpoint of the complete state (see sim_checkpoint)."""
+        from sim_checkpoint import save_checkpoint
+        save_checkpoint(self, path, now)
+
+    def load(self, path, now=None, mmap=True):
+        """Restore a checkpoint written by save(); columns are memory-mapped by default."""
+        from sim_checkpoint import load_checkpoint
+        load_checkpoint(self, path, now, mmap)
+
+    def start_recording(self, path, every=1, quantize=False):
+        """Record every every-th step to a trajectory file (see sim_recording)."""
+        from sim_recording import TrajectoryRecorder
+        self.stop_recording()
+        self.recorder = TrajectoryRecorder(path, every, quantize)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_diagnostics(self, every=DIAGNOSTICS_EVERY, log_path=None):
+        """Sample energy and momentum every every steps (see sim_diagnostics)."""
+        from sim_diagnostics import Diagnostics
+        self.stop_diagnostics()
+        self.diagnostics = Diagnostics(every, log_path)
+
+    def stop_diagnostics(self):
+        if self.diagnostics is not None:
+            self.diagnostics.close()
+            self.diagnostics = None
+
+    def start_domains(self, processes=None):
+        """
+        Compute barnes_hut and direct forces in `processes` worker processes
+        (default: one per available core) by spatial domain decomposition.
+        """
+        from sim_domains import DomainPool
+        self.stop_domains()
+        self.domains = DomainPool(processes)
+        self.domains.start()
+
+    def stop_domains(self):
+        if self.domains is not None:
+            self.domains.close()
+            self.domains = None
+
+    def find_sun(self, stable_only=False):
+        """The first particle named Sun*, or None."""
+        for row, name in enumerate(self.particles.names):
+            if name.startswith("Sun") and (not stable_only or self.particles.stable[row]):
+                return self.particles[row]
+        return None
+
+    def nearest(self, point):
+        """The particle closest to point, or None if the universe is empty."""
+        row = self.spatial.nearest(point)
+        return self.particles[row] if row >= 0 else None
+
+    def covering(self, point):
+        """Rows whose visual radius covers point, in ascending order."""
+        n = len(self.particles)
+        if n == 0:
+            return np.empty(0, dtype=np.int64)
+        radius = self.particles.radius[:n]
+        rows = self.spatial.within(point, float(radius.max()))
+        dist = np.linalg.norm(self.particles.pos[rows] - as_vec3(point), axis=1)
+        return rows[dist < radius[rows]]
+
+    def particle_at(self, point):
+        """The first particle whose visual radius covers point, or None."""
+        hits = self.covering(point)
+        return self.particles[int(hits[0])] if hits.shape[0] else None
+
+    def particles_within(self, point, radius):
+        """Particles whose centers lie within radius of point."""
+        return [self.particles[int(row)] for row in self.spatial.within(point, radius)]
+
+    def particles_in_rect(self, lo, hi):
+        """Particles whose centers lie in the x/y rectangle lo..hi (e.g. the screen)."""
+        return [self.particles[int(row)] for row in self.spatial.in_rect(lo, hi)]
+
+    def remove(self, particle):
+        """Remove a particle from the universe (and from the meteor list)."""
+        if particle in self.particles:
+            self.particles.remove_pid(particle._pid)
+        self.meteors.discard(particle._pid)
+
+    def remove_pid(self, pid):
+        """Remove the live particle with this stable id in O(1)."""
+        self.remove(Particle.view(self.particles, pid))
+
+    # -------------------------------------------------------------------------
+    # Object Creation
+    # -------------------------------------------------------------------------
+    def create_particle_from_dict(self, specs, stable=False, p_type="user", fixed=False):
+        name = specs["name"]
+        color = specs["color"]
+        pos = np.array(specs["pos"], dtype=np.float64)
+        velocity = specs.get("velocity", np.array([0, 0]))
+        mass = specs["mass"] * MASS_SCALE
+        visual_radius = specs["radius"]
+        spin = specs.get("spin", 0)
+        return self.particles.add(name, pos, mass, velocity, 0, color, visual_radius,
+                                  fixed, spin, stable, p_type)
+
+    def create_real_solar_system(self):
+        # Create the Sun (ensure its position is 3D)
+        for body in REAL_SOLAR_SYSTEM:
+            if body["name"] == "Sun":
+                specs = body.copy()
+                # Convert 2D pos to 3D: add a 0 for z.
+                pos_2d = np.array(specs["pos"], dtype=np.float64)
+                specs["pos"] = np.concatenate((pos_2d, [0]))
+                self.create_particle_from_dict(specs, stable=True, p_type="system", fixed=True)
+
+        # Create orbiting bodies (planets)
+        sun = next((b for b in REAL_SOLAR_SYSTEM if b["name"] == "Sun"), None)
+        if sun is None:
+            return
+        sun_pos_2d = np.array(sun["pos"], dtype=np.float64)
+        sun_pos = np.concatenate((sun_pos_2d, [0]))
+        sun_mass = sun["mass"]
+
+        for body in REAL_SOLAR_SYSTEM:
+            if body["name"] != "Sun":
+                angle = self.random.uniform(0, 2 * PI)
+                distance = body["distance"]
+                # Create a 3D position; z can be 0 or a small random offset if desired.
+                pos_2d = np.array([sun_pos[0] + distance * math.cos(angle),
+                                   sun_pos[1] + distance * math.sin(angle)], dtype=np.float64)
+                pos = np.concatenate((pos_2d, [0]))  # 3D position
+                v_mag = math.sqrt(self.G * sun_mass * MASS_SCALE / (distance + EPSILON))
+                velocity_2d = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
+                velocity = np.concatenate((velocity_2d, [0]))
+                specs = {
+                    "name": body["name"],
+                    "mass": body["mass"],
+                    "radius": body["radius"],
+                    "color": body["color"],
+                    "pos": pos,
+                    "velocity": velocity,
+                    "spin": 0
+                }
+                self.create_particle_from_dict(specs, stable=True, p_type="system")
+
+    def create_solar_system(self, center, sys_velocity, num_planets=PLANETS_PER_SYSTEM):
+        rnd = self.random
+        # Use a simple scaling factor; here we assume distances are given in pixels.
+        solar_distance_factor = 1.0  # Direct pixel values for orbit radii.
+        sun_color = (255, 255, 0)
+        sun_mass = 1.989e30  # SI units
+        sun_radius = 50
+
+        # Ensure center and sys_velocity are 3D vectors.
+        center = as_vec3(center)
+        sys_velocity = as_vec3(sys_velocity)
+
+        sun = {
+            "name": f"Sun-{rnd.randint(0,1000)}",
+            "mass": sun_mass,
+            "radius": sun_radius,
+            "color": sun_color,
+            "pos": center,
+            "velocity": sys_velocity,
+            "spin": 0
+        }
+        self.create_particle_from_dict(sun, stable=True, p_type="system")
+
+        # Use fixed orbital distances for stability (e.g., evenly spaced).
+        base_distances = np.linspace(200, 600, num_planets)  # in pixels
+        for i in range(num_planets):
+            distance = base_distances[i] * solar_distance_factor
+            angle = rnd.uniform(0, 2 * PI)
+            pos_2d = np.array([center[0] + distance * math.cos(angle),
+                               center[1] + distance * math.sin(angle)], dtype=np.float64)
+            pos = np.concatenate((pos_2d, [0]))  # 3D position; z = 0 initially.
+            r = np.linalg.norm(pos - center)
+            # Circular orbit: v = sqrt(G * M_sun / r)
+            # Use the effective gravitational constant.
+            v_mag = math.sqrt(self.G * sun_mass * MASS_SCALE / (r + EPSILON))
+            vel_2d = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
+            velocity = np.concatenate((vel_2d, [0])) + sys_velocity
+            planet = {
+                "name": f"Planet-{rnd.randint(0,1000)}",
+                "mass": rnd.uniform(1e24, 5e24),
+                "radius": rnd.uniform(5,15),
+                "color": rnd.choice(preset_colors),
+                "pos": pos,
+                "velocity": velocity * 15,
+                "spin": 0
+            }
+            self.create_particle_from_dict(planet, stable=True, p_type="system")
+
+    def create_galaxy(self, galaxy_center, num_systems=SYSTEMS_PER_GALAXY, galaxy_radius=500e6):
+        for i in range(num_systems):
+            angle = self.random.uniform(0, 2 * PI)
+            distance = self.random.uniform(0.2, 1.0) * galaxy_radius * AU_TO_PIXELS
+            sys_center = np.array([galaxy_center[0] + distance * math.cos(angle),
+                                   galaxy_center[1] + distance * math.sin(angle)], dtype=np.float64)
+            r = np.linalg.norm(sys_center - np.array(galaxy_center))
+            v_mag = math.sqrt(self.G * 1e40 / (r + EPSILON))
+            sys_velocity = np.array([-math.sin(angle), math.cos(angle)]) * v_mag
+            self.create_solar_system(sys_center, sys_velocity)
+
+    def create_galaxies(self, num_galaxies=NUM_GALAXIES):
+        for i in range(num_galaxies):
+            galaxy_center = (self.random.uniform(WIDTH * 0.2, WIDTH * 0.8),
+                             self.random.uniform(HEIGHT * 0.2, HEIGHT * 0.8))
+            self.create_galaxy(galaxy_center)
+
+    def create_asteroids(self, count):
+        rnd = self.random
+        for _ in range(count):
+            pos = np.array([rnd.uniform(0, WIDTH), rnd.uniform(0, HEIGHT)], dtype=np.float64)
+            mass = rnd.uniform(50, 1000) * MASS_SCALE
+            velocity = np.array([rnd.uniform(-0.5, 0.5), rnd.uniform(-0.5, 0.5)])
+            color = (rnd.randint(100,255), rnd.randint(100,255), rnd.randint(100,255))
+            visual_radius = rnd.uniform(3,8)
+            self.particles.add("Asteroid", pos, mass, velocity, 0, color, visual_radius)
+
+    def create_random_particle(self, position):
+        rnd = self.random
+        pos = as_vec3(position)
+        sun = self.find_sun()
+        if sun:
+            r_vec = pos - sun.position
+            r = np.linalg.norm(r_vec)
+            if r > EPSILON:
+                angle = math.atan2(r_vec[1], r_vec[0])
+                v_mag = math.sqrt(self.G * sun.mass / (r + EPSILON))
+                velocity = np.array([-math.sin(angle), math.cos(angle), 0]) * v_mag
+            else:
+                velocity = np.array([0, 0, 0])
+        else:
+            velocity = np.array([rnd.uniform(-0.5, 0.5), rnd.uniform(-0.5, 0.5), 0])
+        mass = rnd.uniform(50, 1000) * MASS_SCALE
+        color = (rnd.randint(100, 255), rnd.randint(100, 255), rnd.randint(100, 255))
+        visual_radius = rnd.uniform(5, 20)
+        spec = {
+            "name": "Custom",
+            "mass": mass / MASS_SCALE,
+            "radius": visual_radius,
+            "color": color,
+            "pos": pos,
+            "velocity": velocity,
+            "spin": 0
+        }
+        return self.create_particle_from_dict(spec)
+
+    def create_random_light(self, position):
+        self.lights.append(position)
+
+    # -------------------------------------------------------------------------
+    # God Mode Actions
+    # -------------------------------------------------------------------------
+    def cosmic_storm(self, strength=5):
+        """Give every particle a random velocity impulse."""
+        for p in self.particles:
+            impulse = np.array([self.random.uniform(-strength, strength) for _ in range(3)])
+            p.velocity += impulse
+
+    def randomize(self):
+        """Scatter every particle to a random position with a random velocity."""
+        rnd = self.random
+        for p in self.particles:
+            p.position = [rnd.uniform(0, WIDTH), rnd.uniform(0, HEIGHT), rnd.uniform(-HEIGHT / 2, HEIGHT / 2)]
+            p.velocity = [rnd.uniform(-1, 1), rnd.uniform(-1, 1), rnd.uniform(-1, 1)]
+
+    def collision_burst(self, position, count=20):
+        """Spawn a cluster of fast small bodies around position."""
+        rnd = self.random
+        pos = np.asarray(position, dtype=np.float64)[:2]
+        for i in range(count):
+            offset = np.array([rnd.uniform(-20,20), rnd.uniform(-20,20)])
+            p_spec = {
+                "name": f"Burst-{i}",
+                "mass": rnd.uniform(1e22,1e23),
+                "radius": rnd.uniform(5,10),
+                "color": rnd.choice(preset_colors),
+                "pos": pos + offset,
+                "velocity": np.array([rnd.uniform(-3,3), rnd.uniform(-3,3)]),
+                "spin": 0
+            }
+            self.create_particle_from_dict(p_spec)
+
+    # -------------------------------------------------------------------------
+    # Meteor (Defense) Mode
+    # -------------------------------------------------------------------------
+    def start_defense(self):
+        self.defense_score = 0
+        self.meteors.reserve(self.particles)
+
+    def spawn_meteors(self, now, count):
+        """
+        Spawn up to count meteors at the screen edges, each heading for a
+        random stable system body, with one batched add. Returns their pids.
+        """
+        particles = self.particles
+        count = min(count, self.meteors.size - len(self.meteors))
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+        rnd = self.random
+        targets = self.meteors.target_pids(particles)
+        pos = np.zeros((count, 3))
+        velocity = np.zeros((count, 3))
+        mass = np.empty(count)
+        radius = np.empty(count)
+        for i in range(count):
+            edge = rnd.choice(["top", "bottom", "left", "right"])
+            if edge == "top":
+                pos[i, :2] = rnd.uniform(0, WIDTH), 0
+            elif edge == "bottom":
+                pos[i, :2] = rnd.uniform(0, WIDTH), HEIGHT
+            elif edge == "left":
+                pos[i, :2] = 0, rnd.uniform(0, HEIGHT)
+            else:
+                pos[i, :2] = WIDTH, rnd.uniform(0, HEIGHT)
+            direction = np.zeros(3)
+            if targets.shape[0]:
+                target = particles.row_of[targets[rnd.randrange(targets.shape[0])]]
+                direction = particles.pos[target] - pos[i]
+                norm = np.linalg.norm(direction)
+                direction = direction / norm if norm > EPSILON else np.zeros(3)
+            speed = rnd.uniform(0, 0.00005) + (self.defense_level * 0.00005)
+            velocity[i] = direction * speed
+            mass[i] = rnd.uniform(1e22, 1e23)
+            radius[i] = rnd.uniform(60, 100)  # Larger meteor radius for visibility.
+        pids = particles.add_many(pos, mass, velocity, colors=(255, 100, 0), radii=radius,
+                                  names="Meteor", p_type="meteor")
+        particles.spawn_time[particles.row_of[pids]] = now
+        self.meteors.add(particles, pids, now + METEOR_LIFETIME)
+        return pids
+
+    def spawn_meteor(self, now):
+        pids = self.spawn_meteors(now, 1)
+        return Particle.view(self.particles, int(pids[0])) if pids.shape[0] else None
+
+    def update_defense(self, now):
+        """Spawn, level up and expire meteors; now is wall-clock milliseconds."""
+        with profiler.phase("meteors"):
+            if now - self.last_meteor_spawn > self.meteor_spawn_interval:
+                self.spawn_meteors(now, 1)
+                self.last_meteor_spawn = now
+            if now - self.last_level_up > DEFENSE_LEVEL_INTERVAL:
+                self.defense_level += 1
+                self.meteor_spawn_interval = max(1000, self.meteor_spawn_interval - 200)
+                self.last_level_up = now
+            for pid in self.meteors.expired(self.particles, now):
+                self.particles.remove_pid(pid)
+
+    def shoot(self, point):
+        """Destroy the first meteor covering point; returns True on a hit."""
+        hits = self.covering(point)
+        hits = hits[self.particles.p_type[hits] == p_type_code("meteor")]
+        if hits.shape[0] == 0:
+            return False
+        self.defense_score += 10
+        self.remove(self.particles[int(hits[0])])
+        return True
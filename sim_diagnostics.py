@@ -0,0 +1,309 @@
+"""
+Conservation diagnostics for the Cosmic Deity universe sandbox.
+
+Every `every` steps a Diagnostics object samples the kinetic and potential
+energy, total linear and angular momentum (about the origin) and the virial
+ratio 2K/|W|. Energy drift between samples shows whether a DT or time_speed
+setting is safe. Samples are kept in a rolling history for the HUD and can
+be appended to a CSV time series.
+
+The potential energy follows the active force backend's interaction model
+and reuses its data structures:
+
+    knn         pairs from the neighbour lists the forces use (no rebuild
+                unless the lists are stale anyway)
+    barnes_hut  an octree walk, O(N log N), built with the force kernels'
+                octree code
+    direct      the exact pairwise sum
+
+Pair energies use the same softening as the forces, -G m_i m_j / (r + eps).
+
+Only barnes_hut and direct conserve that energy. The knn kernel divides
+each body's summed pull by its own mass and its neighbour sets are not
+mutual, so its pair forces are neither equal and opposite nor derived from
+a potential. knn samples are flagged with conservative = 0 (in the CSV and
+on the HUD); their energy and momentum are a reference only and their
+drift says nothing about whether DT is safe. Switch to barnes_hut or
+direct to judge a timestep.
+
+In float32 precision (Universe.precision) every sample also validates the
+force kernels against the float64 path: the accelerations of the current
+state are evaluated both ways and the largest relative difference is
+reported as accel_error. position_ulp is the float spacing at the largest
+coordinate, the resolution every stored position is rounded to. The
+quantities themselves are always accumulated in float64.
+
+    universe.start_diagnostics(every=10, log_path="energy.csv")
+    universe.step(1000)
+    print(universe.diagnostics.latest)
+"""
+import math
+from collections import deque
+
+import numpy as np
+from numba import jit, prange
+
+from sim_core import (BH_LEAF_SIZE, BH_MAX_DEPTH, DIAGNOSTICS_EVERY, DIRECT_TILE, EPSILON,
+                      build_octree, compute_barnes_hut_accelerations,
+                      compute_direct_accelerations, compute_knn_accelerations,
+                      octree_body_order)
+
+HISTORY = 600               # Samples kept for the HUD
+CONSERVATIVE_BACKENDS = ("barnes_hut", "direct")    # Backends whose dynamics conserve energy
+COLUMNS = ("step", "time", "kinetic", "potential", "energy", "px", "py", "pz",
+           "lx", "ly", "lz", "virial", "accel_error", "position_ulp", "conservative")
+
+
+# =============================================================================
+# Potential Energy Kernels (JIT-compiled)
+# =============================================================================
+@jit(nopython=True, parallel=True, cache=True)
+def neighbor_potential(pos, mass, offsets, indices, k, G_val, eps):
+    """
+    Potential energy of the pairs the knn backend couples: every body with
+    its k - 1 nearest candidates from the CSR lists, each directed pair
+    counted at half weight.
+    """
+    n = pos.shape[0]
+    m = k - 1
+    partial = np.zeros(n)
+    for i in prange(n):
+        if m <= 0:
+            continue
+        best_d2 = np.full(m, np.inf)
+        best_j = np.full(m, -1, dtype=np.int64)
+        for p in range(offsets[i], offsets[i + 1]):
+            j = indices[p]
+            if j == i:
+                continue
+            d0 = pos[j, 0] - pos[i, 0]
+            d1 = pos[j, 1] - pos[i, 1]
+            d2 = pos[j, 2] - pos[i, 2]
+            r2 = d0 * d0 + d1 * d1 + d2 * d2
+            if r2 >= best_d2[m - 1]:
+                continue
+            q = m - 1
+            while q > 0 and best_d2[q - 1] > r2:
+                best_d2[q] = best_d2[q - 1]
+                best_j[q] = best_j[q - 1]
+                q -= 1
+            best_d2[q] = r2
+            best_j[q] = j
+        total = 0.0
+        for q in range(m):
+            j = best_j[q]
+            if j == -1:
+                break
+            total += mass[j] / (math.sqrt(best_d2[q]) + eps)
+        partial[i] = -0.5 * G_val * mass[i] * total
+    return partial.sum()
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def barnes_hut_potential(pos, mass, G_val, eps, theta, max_depth, leaf_size):
+    """Potential energy from the same octree and opening rule as the Barnes-Hut forces."""
+    n = pos.shape[0]
+    if n == 0:
+        return 0.0
+    child, first_body, next_body, center, half, com, node_mass = build_octree(
+        pos, mass, max_depth, leaf_size)
+    if theta > 0.0:
+        open_r2 = (2.0 * half / theta) ** 2
+    else:
+        open_r2 = np.full(half.shape[0], np.inf)
+    order = octree_body_order(child, first_body, next_body, max_depth)
+    stack_size = 8 * (max_depth + 2)
+    partial = np.zeros(n)
+    for k in prange(n):
+        i = order[k]
+        px = pos[i, 0]
+        py = pos[i, 1]
+        pz = pos[i, 2]
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        phi = 0.0
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            d0 = com[node, 0] - px
+            d1 = com[node, 1] - py
+            d2 = com[node, 2] - pz
+            r2 = d0 * d0 + d1 * d1 + d2 * d2
+            h = half[node]
+            if (r2 > open_r2[node] and
+                    (abs(px - center[node, 0]) > h or abs(py - center[node, 1]) > h or
+                     abs(pz - center[node, 2]) > h)):
+                phi += node_mass[node] / (math.sqrt(r2) + eps)
+                continue
+            b = first_body[node]
+            if b != -1:
+                while b != -1:
+                    if b != i:
+                        d0 = pos[b, 0] - px
+                        d1 = pos[b, 1] - py
+                        d2 = pos[b, 2] - pz
+                        phi += mass[b] / (math.sqrt(d0 * d0 + d1 * d1 + d2 * d2) + eps)
+                    b = next_body[b]
+                continue
+            for o in range(8):
+                c = child[node, o]
+                if c != -1 and node_mass[c] != 0.0:
+                    stack[top] = c
+                    top += 1
+        partial[i] = -0.5 * G_val * mass[i] * phi
+    return partial.sum()
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def direct_potential(pos, mass, G_val, eps):
+    """Exact potential energy over all pairs; pairs at zero separation are skipped."""
+    n = pos.shape[0]
+    partial = np.zeros(n)
+    for i in prange(n):
+        total = 0.0
+        for j in range(i + 1, n):
+            d0 = pos[j, 0] - pos[i, 0]
+            d1 = pos[j, 1] - pos[i, 1]
+            d2 = pos[j, 2] - pos[i, 2]
+            r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+            if r > 0.0:
+                total += mass[j] / (r + eps)
+        partial[i] = -G_val * mass[i] * total
+    return partial.sum()
+
+
+def potential_energy(universe, pos, mass):
+    """Potential energy under universe's active force backend."""
+    if universe.force_backend == "barnes_hut":
+        return barnes_hut_potential(pos, mass, universe.G, EPSILON, universe.bh_theta,
+                                    BH_MAX_DEPTH, BH_LEAF_SIZE)
+    if universe.force_backend == "direct":
+        return direct_potential(pos, mass, universe.G, EPSILON)
+    offsets, indices = universe.neighbors.update(universe.particles, pos)
+    k = min(universe.neighbors.k, pos.shape[0])
+    return neighbor_potential(pos, mass, offsets, indices, k, universe.G, EPSILON)
+
+
+# =============================================================================
+# Precision
+# =============================================================================
+def reference_accelerations(universe, pos, mass, fixed):
+    """The active backend's accelerations with the state pos, mass promoted to float64."""
+    pos64 = pos.astype(np.float64)
+    mass64 = mass.astype(np.float64)
+    if universe.force_backend == "barnes_hut":
+        return compute_barnes_hut_accelerations(pos64, mass64, fixed, universe.G, EPSILON,
+                                                universe.bh_theta, BH_MAX_DEPTH, BH_LEAF_SIZE)
+    if universe.force_backend == "direct":
+        return compute_direct_accelerations(pos64, mass64, fixed, universe.G, EPSILON, DIRECT_TILE)
+    offsets, indices = universe.neighbors.update(universe.particles, pos)
+    k = min(universe.neighbors.k, pos.shape[0])
+    return compute_knn_accelerations(pos64, mass64, fixed, offsets, indices, k, universe.G, EPSILON)
+
+
+def precision_error(universe):
+    """
+    (accel_error, position_ulp) of the current state: the largest relative
+    difference between the accelerations at the universe's precision and in
+    float64, and the spacing of the stored positions at the largest
+    coordinate. accel_error is 0 in float64.
+    """
+    particles = universe.particles
+    n = particles.n
+    pos = particles.pos[:n]
+    if n == 0:
+        return 0.0, 0.0
+    position_ulp = float(np.spacing(np.abs(pos).max()))
+    if universe.precision == "float64" or n < 2:
+        return 0.0, position_ulp
+    mass = particles.mass[:n]
+    fixed = particles.fixed[:n]
+    acc = universe.compute_accelerations(pos, mass, fixed)
+    ref = reference_accelerations(universe, pos, mass, fixed)
+    norm = np.sqrt((ref * ref).sum(axis=1))
+    moving = norm > 0
+    error = np.sqrt(((acc - ref) ** 2).sum(axis=1))[moving] / norm[moving]
+    return (float(error.max()) if error.shape[0] else 0.0), position_ulp
+
+
+# =============================================================================
+# Sampling
+# =============================================================================
+def measure(universe):
+    """One sample of the conservation quantities as a dict keyed by COLUMNS (without step)."""
+    particles = universe.particles
+    n = particles.n
+    pos = particles.pos[:n]
+    mass = particles.mass[:n]
+    potential = float(potential_energy(universe, pos, mass)) if n > 1 else 0.0
+    # Sums and products in float64 whatever the storage precision.
+    pos = pos.astype(np.float64, copy=False)
+    vel = particles.vel[:n].astype(np.float64, copy=False)
+    mass = mass.astype(np.float64, copy=False)
+    kinetic = 0.5 * float(np.einsum("i,ij,ij->", mass, vel, vel))
+    momentum = mass @ vel
+    angular = mass @ np.cross(pos, vel)
+    accel_error, position_ulp = precision_error(universe)
+    return {
+        "time": universe.simulation_time,
+        "kinetic": kinetic,
+        "potential": potential,
+        "energy": kinetic + potential,
+        "px": float(momentum[0]), "py": float(momentum[1]), "pz": float(momentum[2]),
+        "lx": float(angular[0]), "ly": float(angular[1]), "lz": float(angular[2]),
+        "virial": 2.0 * kinetic / abs(potential) if potential else math.nan,
+        "accel_error": accel_error,
+        "position_ulp": position_ulp,
+        "conservative": int(universe.force_backend in CONSERVATIVE_BACKENDS),
+    }
+
+
+class Diagnostics:
+    """Samples measure() every `every` steps into a rolling history and an optional CSV log."""
+
+    def __init__(self, every=DIAGNOSTICS_EVERY, log_path=None, history=HISTORY):
+        self.every = max(1, int(every))
+        self.samples = deque(maxlen=history)
+        self.steps = 0
+        self.initial_energy = None
+        self.log = None
+        if log_path is not None:
+            self.log = open(log_path, "w")
+            self.log.write(",".join(COLUMNS) + "\n")
+
+    @property
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def observe(self, universe):
+        """Count one step of universe; samples on every `every`-th step."""
+        step = self.steps
+        self.steps += 1
+        if step % self.every == 0:
+            sample = measure(universe)
+            sample["step"] = step
+            self.record(sample)
+
+    def record(self, sample):
+        if self.initial_energy is None:
+            self.initial_energy = sample["energy"]
+        self.samples.append(sample)
+        if self.log is not None:
+            self.log.write(",".join(repr(sample[c]) for c in COLUMNS) + "\n")
+            self.log.flush()
+
+    def drift(self, sample=None):
+        """
+        Relative energy change of sample (default: the latest) since the
+        first sample. Only meaningful while samples are conservative.
+        """
+        sample = sample or self.latest
+        if sample is None or not self.initial_energy:
+            return 0.0
+        return (sample["energy"] - self.initial_energy) / abs(self.initial_energy)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
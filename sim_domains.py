@@ -0,0 +1,557 @@
+"""
+Multi-process spatial domain decomposition for large headless runs.
+
+A DomainPool farms the force evaluations of a Universe out to worker
+processes, one domain each. Domains are contiguous runs of bodies along a
+Morton (Z-order) curve, split so that every worker has about the same
+measured cost. An evaluation runs in two phases, separated by barriers:
+
+    1. Each worker builds a Barnes-Hut octree over its own bodies and
+       publishes to shared memory its bodies in tree order and a summary
+       of the tree: the top `summary_nodes` cells with their centre of
+       mass, size and the range of bodies below them.
+    2. Each worker walks its own full tree and the summaries of all other
+       domains with the Barnes-Hut opening rule. Summary cells that are too
+       close to accept are opened into their bodies (the halo) read
+       straight from shared memory. The accelerations go back to shared
+       memory by row.
+
+The stepping itself (drift, kick, collisions) stays in the calling process.
+Merges and spawns change the rows; the domains are then remapped by pid.
+Every REBALANCE_EVERY evaluations, or when the slowest domain falls more
+than REBALANCE_IMBALANCE behind the mean, the bodies are re-sorted along the
+curve and the domains re-split by cost.
+
+The barnes_hut backend uses the pool with its bh_theta. The direct backend
+uses it with theta = 0, which opens every cell and gives the exact sum. The
+knn backend's forces are local and it stays in process (its kernel is
+already thread-parallel).
+
+    universe = generate("plummer", 2_000_000, seed=1)
+    universe.force_backend = "barnes_hut"
+    universe.start_domains()        # one process per available core
+    universe.step(100)
+    universe.stop_domains()
+"""
+import math
+import multiprocessing as mp
+import os
+import secrets
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from numba import jit
+
+from sim_core import BH_LEAF_SIZE, BH_MAX_DEPTH, build_octree
+
+# =============================================================================
+# Parameters
+# =============================================================================
+SUMMARY_NODES = 4096        # Tree cells each domain publishes for the others
+REBALANCE_EVERY = 50        # Evaluations between re-sorts along the Morton curve
+REBALANCE_IMBALANCE = 1.25  # Re-sort early when the slowest domain exceeds the mean by this
+REBALANCE_MIN = 5           # ... but not more often than every this many evaluations
+MIN_CAPACITY = 1 << 16      # Bodies in the first generation of shared arrays
+BARRIER_TIMEOUT = 600.0     # Seconds to wait for the workers (first calls compile)
+
+# Control block slots (a shared int64 array), followed by the P + 1 domain
+# bounds and the P summary node counts.
+COMMAND, GENERATION, CAPACITY, COUNT = range(4)
+CONTROL_SLOTS = 4
+EVALUATE, STOP = range(2)
+# Parameter slots (a shared float64 array), followed by the P domain times.
+P_G, P_EPS, P_THETA = range(3)
+PARAM_SLOTS = 3
+
+
+# =============================================================================
+# Tree Kernels (JIT-compiled, one core per worker)
+# =============================================================================
+@jit(nopython=True, cache=True)
+def octree_ranges(child, first_body, next_body):
+    """
+    Depth-first body order of an octree from build_octree, with the range
+    [start, end) of that order below every node.
+    """
+    n_nodes = child.shape[0]
+    size = np.zeros(n_nodes, dtype=np.int64)
+    for node in range(n_nodes - 1, -1, -1):
+        s = 0
+        b = first_body[node]
+        while b != -1:
+            s += 1
+            b = next_body[b]
+        for o in range(8):
+            c = child[node, o]
+            if c != -1:
+                s += size[c]
+        size[node] = s
+    start = np.zeros(n_nodes, dtype=np.int64)
+    order = np.empty(next_body.shape[0], dtype=np.int64)
+    # Parents come before children, so every start is known when its node comes up.
+    for node in range(n_nodes):
+        k = start[node]
+        b = first_body[node]
+        while b != -1:
+            order[k] = b
+            k += 1
+            b = next_body[b]
+        for o in range(8):
+            c = child[node, o]
+            if c != -1:
+                start[c] = k
+                k += size[c]
+    return order, start, start + size
+
+
+@jit(nopython=True, cache=True)
+def summarize_octree(child, center, half, com, node_mass, start, end, body_base, node_base,
+                     s_child, s_center, s_half, s_com, s_mass, s_start, s_end):
+    """
+    Copies the top of an octree, breadth first, into the s_* arrays (as many
+    nodes as they hold). A node's children are taken all or none; nodes
+    without children in the summary keep their body range and are opened
+    into bodies. Body ranges are offset by body_base and child indices by
+    node_base. Returns the number of nodes written.
+    """
+    capacity = s_half.shape[0]
+    source = np.empty(capacity, dtype=np.int64)
+    source[0] = 0
+    count = 1
+    for q in range(capacity):
+        if q == count:
+            break
+        node = source[q]
+        for d in range(3):
+            s_center[q, d] = center[node, d]
+            s_com[q, d] = com[node, d]
+        s_half[q] = half[node]
+        s_mass[q] = node_mass[node]
+        s_start[q] = start[node] + body_base
+        s_end[q] = end[node] + body_base
+        for o in range(8):
+            s_child[q, o] = -1
+        k = 0
+        for o in range(8):
+            if child[node, o] != -1:
+                k += 1
+        if k == 0 or count + k > capacity:
+            continue
+        for o in range(8):
+            c = child[node, o]
+            if c != -1:
+                s_child[q, o] = node_base + count
+                source[count] = c
+                count += 1
+    return count
+
+
+@jit(nopython=True, cache=True)
+def tree_accelerations(spos, smass, fixed, lo, hi, roots, child, center, half, com, node_mass,
+                       start, end, G_val, eps, theta, max_depth, acc):
+    """
+    Adds to acc[k - lo] the acceleration on body k of spos (lo <= k < hi,
+    skipping fixed ones) from the trees under roots, with the opening rule
+    of compute_barnes_hut_accelerations. Cells without children are summed
+    directly over their body range of spos.
+    """
+    stack = np.empty(8 * (max_depth + 2), dtype=np.int64)
+    for k in range(lo, hi):
+        if fixed[k - lo]:
+            continue
+        px = spos[k, 0]
+        py = spos[k, 1]
+        pz = spos[k, 2]
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+        for r in range(roots.shape[0]):
+            stack[0] = roots[r]
+            top = 1
+            while top > 0:
+                top -= 1
+                node = stack[top]
+                if node_mass[node] == 0.0:
+                    continue
+                d0 = com[node, 0] - px
+                d1 = com[node, 1] - py
+                d2 = com[node, 2] - pz
+                r2 = d0 * d0 + d1 * d1 + d2 * d2
+                h = half[node]
+                if (theta > 0.0 and 4.0 * h * h < theta * theta * r2 and
+                        (abs(px - center[node, 0]) > h or abs(py - center[node, 1]) > h or
+                         abs(pz - center[node, 2]) > h)):
+                    dist = math.sqrt(r2) + eps
+                    scale = G_val * node_mass[node] / (dist * dist * dist)
+                    ax += scale * d0
+                    ay += scale * d1
+                    az += scale * d2
+                    continue
+                leaf = True
+                for o in range(8):
+                    c = child[node, o]
+                    if c != -1:
+                        leaf = False
+                        stack[top] = c
+                        top += 1
+                if not leaf:
+                    continue
+                for b in range(start[node], end[node]):
+                    if b != k:
+                        d0 = spos[b, 0] - px
+                        d1 = spos[b, 1] - py
+                        d2 = spos[b, 2] - pz
+                        dist = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2) + eps
+                        scale = G_val * smass[b] / (dist * dist * dist)
+                        ax += scale * d0
+                        ay += scale * d1
+                        az += scale * d2
+        acc[k - lo, 0] += ax
+        acc[k - lo, 1] += ay
+        acc[k - lo, 2] += az
+
+
+def morton_keys(pos):
+    """63-bit Morton keys of pos on a 2^21 grid over its bounding cube."""
+    lo = pos.min(axis=0)
+    span = float((pos.max(axis=0) - lo).max()) or 1.0
+    grid = ((pos - lo) * (((1 << 21) - 1) / span)).astype(np.uint64)
+    keys = np.zeros(pos.shape[0], dtype=np.uint64)
+    for d in range(3):
+        x = grid[:, d]
+        for shift, mask in ((32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF),
+                            (8, 0x100F00F00F00F00F), (4, 0x10C30C30C30C30C3),
+                            (2, 0x1249249249249249)):
+            x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+        keys |= x << np.uint64(d)
+    return keys
+
+
+# =============================================================================
+# Shared Memory Layout
+# =============================================================================
+def domain_layout(capacity, processes, summary_nodes):
+    """(shape, dtype, byte offset) of every shared array, and the total size."""
+    nodes = processes * summary_nodes
+    shapes = (("pos", (capacity, 3), np.float64), ("mass", (capacity,), np.float64),
+              ("fixed", (capacity,), np.bool_), ("assign", (capacity,), np.int64),
+              ("spos", (capacity, 3), np.float64), ("smass", (capacity,), np.float64),
+              ("acc", (capacity, 3), np.float64),
+              ("s_child", (nodes, 8), np.int64), ("s_center", (nodes, 3), np.float64),
+              ("s_half", (nodes,), np.float64), ("s_com", (nodes, 3), np.float64),
+              ("s_mass", (nodes,), np.float64), ("s_start", (nodes,), np.int64),
+              ("s_end", (nodes,), np.int64))
+    layout = {}
+    offset = 0
+    for name, shape, dtype in shapes:
+        layout[name] = (shape, dtype, offset)
+        size = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        offset += -(-size // 64) * 64
+    return layout, offset
+
+
+def domain_views(shm, capacity, processes, summary_nodes):
+    layout, _ = domain_layout(capacity, processes, summary_nodes)
+    return {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, (shape, dtype, offset) in layout.items()}
+
+
+def segment_name(prefix, generation):
+    return f"{prefix}_{generation}"
+
+
+# =============================================================================
+# Worker Side
+# =============================================================================
+class DomainWorker:
+    """Runs inside a worker process: builds, publishes and walks one domain per evaluation."""
+
+    def __init__(self, index, processes, summary_nodes, prefix, control, params, barrier):
+        self.index = index
+        self.processes = processes
+        self.summary_nodes = summary_nodes
+        self.prefix = prefix
+        self.control = np.frombuffer(control, dtype=np.int64)
+        self.params = np.frombuffer(params, dtype=np.float64)
+        self.barrier = barrier
+        self.generation = 0
+        self.segment = None
+        self.views = None
+        self.tree = None
+
+    def attach(self):
+        if self.segment is not None:
+            self.views = None
+            self.segment.close()
+        self.generation = int(self.control[GENERATION])
+        self.segment = shared_memory.SharedMemory(name=segment_name(self.prefix, self.generation))
+        self.views = domain_views(self.segment, int(self.control[CAPACITY]), self.processes,
+                                  self.summary_nodes)
+
+    def domain(self):
+        bounds = self.control[CONTROL_SLOTS:CONTROL_SLOTS + self.processes + 1]
+        return int(bounds[self.index]), int(bounds[self.index + 1])
+
+    def build(self):
+        """Phase 1: tree over the domain, bodies in tree order and the summary."""
+        v = self.views
+        lo, hi = self.domain()
+        counts = self.control[CONTROL_SLOTS + self.processes + 1:]
+        counts[self.index] = 0
+        self.tree = None
+        if hi == lo:
+            return
+        rows = v["assign"][lo:hi].copy()
+        pos = v["pos"][rows]
+        mass = v["mass"][rows]
+        child, first_body, next_body, center, half, com, node_mass = build_octree(
+            pos, mass, BH_MAX_DEPTH, BH_LEAF_SIZE)
+        order, start, end = octree_ranges(child, first_body, next_body)
+        self.rows = rows[order]
+        self.fixed = v["fixed"][self.rows]
+        v["assign"][lo:hi] = self.rows
+        v["spos"][lo:hi] = pos[order]
+        v["smass"][lo:hi] = mass[order]
+        base = self.index * self.summary_nodes
+        part = slice(base, base + self.summary_nodes)
+        counts[self.index] = summarize_octree(
+            child, center, half, com, node_mass, start, end, lo, base,
+            v["s_child"][part], v["s_center"][part], v["s_half"][part], v["s_com"][part],
+            v["s_mass"][part], v["s_start"][part], v["s_end"][part])
+        self.tree = (child, center, half, com, node_mass, start + lo, end + lo)
+
+    def walk(self):
+        """Phase 2: accelerations of the domain's bodies from every tree."""
+        if self.tree is None:
+            return
+        v = self.views
+        lo, hi = self.domain()
+        G_val, eps, theta = self.params[P_G], self.params[P_EPS], self.params[P_THETA]
+        acc = np.zeros((hi - lo, 3))
+        tree_accelerations(v["spos"], v["smass"], self.fixed, lo, hi, np.zeros(1, dtype=np.int64),
+                           *self.tree, G_val, eps, theta, BH_MAX_DEPTH, acc)
+        counts = self.control[CONTROL_SLOTS + self.processes + 1:]
+        roots = np.array([e * self.summary_nodes for e in range(self.processes)
+                          if e != self.index and counts[e] > 0], dtype=np.int64)
+        tree_accelerations(v["spos"], v["smass"], self.fixed, lo, hi, roots, v["s_child"],
+                           v["s_center"], v["s_half"], v["s_com"], v["s_mass"], v["s_start"],
+                           v["s_end"], G_val, eps, theta, BH_MAX_DEPTH, acc)
+        v["acc"][self.rows] = acc
+
+    def run(self):
+        times = self.params[PARAM_SLOTS:]
+        try:
+            while True:
+                self.barrier.wait()
+                if self.control[COMMAND] == STOP:
+                    break
+                if self.control[GENERATION] != self.generation:
+                    self.attach()
+                start = time.perf_counter()
+                self.build()
+                built = time.perf_counter() - start
+                self.barrier.wait()
+                start = time.perf_counter()
+                self.walk()
+                times[self.index] = built + time.perf_counter() - start
+                self.barrier.wait()
+        except BaseException:
+            self.barrier.abort()
+            raise
+        finally:
+            self.views = None
+            if self.segment is not None:
+                self.segment.close()
+
+
+def run_domain_worker(index, processes, summary_nodes, prefix, control, params, barrier):
+    """Process entry point."""
+    DomainWorker(index, processes, summary_nodes, prefix, control, params, barrier).run()
+
+
+# =============================================================================
+# Coordinator Side
+# =============================================================================
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:      # Not Linux
+        return os.cpu_count() or 1
+
+
+class DomainPool:
+    """
+    Worker processes plus the shared memory they exchange domains through.
+    accelerations() has the signature of the force kernels and can stand in
+    for them.
+    """
+
+    def __init__(self, processes=None, summary_nodes=SUMMARY_NODES):
+        self.processes = max(1, processes or available_cores())
+        self.summary_nodes = summary_nodes
+        self.workers = []
+        self.segment = None
+        self.views = None
+        self.generation = 0
+        self.capacity = 0
+        self.n = 0                  # Bodies in the current assignment
+        self.store = None
+        self.version = -1
+        self.row_pid = None         # pid of every row when the assignment was made
+        self.evaluations = 0
+        self.since_sort = 0
+        self.rebalances = 0
+
+    # -------------------------------------------------------------------------
+    # Process lifecycle
+    # -------------------------------------------------------------------------
+    def start(self):
+        ctx = mp.get_context("spawn")
+        p = self.processes
+        self.prefix = f"udom{os.getpid()}_{secrets.token_hex(3)}"
+        self.control_array = ctx.RawArray("q", CONTROL_SLOTS + 2 * p + 1)
+        self.params_array = ctx.RawArray("d", PARAM_SLOTS + p)
+        self.control = np.frombuffer(self.control_array, dtype=np.int64)
+        self.params = np.frombuffer(self.params_array, dtype=np.float64)
+        self.bounds = self.control[CONTROL_SLOTS:CONTROL_SLOTS + p + 1]
+        self.times = self.params[PARAM_SLOTS:]
+        self.barrier = ctx.Barrier(p + 1)
+        self.workers = [ctx.Process(target=run_domain_worker, name=f"domain-worker-{i}",
+                                    daemon=True,
+                                    args=(i, p, self.summary_nodes, self.prefix,
+                                          self.control_array, self.params_array, self.barrier))
+                        for i in range(p)]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self, timeout=10.0):
+        if self.workers:
+            self.control[COMMAND] = STOP
+            try:
+                self.barrier.wait(timeout)
+            except threading.BrokenBarrierError:
+                pass
+            for worker in self.workers:
+                worker.join(timeout)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+            self.workers = []
+        self.release()
+
+    def release(self):
+        self.views = None
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+    def allocate(self, capacity):
+        """A new generation of shared arrays; the assignment is carried over."""
+        _, size = domain_layout(capacity, self.processes, self.summary_nodes)
+        generation = self.generation + 1
+        segment = shared_memory.SharedMemory(name=segment_name(self.prefix, generation),
+                                             create=True, size=size)
+        views = domain_views(segment, capacity, self.processes, self.summary_nodes)
+        if self.views is not None:
+            views["assign"][:self.n] = self.views["assign"][:self.n]
+        self.release()
+        self.segment, self.views = segment, views
+        self.generation, self.capacity = generation, capacity
+        self.control[GENERATION] = generation
+        self.control[CAPACITY] = capacity
+
+    def wait(self):
+        try:
+            self.barrier.wait(BARRIER_TIMEOUT)
+        except threading.BrokenBarrierError:
+            dead = [w.name for w in self.workers if not w.is_alive()]
+            raise RuntimeError(f"domain workers failed (stopped: {dead or 'none'})") from None
+
+    # -------------------------------------------------------------------------
+    # Domains
+    # -------------------------------------------------------------------------
+    def remap(self, store, n):
+        """Carry the domains over a change of rows (merges, spawns, removals) by pid."""
+        assign = self.views["assign"]
+        new_rows = store.row_of[self.row_pid[assign[:self.n]]]
+        alive = new_rows >= 0
+        domain = np.repeat(np.arange(self.processes), np.diff(self.bounds))
+        counts = np.bincount(domain[alive], minlength=self.processes)
+        covered = np.zeros(n, dtype=bool)
+        covered[new_rows[alive]] = True
+        added = np.flatnonzero(~covered)
+        counts[-1] += added.shape[0]
+        assign[:n] = np.concatenate([new_rows[alive], added])
+        self.bounds[0] = 0
+        np.cumsum(counts, out=self.bounds[1:])
+
+    def rebalance(self, pos, n, weighted):
+        """Sort the bodies along the Morton curve and cut it into domains of equal cost."""
+        assign = self.views["assign"]
+        order = np.argsort(morton_keys(pos), kind="stable")
+        cost = np.ones(n)
+        if weighted:
+            # Per-body cost of each domain from its last measured time.
+            counts = np.diff(self.bounds)
+            per_body = self.times / np.maximum(counts, 1)
+            cost[assign[:n]] = np.repeat(per_body, counts)
+        total = np.cumsum(cost[order])
+        cuts = np.searchsorted(total, total[-1] * np.arange(1, self.processes) / self.processes)
+        assign[:n] = order
+        self.bounds[0] = 0
+        self.bounds[1:-1] = cuts
+        self.bounds[-1] = n
+        self.since_sort = 0
+        self.rebalances += 1
+
+    def place(self, store, pos):
+        """Domains for the rows of store: remapped if the rows changed, re-sorted when due."""
+        n = pos.shape[0]
+        if self.store is not store or self.n == 0:
+            self.rebalance(pos, n, weighted=False)
+        else:
+            if store.version != self.version or n != self.n:
+                self.remap(store, n)
+            if (self.since_sort >= REBALANCE_EVERY or
+                    (self.since_sort >= REBALANCE_MIN and self.imbalance() > REBALANCE_IMBALANCE)):
+                self.rebalance(pos, n, weighted=True)
+        if store.version != self.version or self.store is not store or n != self.n:
+            self.row_pid = store.pid[:n].copy()
+        self.store = store
+        self.version = store.version
+        self.n = n
+
+    def imbalance(self):
+        """Slowest domain time over the mean, from the last evaluation."""
+        return float(self.times.max() / max(self.times.mean(), 1e-12))
+
+    # -------------------------------------------------------------------------
+    # Evaluation
+    # -------------------------------------------------------------------------
+    def accelerations(self, store, pos, mass, fixed, G_val, eps, theta):
+        """Accelerations on the rows of store (given as pos, mass, fixed) computed by the workers."""
+        if not self.workers:
+            raise RuntimeError("DomainPool.start() has not been called")
+        n = pos.shape[0]
+        if n == 0:
+            return np.zeros((0, 3))
+        if n > self.capacity:
+            self.allocate(max(MIN_CAPACITY, 2 * n))
+        self.place(store, pos)
+        v = self.views
+        v["pos"][:n] = pos
+        v["mass"][:n] = mass
+        v["fixed"][:n] = fixed
+        self.params[P_G] = G_val
+        self.params[P_EPS] = eps
+        self.params[P_THETA] = theta
+        self.control[COUNT] = n
+        self.control[COMMAND] = EVALUATE
+        for _ in range(3):      # start, trees published, accelerations written
+            self.wait()
+        self.evaluations += 1
+        self.since_sort += 1
+        return v["acc"][:n].copy()
@@ -0,0 +1,173 @@
+"""
+Lightweight per-phase profiler for the Cosmic Deity universe sandbox.
+
+Code marks its phases with
+
+    with profiler.phase("collisions"):
+        ...
+
+When the profiler is disabled, phase() returns a shared no-op context, so
+the hooks cost one method call. When it is enabled, every phase's self time
+(its duration minus nested phases) is summed per frame. end_frame() pushes
+the totals into a rolling window, and stats() reports the average and p99
+per phase over that window. A recording captures every span as a Chrome
+trace event, and export_trace() writes them as JSON that chrome://tracing
+or Perfetto can open.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+WINDOW = 240                # Frames kept for the rolling statistics
+MAX_TRACE_EVENTS = 500000   # Spans kept per recording (older ones are dropped)
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "start", "children")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.children = 0.0
+
+    def __enter__(self):
+        self.profiler.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        profiler = self.profiler
+        if not profiler.stack or profiler.stack[-1] is not self:
+            return False        # The profiler was reset while this phase ran
+        profiler.stack.pop()
+        duration = end - self.start
+        if profiler.stack:
+            profiler.stack[-1].children += duration
+        frame = profiler.frame
+        frame[self.name] = frame.get(self.name, 0.0) + duration - self.children
+        if profiler.trace is not None:
+            profiler.trace.append((self.name, self.start, duration, threading.get_ident()))
+        return False
+
+
+class Profiler:
+    """Per-phase timings with rolling statistics and optional trace recording."""
+
+    def __init__(self, window=WINDOW, max_trace_events=MAX_TRACE_EVENTS):
+        self.enabled = False
+        self.window = window
+        self.max_trace_events = max_trace_events
+        self.stack = []
+        self.frame = {}         # Self time per phase in the current frame (seconds)
+        self.history = {}       # Phase -> deque of per-frame totals
+        self.frame_times = deque(maxlen=window)
+        self.frame_start = None
+        self.trace = None       # Spans (name, start, duration, thread) while recording
+        self.epoch = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def begin(self, name):
+        """Open a phase around a block too long to indent under with; close it with end()."""
+        span = self.phase(name)
+        span.__enter__()
+        return span
+
+    def end(self, span):
+        span.__exit__(None, None, None)
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.stack = []
+        self.frame = {}
+        self.frame_start = None
+        if not enabled:
+            self.trace = None
+
+    def reset(self):
+        self.frame = {}
+        self.history = {}
+        self.frame_times.clear()
+        self.frame_start = None
+
+    def end_frame(self):
+        """Close the current frame: push its phase totals into the rolling window."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.frame_times.append(now - self.frame_start)
+        self.frame_start = now
+        for name in self.history.keys() | self.frame.keys():
+            history = self.history.get(name)
+            if history is None:
+                history = self.history[name] = deque(maxlen=self.window)
+            history.append(self.frame.get(name, 0.0))
+        self.frame = {}
+
+    def stats(self):
+        """{phase: (avg_ms, p99_ms)} over the rolling window, plus "frame" for whole frames."""
+        result = {}
+        for name, history in self.history.items():
+            ms = np.fromiter(history, dtype=np.float64) * 1000.0
+            result[name] = (float(ms.mean()), float(np.percentile(ms, 99)))
+        if self.frame_times:
+            ms = np.fromiter(self.frame_times, dtype=np.float64) * 1000.0
+            result["frame"] = (float(ms.mean()), float(np.percentile(ms, 99)))
+        return result
+
+    # -------------------------------------------------------------------------
+    # Trace recording
+    # -------------------------------------------------------------------------
+    @property
+    def recording(self):
+        return self.trace is not None
+
+    def start_recording(self):
+        self.enable(True)
+        self.trace = deque(maxlen=self.max_trace_events)
+
+    def stop_recording(self):
+        """Stop recording and return the captured spans."""
+        trace, self.trace = self.trace, None
+        return list(trace or ())
+
+    def export_trace(self, path, spans=None):
+        """
+        Write spans (by default the current recording) in the Chrome trace
+        event format as complete ("X") events with microsecond timestamps.
+        """
+        if spans is None:
+            spans = list(self.trace or ())
+        pid = os.getpid()
+        events = [{"name": name, "cat": "sim", "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - self.epoch) * 1e6, "dur": duration * 1e6}
+                  for name, start, duration, tid in spans]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+# Shared by sim_core and the front-end, so all phases land in one timeline.
+profiler = Profiler()
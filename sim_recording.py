@@ -0,0 +1,227 @@
+"""
+Trajectory recording and physics-free replay for the Cosmic Deity sandbox.
+
+A TrajectoryRecorder appends one frame per recorded step to a file. Each
+frame holds the pid, position, radius and colour of every live body at that
+step. The body count may differ from frame to frame (merges, meteor
+spawns). Recording can be decimated (every k-th step) and positions can be
+stored as float32. Frames are collected in chunks and appended with one
+write each; nothing already written is ever rewritten. The file layout is
+
+    magic (8 bytes) | format version (uint32) | header length (uint32)
+    | JSON header | padding | frame | frame | ...
+
+and each frame is
+
+    frame magic | count | step | simulation time | column blocks (8-byte aligned)
+
+A TrajectoryReader memory-maps the file and indexes the frame offsets. A
+frame's columns are views into the mapping, so a replay only touches the
+pages of the frames it shows. refresh() picks up frames appended since the
+last call, which allows following a recording that is still running.
+
+    universe.start_recording("run.traj", every=2, quantize=True)
+    universe.step(1000)
+    universe.stop_recording()
+
+    reader = TrajectoryReader("run.traj")
+    frame = reader.frame(len(reader) - 1)
+"""
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from sim_core import ParticleStore
+
+MAGIC = b"UNIVTRAJ"
+FORMAT_VERSION = 1
+PREFIX_BYTES = len(MAGIC) + 8
+FRAME_MAGIC = b"FRAM"
+FRAME_HEADER = struct.Struct("<4sxxxxqqd")   # magic, count, step, simulation time
+ALIGN = 8
+CHUNK_FRAMES = 16       # Frames buffered before one append to the file
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def frame_columns(pos_dtype):
+    """(name, row shape, dtype) of the per-body columns stored in every frame."""
+    return (("pid", (), np.dtype("<i8")),
+            ("pos", (3,), np.dtype(pos_dtype)),
+            ("radius", (), np.dtype("<f4")),
+            ("color", (3,), np.dtype("u1")))
+
+
+# =============================================================================
+# Recording
+# =============================================================================
+class TrajectoryRecorder:
+    """Appends decimated, optionally float32-quantised frames of a universe to path."""
+
+    def __init__(self, path, every=1, quantize=False, chunk_frames=CHUNK_FRAMES):
+        self.path = path
+        self.every = max(1, int(every))
+        self.chunk_frames = chunk_frames
+        self.columns = frame_columns("<f4" if quantize else "<f8")
+        self.steps = 0          # Steps seen, recorded or not
+        self.frames = 0         # Frames written or buffered
+        self.chunk = []
+        header = json.dumps({
+            "every": self.every,
+            "columns": [{"name": name, "dtype": dtype.str, "shape": list(shape)}
+                        for name, shape, dtype in self.columns],
+        }).encode("utf-8")
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.file.write(np.array([FORMAT_VERSION, len(header)], dtype="<u4").tobytes())
+        self.file.write(header)
+        self.file.write(bytes(_aligned(PREFIX_BYTES + len(header)) - PREFIX_BYTES - len(header)))
+        self.file.flush()
+
+    def record(self, universe):
+        """Note one step of universe; every self.every-th step becomes a frame."""
+        step = self.steps
+        self.steps += 1
+        if step % self.every:
+            return
+        store = universe.particles
+        n = store.n
+        parts = [FRAME_HEADER.pack(FRAME_MAGIC, n, step, universe.simulation_time)]
+        for name, _, dtype in self.columns:
+            data = getattr(store, name)[:n].astype(dtype, copy=False).tobytes()
+            parts.append(data)
+            parts.append(bytes(_aligned(len(data)) - len(data)))
+        self.chunk.append(b"".join(parts))
+        self.frames += 1
+        if len(self.chunk) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.file.write(b"".join(self.chunk))
+            self.chunk = []
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+# =============================================================================
+# Replay
+# =============================================================================
+class TrajectoryReader:
+    """Random access to the frames of a recording through a memory map."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        prefix = self.file.read(PREFIX_BYTES)
+        if len(prefix) < PREFIX_BYTES or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a trajectory recording")
+        version, header_len = np.frombuffer(prefix[len(MAGIC):], dtype="<u4")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{path} uses recording format {version}; "
+                             f"this version reads up to {FORMAT_VERSION}")
+        header = json.loads(self.file.read(int(header_len)).decode("utf-8"))
+        self.every = header["every"]
+        self.columns = [(c["name"], tuple(c["shape"]), np.dtype(c["dtype"]))
+                        for c in header["columns"]]
+        self.row_bytes = [int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                          for _, shape, dtype in self.columns]
+        self.map = None
+        self.offsets = []       # File offset of every complete frame
+        self.end = _aligned(PREFIX_BYTES + int(header_len))
+        self.refresh()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frame_bytes(self, n):
+        return FRAME_HEADER.size + sum(_aligned(n * size) for size in self.row_bytes)
+
+    def refresh(self):
+        """Index frames appended since the last call; returns the new frame count."""
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        if size <= self.end:
+            return len(self.offsets)
+        # Views handed out earlier keep the old mapping alive until released.
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = self.end
+        while offset + FRAME_HEADER.size <= size:
+            magic, n, _, _ = FRAME_HEADER.unpack_from(self.map, offset)
+            if magic != FRAME_MAGIC:
+                raise ValueError(f"{self.path} is corrupt at byte {offset}")
+            length = self.frame_bytes(n)
+            if offset + length > size:
+                break           # Partly written; the recorder is still appending
+            self.offsets.append(offset)
+            offset += length
+        self.end = offset
+        return len(self.offsets)
+
+    def frame(self, index):
+        """
+        Frame index as a dict of read-only column views plus "step" and
+        "simulation_time".
+        """
+        offset = self.offsets[index]
+        _, n, step, simulation_time = FRAME_HEADER.unpack_from(self.map, offset)
+        frame = {"step": step, "simulation_time": simulation_time}
+        offset += FRAME_HEADER.size
+        for (name, shape, dtype), size in zip(self.columns, self.row_bytes):
+            count = n * int(np.prod(shape, dtype=np.int64))
+            frame[name] = np.frombuffer(self.map, dtype=dtype, count=count,
+                                        offset=offset).reshape((n,) + shape)
+            offset += _aligned(n * size)
+        return frame
+
+    def close(self):
+        self.offsets = []
+        self.map = None
+        self.file.close()
+
+
+def frame_arrays(frame):
+    """A full set of ParticleStore.FIELDS arrays for a frame, for ParticleStore.assign."""
+    n = frame["pid"].shape[0]
+    arrays = {name: np.zeros((n,) + shape, dtype=dtype) for name, shape, dtype in ParticleStore.FIELDS}
+    arrays["fixed"][:] = True
+    for name in ("pid", "pos", "radius", "color"):
+        arrays[name][:] = frame[name]
+    return arrays
+
+
+class Player:
+    """
+    Playback cursor over a TrajectoryReader. speed is in recorded frames per
+    tick and may be negative or fractional.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.position = 0.0
+        self.speed = 1.0
+
+    @property
+    def index(self):
+        return int(self.position)
+
+    def seek(self, index):
+        last = len(self.reader) - 1
+        self.position = float(min(max(index, 0), max(last, 0)))
+
+    def seek_fraction(self, fraction):
+        self.seek(round(fraction * (len(self.reader) - 1)))
+
+    def tick(self):
+        """Advance by speed; at the end, pick up frames appended meanwhile."""
+        if self.position + self.speed > len(self.reader) - 1:
+            self.reader.refresh()
+        self.seek(self.position + self.speed)
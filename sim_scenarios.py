@@ -0,0 +1,243 @@
+"""
+Seeded, vectorised initial conditions for large Cosmic Deity scenes.
+
+Universe.create_galaxies builds its scene one body at a time from the
+universe's own random stream. The generators here draw every body of a
+component at once from an explicit numpy Generator and append the arrays
+with Universe.add_bodies. Scenes of a million bodies take well under a
+second, and the same seed gives the same scene on every run and platform.
+
+    rng = np.random.default_rng(42)
+    add_exponential_disk(universe, rng, 100000, center=(950, 500))
+    add_plummer_sphere(universe, rng, 20000, center=(400, 300))
+
+    universe = generate("galaxies", 1000000, seed=42)
+
+Masses are given in kilograms like the create_* methods of Universe and
+scaled by MASS_SCALE. Orbital velocities use universe.G, so set G before
+generating. Universe.step() derives G from the body count, so generate()
+first sets the G of the scene's final count with
+update_gravitational_constant(n) and the scene starts in equilibrium under
+the G it is integrated with.
+
+    python sim_scenarios.py plummer 1000000 --seed 1 --output plummer.ckpt
+"""
+import argparse
+import time
+
+import numpy as np
+
+from sim_core import (AU_TO_PIXELS, EPSILON, HEIGHT, MASS_SCALE, NUM_GALAXIES, PI,
+                      PLANETS_PER_SYSTEM, WIDTH, Universe, as_vec3, preset_colors)
+
+SUN_MASS = 1.989e30         # kg, as in Universe.create_solar_system
+SUN_RADIUS = 50
+BLACK_HOLE_MASS = 1e31      # kg, as the B key in the front-end
+GALAXY_MASS = 1e40          # Mass the galaxy rotation curve of create_galaxy assumes
+SCENARIOS = ("disk", "plummer", "galaxies")
+MIN_BODIES = {"disk": 2, "plummer": 1, "galaxies": 1}   # The disk adds a black hole
+
+
+def _plane(angle):
+    """Unit vectors (cos, sin, 0) for an array of angles."""
+    return np.stack([np.cos(angle), np.sin(angle), np.zeros_like(angle)], axis=-1)
+
+
+def _rows3(values, k):
+    """A scalar, one 2D/3D vector or one vector per row, as a (k, 3) array."""
+    values = np.asarray(values, dtype=np.float64)
+    rows = np.zeros((k, 3))
+    if values.ndim == 0:
+        rows[:] = values
+    else:
+        rows[:, :values.shape[-1]] = values
+    return rows
+
+
+def _isotropic(rng, n):
+    """n random unit vectors, uniform on the sphere."""
+    z = rng.uniform(-1.0, 1.0, n)
+    phi = rng.uniform(0.0, 2 * PI, n)
+    s = np.sqrt(1.0 - z * z)
+    return np.stack([s * np.cos(phi), s * np.sin(phi), z], axis=-1)
+
+
+# =============================================================================
+# Components
+# =============================================================================
+def add_exponential_disk(universe, rng, n, center=(WIDTH / 2, HEIGHT / 2), velocity=(0, 0, 0),
+                         scale_length=150.0, disk_mass=1e30, central_mass=BLACK_HOLE_MASS,
+                         scale_height=0.0, dispersion=0.05, radius=2.0):
+    """
+    A rotating disk of n stars with surface density exp(-R / scale_length).
+    Each star moves at the circular speed of the central mass plus the disk
+    mass inside its radius, with a Gaussian dispersion of that speed (a
+    fraction of it). With central_mass > 0 a black hole is added at the
+    center first. Returns the pids of the stars.
+    """
+    center = as_vec3(center)
+    velocity = as_vec3(velocity)
+    if central_mass > 0:
+        universe.add_bodies(center[None], central_mass * MASS_SCALE, velocity[None],
+                            colors=(80, 0, 80), radii=12, names="Black Hole",
+                            stable=True, p_type="system")
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    # R follows a Gamma(2) distribution, which is the exponential disk profile.
+    r = rng.gamma(2.0, scale_length, n)
+    angle = rng.uniform(0.0, 2 * PI, n)
+    radial = _plane(angle)
+    positions = center + radial * r[:, None]
+    if scale_height > 0:
+        positions[:, 2] += rng.laplace(0.0, scale_height, n)
+
+    x = r / scale_length
+    enclosed = central_mass + disk_mass * (1.0 - (1.0 + x) * np.exp(-x))
+    v_circ = np.sqrt(universe.G * enclosed * MASS_SCALE / (r + EPSILON))
+    tangent = np.stack([-radial[:, 1], radial[:, 0], np.zeros(n)], axis=-1)
+    velocities = velocity + tangent * v_circ[:, None]
+    if dispersion > 0:
+        velocities[:, :2] += rng.normal(0.0, 1.0, (n, 2)) * (dispersion * v_circ)[:, None]
+
+    # Warm core fading to a blue rim.
+    t = np.minimum(x / 4.0, 1.0)[:, None]
+    colors = (1 - t) * np.array([255, 230, 180]) + t * np.array([150, 180, 255])
+    return universe.add_bodies(positions, np.full(n, disk_mass * MASS_SCALE / n), velocities,
+                               colors=colors.astype(np.uint8), radii=radius, names="Star",
+                               p_type="generic")
+
+
+def add_plummer_sphere(universe, rng, n, center=(WIDTH / 2, HEIGHT / 2), velocity=(0, 0, 0),
+                       scale_radius=150.0, total_mass=1e31, max_radius=10.0, radius=2.0):
+    """
+    A Plummer sphere of n equal-mass stars in virial equilibrium, sampled
+    as in Aarseth, Henon & Wielen (1974) and truncated at max_radius scale
+    radii. Returns the pids.
+    """
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    center = as_vec3(center)
+    # Inverse of the cumulative mass profile M(r)/M = r^3 / (r^2 + a^2)^1.5
+    limit = max_radius ** 3 / (1.0 + max_radius ** 2) ** 1.5
+    m = rng.uniform(0.0, limit, n)
+    r = scale_radius / np.sqrt(m ** (-2.0 / 3.0) - 1.0)
+    positions = center + _isotropic(rng, n) * r[:, None]
+
+    # Speed as a fraction q of the local escape speed: rejection sampling of
+    # g(q) = q^2 (1 - q^2)^3.5, whose maximum is just under 0.1.
+    q = np.empty(n)
+    pending = np.arange(n)
+    while pending.shape[0]:
+        x = rng.random(pending.shape[0])
+        y = rng.uniform(0.0, 0.1, pending.shape[0])
+        accepted = y < x * x * (1.0 - x * x) ** 3.5
+        q[pending[accepted]] = x[accepted]
+        pending = pending[~accepted]
+    mass = total_mass * MASS_SCALE
+    v_escape = np.sqrt(2.0 * universe.G * mass / scale_radius) * \
+        (1.0 + (r / scale_radius) ** 2) ** -0.25
+    velocities = as_vec3(velocity) + _isotropic(rng, n) * (q * v_escape)[:, None]
+    return universe.add_bodies(positions, np.full(n, mass / n), velocities,
+                               colors=(255, 200, 150), radii=radius, names="Star",
+                               p_type="generic")
+
+
+def add_planetary_systems(universe, rng, centers, velocities=0.0, num_planets=PLANETS_PER_SYSTEM):
+    """
+    One sun per center with num_planets planets on circular orbits, laid out
+    like Universe.create_solar_system (orbits from 200 to 600 pixels and its
+    15x planet speed-up), for all systems at once. Returns the pids of the
+    suns and of the planets.
+    """
+    k = len(centers)
+    centers = _rows3(centers, k)
+    velocities = _rows3(velocities, k)
+    suns = universe.add_bodies(centers, SUN_MASS * MASS_SCALE, velocities, colors=(255, 255, 0),
+                               radii=SUN_RADIUS, names="Sun", stable=True, p_type="system")
+
+    distance = np.broadcast_to(np.linspace(200, 600, num_planets), (k, num_planets))
+    angle = rng.uniform(0.0, 2 * PI, (k, num_planets))
+    radial = _plane(angle)
+    positions = centers[:, None, :] + radial * distance[..., None]
+    v_mag = np.sqrt(universe.G * SUN_MASS * MASS_SCALE / (distance + EPSILON))
+    tangent = np.stack([-radial[..., 1], radial[..., 0], np.zeros_like(angle)], axis=-1)
+    planet_velocities = (tangent * v_mag[..., None] + velocities[:, None, :]) * 15
+    count = k * num_planets
+    palette = np.array(preset_colors, dtype=np.uint8)
+    planets = universe.add_bodies(positions.reshape(count, 3),
+                                  rng.uniform(1e24, 5e24, count) * MASS_SCALE,
+                                  planet_velocities.reshape(count, 3),
+                                  colors=palette[rng.integers(0, len(palette), count)],
+                                  radii=rng.uniform(5, 15, count), names="Planet",
+                                  stable=True, p_type="system")
+    return suns, planets
+
+
+def add_galaxies(universe, rng, num_galaxies=NUM_GALAXIES, num_systems=1000,
+                 galaxy_radius=500e6, num_planets=PLANETS_PER_SYSTEM):
+    """
+    Galaxies of planetary systems placed and set in rotation like
+    Universe.create_galaxy, num_systems systems each. Returns the pids of
+    the suns and of the planets.
+    """
+    galaxy_centers = rng.uniform((WIDTH * 0.2, HEIGHT * 0.2), (WIDTH * 0.8, HEIGHT * 0.8),
+                                 (num_galaxies, 2))
+    count = num_galaxies * num_systems
+    angle = rng.uniform(0.0, 2 * PI, count)
+    distance = rng.uniform(0.2, 1.0, count) * galaxy_radius * AU_TO_PIXELS
+    radial = _plane(angle)[:, :2]
+    centers = np.repeat(galaxy_centers, num_systems, axis=0) + radial * distance[:, None]
+    v_mag = np.sqrt(universe.G * GALAXY_MASS / (distance + EPSILON))
+    velocities = np.stack([-radial[:, 1], radial[:, 0]], axis=-1) * v_mag[:, None]
+    return add_planetary_systems(universe, rng, centers, velocities, num_planets)
+
+
+# =============================================================================
+# Whole Scenes
+# =============================================================================
+def generate(name, n, seed=0, universe=None):
+    """
+    A universe (a new one unless given) filled with about n bodies of the
+    named scenario: "disk", "plummer" or "galaxies". n must be at least
+    MIN_BODIES of the scenario.
+    """
+    if name not in SCENARIOS:
+        raise ValueError(f"unknown scenario {name!r}; expected one of {SCENARIOS}")
+    if n < MIN_BODIES[name]:
+        raise ValueError(f"scenario {name!r} needs a body count of at least {MIN_BODIES[name]}, got {n}")
+    if universe is None:
+        universe = Universe(seed=seed)
+    rng = np.random.default_rng(seed)
+    per_system = 1 + PLANETS_PER_SYSTEM
+    num_systems = max(1, n // (NUM_GALAXIES * per_system))
+    count = NUM_GALAXIES * num_systems * per_system if name == "galaxies" else n
+    universe.update_gravitational_constant(len(universe.particles) + count)
+    if name == "disk":
+        add_exponential_disk(universe, rng, n - 1)
+    elif name == "plummer":
+        add_plummer_sphere(universe, rng, n)
+    else:
+        add_galaxies(universe, rng, num_systems=num_systems)
+    return universe
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("bodies", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the scene as a checkpoint (see sim_checkpoint)")
+    args = parser.parse_args(argv)
+    if args.bodies < MIN_BODIES[args.scenario]:
+        parser.error(f"{args.scenario} needs a body count of at least {MIN_BODIES[args.scenario]}")
+
+    start = time.perf_counter()
+    universe = generate(args.scenario, args.bodies, args.seed)
+    print(f"{args.scenario}: {len(universe.particles)} bodies in "
+          f"{time.perf_counter() - start:.3f} s")
+    if args.output:
+        universe.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
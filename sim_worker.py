@@ -0,0 +1,463 @@
+"""
+Physics worker process for the Cosmic Deity universe sandbox.
+
+The worker owns a Universe and steps it as fast as one core allows. After a
+step it publishes the particle store and a few scalars into one of two
+shared-memory buffers. The front-end reads the latest completed buffer
+through a RemoteUniverse proxy, which also sends commands back over a queue.
+Commands cover spawning bodies, god-mode actions, dt / time_speed changes
+and pausing. Rendering and input therefore never wait for a physics step.
+
+    universe = RemoteUniverse()
+    universe.start()
+    universe.reset()
+    while running:
+        universe.sync()          # adopt the newest published state
+        draw(universe.particles)
+    universe.close()
+
+Buffers are double-buffered: the worker fills the back buffer and then swaps
+the front index under a lock. The reader copies the front buffer under the
+same lock. When the store outgrows the buffers, the worker allocates a new
+generation of larger segments.
+"""
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import secrets
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sim_core import (DT, DIAGNOSTICS_EVERY, G_SIM, BH_THETA, P_TYPES, Particle, ParticleStore,
+                      SpatialIndex, Universe, compile_kernels, p_type_code)
+
+# =============================================================================
+# Parameters
+# =============================================================================
+PUBLISH_INTERVAL = 1 / 120  # Seconds between published frames while running
+PAUSED_POLL = 0.05          # Command wait while paused (seconds)
+MIN_CAPACITY = 1024         # Bodies per buffer in the first generation
+META_CAPACITY = 1 << 16     # Bytes reserved for the pickled scalar state
+
+# Control block slots (a shared int64 array)
+FRONT, GENERATION, CAPACITY, META_BYTES = range(4)
+# Per-buffer header slots
+H_COUNT, H_META, H_STEPS, H_COMMANDS = range(4)
+HEADER_BYTES = 4 * 8
+
+# Universe attributes the front-end may assign, and methods it may call.
+SETTABLE = ("G", "dt", "time_speed", "force_backend", "bh_theta", "block_levels",
+            "integrator", "precision")
+METHODS = ("reset", "create_solar_system", "create_particle_from_dict",
+           "create_random_particle", "create_random_light", "cosmic_storm",
+           "randomize", "collision_burst", "start_defense", "update_defense",
+           "shoot", "add_body", "add_bodies", "save", "load", "start_recording",
+           "stop_recording", "start_diagnostics", "stop_diagnostics")
+# Methods that take the wall-clock time, mapped to the position of their now
+# argument; the worker drops it from there on and passes its own clock.
+CLOCKED = {"reset": 0, "update_defense": 0, "save": 1, "load": 1}
+
+
+# =============================================================================
+# Shared Buffer Layout
+# =============================================================================
+def buffer_layout(capacity, meta_capacity):
+    """Byte offsets of every store field (8-byte aligned) and the total size."""
+    offsets = {}
+    offset = HEADER_BYTES
+    for name, shape, dtype in ParticleStore.FIELDS:
+        size = capacity * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        offsets[name] = offset
+        offset += -(-size // 8) * 8
+    offsets["meta"] = offset
+    return offsets, offset + meta_capacity
+
+
+def buffer_views(shm, capacity, meta_capacity):
+    """Header, per-field arrays and meta bytes mapped onto one segment."""
+    offsets, _ = buffer_layout(capacity, meta_capacity)
+    header = np.ndarray((4,), dtype=np.int64, buffer=shm.buf)
+    fields = {name: np.ndarray((capacity,) + shape, dtype=dtype, buffer=shm.buf,
+                               offset=offsets[name])
+              for name, shape, dtype in ParticleStore.FIELDS}
+    meta = np.ndarray((meta_capacity,), dtype=np.uint8, buffer=shm.buf,
+                      offset=offsets["meta"])
+    return header, fields, meta
+
+
+def segment_name(prefix, generation, index):
+    return f"{prefix}_{generation}_{index}"
+
+
+# =============================================================================
+# Worker Side
+# =============================================================================
+class PhysicsWorker:
+    """Runs inside the worker process: applies commands, steps and publishes."""
+
+    def __init__(self, prefix, control, lock, commands, seed=None, force_backend="knn"):
+        self.prefix = prefix
+        self.control = np.frombuffer(control, dtype=np.int64)
+        self.lock = lock
+        self.commands = commands
+        self.universe = Universe(seed=seed, force_backend=force_backend)
+        self.paused = False
+        self.running = True
+        self.dirty = True       # Something changed since the last published frame
+        self.applied = 0        # Commands processed, echoed so the proxy can detect stale state
+        self.generation = 0
+        self.segments = []
+        self.buffers = []
+        self.sun_version = -1
+        self.sun_pid = -1
+        self.epoch = time.perf_counter()
+
+    def now(self):
+        """Worker wall clock in milliseconds (defense mode timings)."""
+        return (time.perf_counter() - self.epoch) * 1000.0
+
+    # -------------------------------------------------------------------------
+    # Commands
+    # -------------------------------------------------------------------------
+    def apply(self, command):
+        name, args, kwargs = command
+        self.applied += 1
+        if name == "stop":
+            self.running = False
+        elif name == "pause":
+            self.paused = bool(args[0])
+        elif name == "set":
+            attr, value = args
+            if attr in SETTABLE:
+                setattr(self.universe, attr, value)
+        elif name == "remove":
+            particles = self.universe.particles
+            pid = args[0]
+            if 0 <= pid < particles.row_of.shape[0] and particles.row_of[pid] >= 0:
+                self.universe.remove(Particle.view(particles, pid))
+        elif name in METHODS:
+            if name in CLOCKED:
+                args, kwargs = args[:CLOCKED[name]], {**kwargs, "now": self.now()}
+            getattr(self.universe, name)(*args, **kwargs)
+
+    def drain(self, timeout=None):
+        """Apply every queued command; optionally wait up to timeout for the first."""
+        applied = 0
+        try:
+            command = self.commands.get(timeout=timeout) if timeout else self.commands.get_nowait()
+            while True:
+                self.apply(command)
+                applied += 1
+                command = self.commands.get_nowait()
+        except queue.Empty:
+            pass
+        return applied
+
+    # -------------------------------------------------------------------------
+    # Publishing
+    # -------------------------------------------------------------------------
+    def allocate(self, capacity, meta_capacity):
+        """Create a new generation of buffers, retiring the old one."""
+        old = self.segments
+        generation = self.generation + 1
+        _, size = buffer_layout(capacity, meta_capacity)
+        segments = [shared_memory.SharedMemory(name=segment_name(self.prefix, generation, i),
+                                               create=True, size=size)
+                    for i in range(2)]
+        self.buffers = [buffer_views(shm, capacity, meta_capacity) for shm in segments]
+        self.segments = segments
+        self.generation = generation
+        with self.lock:
+            self.control[GENERATION] = generation
+            self.control[CAPACITY] = capacity
+            self.control[META_BYTES] = meta_capacity
+            self.control[FRONT] = -1     # Nothing complete in this generation yet
+        for shm in old:
+            shm.close()
+            shm.unlink()
+
+    def sun(self):
+        """pid of the first stable Sun (find_sun needs names, which stay here)."""
+        particles = self.universe.particles
+        if particles.version != self.sun_version:
+            sun = self.universe.find_sun(stable_only=True)
+            self.sun_pid = sun._pid if sun is not None else -1
+            self.sun_version = particles.version
+        return self.sun_pid
+
+    def publish(self, steps):
+        u = self.universe
+        particles = u.particles
+        n = particles.n
+        meta = pickle.dumps({
+            "settings": {attr: getattr(u, attr) for attr in SETTABLE},
+            "simulation_time": u.simulation_time,
+            "alive_population": u.alive_population,
+            "defense_score": u.defense_score,
+            "defense_level": u.defense_level,
+            "lights": u.lights,
+            "sun": self.sun(),
+            "p_types": P_TYPES,
+            "diagnostics": u.diagnostics.latest if u.diagnostics is not None else None,
+            "precision_notice": u.precision_notice,
+        })
+        capacity = int(self.control[CAPACITY])
+        meta_capacity = int(self.control[META_BYTES])
+        if self.generation == 0 or n > capacity or len(meta) > meta_capacity:
+            self.allocate(max(MIN_CAPACITY, 2 * n, capacity),
+                          max(META_CAPACITY, 2 * len(meta), meta_capacity))
+        back = 0 if self.control[FRONT] == 1 else 1
+        header, fields, meta_buf = self.buffers[back]
+        for name, _, _ in ParticleStore.FIELDS:
+            fields[name][:n] = getattr(particles, name)[:n]
+        meta_buf[:len(meta)] = np.frombuffer(meta, dtype=np.uint8)
+        header[H_COUNT] = n
+        header[H_META] = len(meta)
+        header[H_STEPS] = steps
+        header[H_COMMANDS] = self.applied
+        with self.lock:
+            self.control[FRONT] = back
+
+    # -------------------------------------------------------------------------
+    # Main loop
+    # -------------------------------------------------------------------------
+    def run(self):
+        steps = 0
+        last_publish = -PUBLISH_INTERVAL
+        # Compile while the front-end shows its menu; commands queue meanwhile.
+        compile_kernels((self.universe.force_backend, "collisions"))
+        try:
+            while self.running:
+                if self.drain(PAUSED_POLL if self.paused else None):
+                    self.dirty = True
+                if not self.running:
+                    break
+                if not self.paused:
+                    self.universe.step()
+                    steps += 1
+                    self.dirty = True
+                now = time.perf_counter()
+                if self.dirty and now - last_publish >= PUBLISH_INTERVAL:
+                    self.publish(steps)
+                    self.dirty = False
+                    last_publish = now
+        finally:
+            self.universe.stop_recording()
+            self.universe.stop_diagnostics()
+            self.buffers = []
+            for shm in self.segments:
+                shm.close()
+                shm.unlink()
+
+
+def run_worker(prefix, control, lock, commands, seed=None, force_backend="knn"):
+    """Process entry point."""
+    PhysicsWorker(prefix, control, lock, commands, seed, force_backend).run()
+
+
+# =============================================================================
+# Front-end Side
+# =============================================================================
+def _forward(name):
+    def method(self, *args, **kwargs):
+        self.send(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = f"Run Universe.{name} in the worker."
+    return method
+
+
+def _setting(attr):
+    def get(self):
+        return self.settings[attr]
+
+    def set(self, value):
+        self.settings[attr] = value
+        self.send("set", attr, value)
+    return property(get, set)
+
+
+class RemoteUniverse:
+    """
+    Front-end proxy for a Universe stepped in a PhysicsWorker process.
+
+    It exposes the attributes and methods sim.py uses. Mutating calls become
+    queued commands, and `particles` is a local mirror store refreshed by
+    sync(). Read-only queries (nearest, particle_at, find_sun) run on that
+    mirror, so they see the state from the last published frame. The mirror
+    keeps the worker's pids, so Particle views survive syncs. It records its
+    own trails, one point per new frame.
+    """
+
+    def __init__(self, seed=None, force_backend="knn"):
+        self.seed = seed
+        self.particles = ParticleStore()
+        self.lights = []
+        self.settings = {"G": G_SIM, "dt": DT, "time_speed": 1.0,
+                         "force_backend": force_backend, "bh_theta": BH_THETA, "block_levels": 0,
+                         "integrator": "verlet", "precision": "float64"}
+        self.simulation_time = 0.0
+        self.alive_population = 0
+        self.defense_score = 0
+        self.defense_level = 1
+        self.steps = 0
+        self.sun_pid = -1
+        self.diagnostics = None # Samples published by the worker, see start_diagnostics
+        self.precision_notice = None
+        self.spatial = SpatialIndex(self)
+        self.paused = False
+        self.sent = 0           # Commands queued so far
+        self.applied = -1       # Commands the worker had applied in the adopted frame
+        self.process = None
+        self.generation = 0
+        self.segments = []
+        self.buffers = []
+
+    G = _setting("G")
+    dt = _setting("dt")
+    time_speed = _setting("time_speed")
+    force_backend = _setting("force_backend")
+    bh_theta = _setting("bh_theta")
+    block_levels = _setting("block_levels")
+    integrator = _setting("integrator")
+    precision = _setting("precision")
+
+    # -------------------------------------------------------------------------
+    # Process lifecycle
+    # -------------------------------------------------------------------------
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.prefix = f"usim{os.getpid()}_{secrets.token_hex(3)}"
+        self.control_array = ctx.RawArray("q", 4)
+        self.control = np.frombuffer(self.control_array, dtype=np.int64)
+        self.control[FRONT] = -1
+        self.lock = ctx.Lock()
+        self.commands = ctx.Queue()
+        self.process = ctx.Process(
+            target=run_worker, name="physics-worker", daemon=True,
+            args=(self.prefix, self.control_array, self.lock, self.commands,
+                  self.seed, self.settings["force_backend"]))
+        self.process.start()
+
+    def close(self, timeout=10.0):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.send("stop")
+                self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+        self.detach()
+
+    def send(self, name, *args, **kwargs):
+        self.commands.put((name, args, kwargs))
+        self.sent += 1
+
+    def set_paused(self, paused):
+        if paused != self.paused:
+            self.paused = paused
+            self.send("pause", paused)
+
+    # -------------------------------------------------------------------------
+    # Reading published frames
+    # -------------------------------------------------------------------------
+    def detach(self):
+        self.buffers = []
+        for shm in self.segments:
+            shm.close()
+        self.segments = []
+
+    def attach(self, generation, capacity, meta_capacity):
+        self.detach()
+        # The worker's resource tracker is shared with this process, so attaching
+        # here does not take over ownership; the worker unlinks the segments.
+        self.segments = [shared_memory.SharedMemory(name=segment_name(self.prefix, generation, i))
+                         for i in range(2)]
+        self.buffers = [buffer_views(shm, capacity, meta_capacity) for shm in self.segments]
+        self.generation = generation
+
+    def sync(self):
+        """Adopt the newest completed frame; returns False if nothing new arrived."""
+        if self.process is None or not self.process.is_alive():
+            code = None if self.process is None else self.process.exitcode
+            raise RuntimeError(f"physics worker is not running (exit code {code})")
+        with self.lock:
+            front = int(self.control[FRONT])
+            if front < 0:
+                return False
+            generation = int(self.control[GENERATION])
+            if generation != self.generation:
+                self.attach(generation, int(self.control[CAPACITY]), int(self.control[META_BYTES]))
+            header, fields, meta_buf = self.buffers[front]
+            steps = int(header[H_STEPS])
+            applied = int(header[H_COMMANDS])
+            if steps == self.steps and applied == self.applied:
+                return False
+            n = int(header[H_COUNT])
+            self.particles.assign({name: arr[:n] for name, arr in fields.items()})
+            meta = pickle.loads(meta_buf[:header[H_META]].tobytes())
+        self.steps = steps
+        self.applied = applied
+        for name in meta["p_types"][len(P_TYPES):]:
+            p_type_code(name)
+        # Keep local settings until the worker has seen every command we sent.
+        if applied >= self.sent:
+            self.settings.update(meta["settings"])
+        self.simulation_time = meta["simulation_time"]
+        self.alive_population = meta["alive_population"]
+        self.defense_score = meta["defense_score"]
+        self.defense_level = meta["defense_level"]
+        self.lights = meta["lights"]
+        self.sun_pid = meta["sun"]
+        self.precision_notice = meta["precision_notice"]
+        sample = meta["diagnostics"]
+        if self.diagnostics is not None and sample is not None:
+            latest = self.diagnostics.latest
+            if latest is None or latest["step"] != sample["step"]:
+                self.diagnostics.record(sample)
+        n = self.particles.n
+        self.particles.record_trails(np.flatnonzero(~self.particles.fixed[:n]))
+        return True
+
+    # -------------------------------------------------------------------------
+    # Universe interface
+    # -------------------------------------------------------------------------
+    def step(self, n=1):
+        """Stepping happens in the worker; this only picks up the latest frame."""
+        self.set_paused(False)
+        self.sync()
+
+    def remove(self, particle):
+        self.send("remove", particle._pid)
+
+    def find_sun(self, stable_only=False):
+        particles = self.particles
+        if 0 <= self.sun_pid < particles.row_of.shape[0] and particles.row_of[self.sun_pid] >= 0:
+            return Particle.view(particles, self.sun_pid)
+        return None
+
+    def start_diagnostics(self, every=DIAGNOSTICS_EVERY, log_path=None):
+        """Sample in the worker (which writes the log); the mirror keeps the published samples."""
+        from sim_diagnostics import Diagnostics
+        self.send("start_diagnostics", every, log_path)
+        self.diagnostics = Diagnostics(every)
+
+    def stop_diagnostics(self):
+        self.send("stop_diagnostics")
+        self.diagnostics = None
+
+    # Queries only read self.particles, so the Universe implementations apply.
+    nearest = Universe.nearest
+    covering = Universe.covering
+    particle_at = Universe.particle_at
+    particles_within = Universe.particles_within
+    particles_in_rect = Universe.particles_in_rect
+
+
+for _name in METHODS:
+    if _name not in vars(RemoteUniverse):
+        setattr(RemoteUniverse, _name, _forward(_name))
+del _name
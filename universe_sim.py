@@ -1,60 +1,160 @@
-import pygame
+"""
+Minimal N-body sandbox: direct-summation gravity with a leapfrog integrator.
+
+Bodies are plain numpy arrays. Accelerations are recomputed every step by
+NumPy broadcasting over blocks of rows, so the pairwise temporaries stay
+within CHUNK_BYTES whatever the body count. Only numpy is needed headless;
+the window needs pygame.
+
+    python universe_sim.py                                  # three-body window
+    python universe_sim.py --headless --steps 200 --bodies 5000
+"""
+import argparse
+import time
+
 import numpy as np
-import math
 
 WIDTH, HEIGHT = 800, 600
 G = 6.67430e-11
-DT = 3600  # one hour per simulation step
-
-class Particle:
-    def __init__(self, name, position, mass, velocity, color=(255, 255, 255), radius=5):
-        self.name = name
-        self.position = np.array(position, dtype=float)
-        if self.position.shape[0] < 3:
-            self.position = np.concatenate([self.position, np.zeros(3 - self.position.shape[0])])
-        self.velocity = np.array(velocity, dtype=float)
-        if self.velocity.shape[0] < 3:
-            self.velocity = np.concatenate([self.velocity, np.zeros(3 - self.velocity.shape[0])])
-        self.mass = mass
-        self.color = color
-        self.radius = radius
-
-    def draw(self, screen):
-        x = int(self.position[0] + WIDTH / 2)
-        y = int(self.position[1] + HEIGHT / 2)
-        pygame.draw.circle(screen, self.color, (x, y), self.radius)
-
-
-def precompute_accelerations(particles):
-    """Precompute initial gravitational accelerations for each particle."""
-    N = len(particles)
-    acc = [np.zeros(3) for _ in range(N)]
-    for i in range(N):
-        for j in range(N):
-            if i == j:
-                continue
-            r_vec = particles[j].position - particles[i].position
-            dist = np.linalg.norm(r_vec)
-            if dist == 0:
-                continue
-            force_dir = r_vec / dist
-            force_mag = G * particles[j].mass / dist ** 2
-            acc[i] += force_dir * force_mag
+DT = 1.0                  # Seconds per simulation step
+SOFTENING = 1.0           # Added to pair distances so close encounters stay finite
+CHUNK_BYTES = 32 << 20    # Memory for the pairwise temporaries of one block of rows
+PAIR_BYTES = 48           # Bytes of temporaries per pair (dx, dy, dz, r^2, weight, mask)
+BODY_MASS = 5e10          # Mass of each body of the classic scene
+DISK_MASS = 2.5e12        # Total mass of a random scene, whatever its body count
+
+
+# =============================================================================
+# Physics
+# =============================================================================
+def chunk_rows(n, chunk_bytes=CHUNK_BYTES):
+    """Rows per block so one block's pairwise temporaries fit in chunk_bytes."""
+    return max(1, chunk_bytes // (PAIR_BYTES * max(n, 1)))
+
+
+def accelerations(pos, mass, softening=SOFTENING, rows=None, out=None):
+    """
+    Gravitational acceleration of every body from all others, evaluated in
+    blocks of rows (default: chunk_rows). Coincident bodies without
+    softening exert no force, as a body does on itself.
+    """
+    n = pos.shape[0]
+    acc = np.empty_like(pos) if out is None else out
+    rows = rows or chunk_rows(n)
+    eps2 = softening * softening
+    x, y, z = pos.T
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        dx = x - x[start:stop, None]
+        dy = y - y[start:stop, None]
+        dz = z - z[start:stop, None]
+        r2 = dx * dx
+        r2 += dy * dy
+        r2 += dz * dz
+        r2 += eps2
+        with np.errstate(divide="ignore"):
+            weight = r2 ** -1.5
+        weight[r2 == 0] = 0.0
+        weight *= mass
+        # sum_j w_ij (x_j - x_i) as one matrix product (BLAS) and a row sum.
+        np.matmul(weight, pos, out=acc[start:stop])
+        acc[start:stop] -= weight.sum(axis=1)[:, None] * pos[start:stop]
+    acc *= G
     return acc
 
 
-def main():
+def potential_energy(pos, mass, softening=SOFTENING, rows=None):
+    """Total potential energy with the same softening and blocks as accelerations."""
+    n = pos.shape[0]
+    rows = rows or chunk_rows(n)
+    eps2 = softening * softening
+    total = 0.0
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        d = pos[None, :, :] - pos[start:stop, None, :]
+        r2 = np.einsum("ijk,ijk->ij", d, d)
+        r2 += eps2
+        # Each pair once: only partners after the row's own body.
+        upper = np.arange(n)[None, :] > np.arange(start, stop)[:, None]
+        inverse = np.zeros_like(r2)
+        np.divide(1.0, np.sqrt(r2), out=inverse, where=upper & (r2 > 0))
+        total -= G * float(mass[start:stop] @ inverse @ mass)
+    return total
+
+
+def energy(pos, vel, mass, softening=SOFTENING):
+    return 0.5 * float(mass @ (vel * vel).sum(axis=1)) + potential_energy(pos, mass, softening)
+
+
+def leapfrog_step(pos, vel, acc, mass, dt, softening=SOFTENING):
+    """
+    One kick-drift-kick leapfrog step in place. acc holds the accelerations
+    at pos on entry and at the new positions on return, so each step costs
+    one force evaluation.
+    """
+    vel += 0.5 * dt * acc
+    pos += dt * vel
+    accelerations(pos, mass, softening, out=acc)
+    vel += 0.5 * dt * acc
+
+
+# =============================================================================
+# Scenes
+# =============================================================================
+def classic_scene():
+    """The original three bodies: positions, velocities, masses, colours and radii."""
+    pos = np.array([[0, 0, 0], [100, 0, 0], [0, 100, 0]], dtype=np.float64)
+    vel = np.array([[0, 0, 0], [0, 1, 0], [-1, 0, 0]], dtype=np.float64)
+    mass = np.full(3, BODY_MASS)
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    return pos, vel, mass, colors, [8, 8, 8]
+
+
+def random_scene(n, seed=0):
+    """n bodies in a thin disk, rotating about its centre at the circular speed of the mass inside."""
+    rng = np.random.default_rng(seed)
+    r = (min(WIDTH, HEIGHT) / 2.5) * np.sqrt(rng.random(n))
+    angle = rng.uniform(0.0, 2 * np.pi, n)
+    radial = np.stack([np.cos(angle), np.sin(angle), np.zeros(n)], axis=-1)
+    pos = radial * r[:, None]
+    pos[:, 2] = rng.normal(0.0, 1.0, n)
+    mass = np.full(n, DISK_MASS / n)
+    inside = np.argsort(np.argsort(r)) * (DISK_MASS / n)
+    speed = np.sqrt(G * inside / (r + SOFTENING))
+    vel = np.stack([-radial[:, 1], radial[:, 0], np.zeros(n)], axis=-1) * speed[:, None]
+    colors = [(255, 255, 255)] * n
+    return pos, vel, mass, colors, [2] * n
+
+
+def make_scene(bodies, seed=0):
+    return classic_scene() if bodies == 3 else random_scene(bodies, seed)
+
+
+# =============================================================================
+# Entry Points
+# =============================================================================
+def run_headless(pos, vel, mass, steps, dt):
+    """Step without a display and print throughput and energy drift."""
+    n = pos.shape[0]
+    e0 = energy(pos, vel, mass)
+    acc = accelerations(pos, mass)
+    start = time.perf_counter()
+    for _ in range(steps):
+        leapfrog_step(pos, vel, acc, mass, dt)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    drift = (energy(pos, vel, mass) - e0) / abs(e0) if e0 else 0.0
+    print(f"{n} bodies, {steps} steps in {elapsed:.3f} s: "
+          f"{steps / elapsed:.1f} steps/s, {steps * n * n / elapsed:.3e} pairs/s, "
+          f"energy drift {drift:+.2e}")
+
+
+def run_window(pos, vel, mass, colors, radii, dt):
+    import pygame
+
     pygame.init()
     screen = pygame.display.set_mode((WIDTH, HEIGHT))
     clock = pygame.time.Clock()
-
-    particles = [
-        Particle("A", [0, 0, 0], 5e10, [0, 0, 0], color=(255, 0, 0), radius=8),
-        Particle("B", [100, 0, 0], 5e10, [0, 1, 0], color=(0, 255, 0), radius=8),
-        Particle("C", [0, 100, 0], 5e10, [-1, 0, 0], color=(0, 0, 255), radius=8),
-    ]
-
-    accelerations = precompute_accelerations(particles)
+    acc = accelerations(pos, mass)
 
     running = True
     while running:
@@ -63,11 +163,10 @@ def main():
                 running = False
 
         screen.fill((0, 0, 0))
-
-        for i, p in enumerate(particles):
-            p.velocity += accelerations[i] * DT
-            p.position += p.velocity * DT
-            p.draw(screen)
+        leapfrog_step(pos, vel, acc, mass, dt)
+        screen_xy = (pos[:, :2] + (WIDTH / 2, HEIGHT / 2)).astype(np.int64).tolist()
+        for xy, color, radius in zip(screen_xy, colors, radii):
+            pygame.draw.circle(screen, color, xy, radius)
 
         pygame.display.flip()
         clock.tick(60)
@@ -75,5 +174,27 @@ def main():
     pygame.quit()
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--headless", action="store_true",
+                        help="step without a window and report throughput")
+    parser.add_argument("--steps", type=int, default=1000, help="steps to run headless")
+    parser.add_argument("--bodies", type=int, default=3,
+                        help="3 for the classic scene, otherwise a random disk of this many")
+    parser.add_argument("--dt", type=float, default=DT)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.bodies < 1:
+        parser.error("--bodies must be at least 1")
+    if args.steps < 0:
+        parser.error("--steps must not be negative")
+
+    pos, vel, mass, colors, radii = make_scene(args.bodies, args.seed)
+    if args.headless:
+        run_headless(pos, vel, mass, args.steps, args.dt)
+    else:
+        run_window(pos, vel, mass, colors, radii, args.dt)
+
+
 if __name__ == "__main__":
     main()